@@ -0,0 +1,218 @@
+import importlib.util
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+
+from shared import scheduler
+from shared import synthetic_funds
+from shared import telemetry
+
+# Benchmarks of process-mf-data.py on synthetic data (see
+# shared/synthetic_funds.py), for reproducing performance regressions
+# without the real data. Each benchmark is run at every scale in a fresh
+# process, and the best wall time of NUM_REPEATS untraced runs is
+# reported alongside its throughput. One further run traces memory with
+# tracemalloc to report the peak memory allocated by the benchmarked
+# call, which includes numpy arrays but not memory allocated by pyarrow.
+
+# process-mf-data.py cannot be imported by name, so load it from its path.
+_spec = importlib.util.spec_from_file_location(
+    "process_mf_data", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    "process-mf-data.py")
+)
+pmf = importlib.util.module_from_spec(_spec)
+sys.modules["process_mf_data"] = pmf
+_spec.loader.exec_module(pmf)
+
+BENCHMARK_DIR = "data/benchmarks"
+
+# The options passed to synthetic_funds.generate_fund_data at each scale.
+# Every scale has a single country group.
+BENCHMARK_SCALES = {
+    "small": {"num_funds": 500, "num_months": 120},
+    "medium": {"num_funds": 5000, "num_months": 240},
+    "large": {"num_funds": 20000, "num_months": 360},
+}
+BENCHMARK_GROUP = "lux"
+
+NUM_REPEATS = 3
+
+# The run options of the end-to-end benchmark.
+RUN_OPTIONS = {"currency_type": "usd", "raw_ret_only": False,
+               "polation_method": "both", "strict_eq": True,
+               "exc_finre": False, "inv_targets": True, "inc_agefilter": True}
+
+# The panels loaded by the load_data benchmark, as (filename_base,
+# value_name, exp_dtype, sparse).
+LOAD_PANELS = [
+    ("usd-monthly-gross-returns", "ret_gross_m", np.float64, False),
+    ("usd-monthly-net-returns", "ret_net_m", np.float64, False),
+    ("monthly-costs", "rep_costs", np.float64, False),
+    ("monthly-net-assets", "net_assets", np.float64, True),
+    ("monthly-morningstar-category", "morningstar_category", object, True),
+]
+
+# Define the setup of each benchmark. Each returns the function to be
+# timed and the number of rows passed into it, and runs from the root
+# directory of the synthetic data.
+def setup_load_data():
+    def run():
+        return [pmf.load_data(filename_base, BENCHMARK_GROUP, series_type="panel",
+                              value_name=value_name, exp_dtype=exp_dtype,
+                              sparse=sparse, categorical=True, use_cache=False)
+                for filename_base, value_name, exp_dtype, sparse in LOAD_PANELS]
+
+    return run, None
+
+def setup_panelmerge():
+    panels = pmf.load_fund_panels(BENCHMARK_GROUP, RUN_OPTIONS["currency_type"])
+    df_mfrets = pmf.trim_nans(panels["rets"])
+    dflist = [df_mfrets, panels["na"], panels["cat"]]
+
+    return (lambda: pmf.panelmerge(dflist, how="left"),
+            telemetry.count_rows(dflist))
+
+def setup_trim_nans():
+    df_mfrets = pmf.load_fund_panels(BENCHMARK_GROUP,
+                                     RUN_OPTIONS["currency_type"])["rets"]
+
+    return lambda: pmf.trim_nans(df_mfrets), len(df_mfrets)
+
+def setup_polate_assets():
+    df_mf = pmf.combine_fund_panels(
+        pmf.load_fund_panels(BENCHMARK_GROUP, RUN_OPTIONS["currency_type"]),
+        RUN_OPTIONS["raw_ret_only"], RUN_OPTIONS["inc_agefilter"]
+    )
+
+    return (lambda: pmf.polate_assets(df_mf, how=RUN_OPTIONS["polation_method"],
+                                      keep=True),
+            len(df_mf))
+
+def setup_agg_verify():
+    df_mf_anyeq = pmf.filter_equity_funds(
+        pmf.categorise_fund_panel(
+            pmf.combine_fund_panels(
+                pmf.load_fund_panels(BENCHMARK_GROUP, RUN_OPTIONS["currency_type"]),
+                RUN_OPTIONS["raw_ret_only"], RUN_OPTIONS["inc_agefilter"]
+            ),
+            RUN_OPTIONS["polation_method"], RUN_OPTIONS["inv_targets"]
+        ),
+        RUN_OPTIONS["strict_eq"], RUN_OPTIONS["exc_finre"]
+    )
+    column_names = ["inv_msci_class", "inv_region", "inv_group", "inv_country",
+                    "domicile"]
+
+    return lambda: pmf.agg_verify(df_mf_anyeq, column_names), len(df_mf_anyeq)
+
+def setup_process_fund_data():
+    # The throughput of a whole run is measured in secid-months of the
+    # returns panel.
+    spec = synthetic_funds.read_spec(".")
+    rows_in = spec["num_secids"][BENCHMARK_GROUP] * spec["num_months"]
+
+    return (lambda: pmf.process_fund_data(BENCHMARK_GROUP, **RUN_OPTIONS),
+            rows_in)
+
+def setup_process_fund_data_polars():
+    # The polars engine is only timed once its output has been checked
+    # against that of the pandas engine.
+    pmf.check_engines(BENCHMARK_GROUP, **RUN_OPTIONS)
+    spec = synthetic_funds.read_spec(".")
+    rows_in = spec["num_secids"][BENCHMARK_GROUP] * spec["num_months"]
+
+    return (lambda: pmf.process_fund_data(BENCHMARK_GROUP, **RUN_OPTIONS,
+                                          engine="polars"),
+            rows_in)
+
+BENCHMARKS = {
+    "load_data": setup_load_data,
+    "panelmerge": setup_panelmerge,
+    "trim_nans": setup_trim_nans,
+    "agg_verify": setup_agg_verify,
+    "polate_assets": setup_polate_assets,
+    "process_fund_data": setup_process_fund_data,
+    "process_fund_data_polars": setup_process_fund_data_polars,
+}
+
+def scale_dir(scale):
+    """Return the root directory of the synthetic data at one scale."""
+    return os.path.abspath(os.path.join(BENCHMARK_DIR, scale))
+
+def prepare_scale(scale):
+    """
+    Generate the synthetic data for one scale, unless data made with
+    the same options already exists.
+    """
+    options = {"country_group_codes": [BENCHMARK_GROUP],
+               **BENCHMARK_SCALES[scale]}
+    spec = synthetic_funds.read_spec(scale_dir(scale))
+    if spec is not None and all(spec[name] == value
+                                for name, value in options.items()):
+        return
+
+    print(f"Generating {scale} synthetic data")
+    synthetic_funds.generate_fund_data(scale_dir(scale), **options)
+
+def run_benchmark(job):
+    """
+    Run one benchmark at one scale, returning a telemetry record of each
+    run of the benchmarked function.
+    """
+    scale, name = job
+    os.chdir(scale_dir(scale))
+    run, rows_in = BENCHMARKS[name]()
+
+    records = []
+    for repeat in range(NUM_REPEATS + 1):
+        traced = repeat == NUM_REPEATS
+
+        # Only the record of the benchmarked function itself is kept, and
+        # not those of the functions it calls.
+        telemetry.start(trace_memory=traced)
+        with telemetry.labels(scale=scale, repeat=repeat, traced=traced):
+            with telemetry.measure(name, rows_in, kind="benchmark") as record:
+                record["rows_out"] = telemetry.count_rows(run())
+        telemetry.stop()
+
+        # Functions that do not return a DataFrame are measured by the
+        # rows passed into them, and loaders by the rows they return.
+        rows = rows_in if rows_in is not None else record["rows_out"]
+        record["rows_per_second"] = rows / record["wall_seconds"]
+        records.append(record)
+
+    return records
+
+if __name__ == "__main__":
+    start_time = datetime.now()
+
+    for scale in BENCHMARK_SCALES:
+        prepare_scale(scale)
+
+    # Run one benchmark at a time, each in a fresh process, so that the
+    # timings do not compete and the peak memory of one benchmark does
+    # not carry over into the next.
+    jobs = [(scale, name) for scale in BENCHMARK_SCALES for name in BENCHMARKS]
+    records = []
+    for (scale, name), result, error in scheduler.imap_budgeted(
+            run_benchmark, {job: 0 for job in jobs}, workers=1):
+        if error is not None:
+            print(f"Benchmark {name} ({scale}) failed: {error!r}")
+            continue
+
+        records.extend(result)
+
+        timed_runs = [record for record in result if not record["traced"]]
+        best = min(timed_runs, key=lambda record: record["wall_seconds"])
+        peak_rss = result[-1]["peak_rss_bytes"]
+        print(f"{scale:>8} {name:<24} {best['wall_seconds']:9.3f} s "
+              f"{best['rows_per_second']:14,.0f} rows/s "
+              f"{result[-1]['traced_peak_bytes'] / 2**20:9.1f} MB traced peak"
+              + (f" {peak_rss / 2**20:9.1f} MB peak rss" if peak_rss else ""))
+
+    report_paths = telemetry.write_report(
+        records, report_dir=os.path.join(BENCHMARK_DIR, "reports"),
+        run_name="benchmark_" + start_time.strftime("%Y%m%d-%H%M%S")
+    )
+    print(f"Benchmark results saved to {report_paths[0]} and {report_paths[1]}")
@@ -1,19 +1,213 @@
 import numpy as np
 import pandas as pd
 import statsmodels.api as sm
-import scipy.stats as stats
 import re
 import os
+import csv
+import functools
 import multiprocessing
-from pandas.tseries.offsets import MonthEnd
+import shutil
+import sys
+import tempfile
+import zlib
 from datetime import datetime
 
+from shared import append_state
+from shared import fund_output
+from shared import lazy_pipeline
+from shared import load_cache
+from shared import month_index
+from shared import panel_reader
+from shared import partition_spill
+from shared import quantile_sketch
+from shared import scheduler
+from shared import stage_cache
+from shared import telemetry
+
 COUNTRY_GROUPS = {0: "lux", 1: "kor", 2: "usa", 3: "can-chn-jpn", 4: "irl-bra",
                   5: "gbr-fra-ind", 6: "esp-tha-aus-zaf-mex-aut-che", 7: "other"}
 
+# The maximum number of country groups to process at once, and the total
+# peak memory (in bytes) that the running groups are allowed to use. The
+# peak memory of a group is estimated as a multiple of the size of its
+# source files.
+NUM_WORKERS = 4
+MEMORY_BUDGET = 32 * 2**30
+MEMORY_PER_INPUT_BYTE = 6
+
+# The same estimate for runs in place (see process_fund_data), and the
+# multiple of the size of the merged panel (the output of the combine
+# stage) that the peak memory of each stage is held under in those runs.
+# This does not count the interpreter itself or a fixed overhead of a few
+# tens of megabytes, which only matters for the smallest groups. Runs
+# that copy between stages peak at up to about twice as much.
+MEMORY_PER_INPUT_BYTE_INPLACE = 3
+INPLACE_MEMORY_MULTIPLE = 5
+
+# The multiple of its size that a block of csv text can take up once it is
+# parsed, which out-of-core runs size the blocks that they read at a time by.
+SPILL_BLOCK_MULTIPLE = 16
+
+# The country groups that are split into shards of funds when this script is
+# run directly, and the number of shards to split each into, such as
+# {"lux": 4, "usa": 4}. No group is split by default.
+GROUP_SHARDS = {}
+
 # Define Assisting Functions
+def data_filename(filename_base, country_group_code):
+    """
+    Return the path of one domicile-grouped data file.
+
+    Parameters
+    ----------
+    filename_base : str
+        The base string of the name of the data to be loaded.
+    country_group_code : str
+        A filename suffix that selects the correct country group.
+    """
+    return (
+        "data/mutual-funds/domicile-grouped/{base}/mf_{base}_{country}.csv"
+        .format(base=filename_base,country=country_group_code)
+    )
+
+def read_wide_panel(filename, exp_dtype=None):
+    """
+    Read one wide panel csv, with one row per secid and one column per
+    month.
+
+    Parameters
+    ----------
+    filename : str
+        The path of the file to be read.
+    exp_dtype : type, default None
+        If provided, sets the datatype of all columns to be loaded
+        except for the three left-most columns.
+
+    Returns
+    -------
+    df_return : DataFrame
+        The wide data, with "fundid" and "secid" as the first two
+        columns and the remaining columns labelled by month index (see
+        shared/month_index.py). Date columns that have no non-nan
+        entries are dropped.
+    """
+    # Pull out the columns names of the csv for use in declaring
+    # the start date and in setting explicit datatypes. Only the
+    # header line is read here, so the file is parsed once.
+    with open(filename, newline="", encoding="utf-8") as f:
+        col_names = pd.Index(next(csv.reader(f)))
+    
+    if exp_dtype is not None:
+        # Pull out column names to declare which columns should be
+        # typed in the next read
+        dict_dtypes = dict(zip(col_names[3:],
+                               [exp_dtype]*(col_names.size-3)))
+        
+        # Read the csv
+        df_return = pd.read_csv(filename, dtype=dict_dtypes)
+    else:
+        df_return = pd.read_csv(filename)
+
+    # Remove the first column (Morningstar Direct doesn't allow you
+    # to drop Fund Name from the data)
+    df_return = df_return.iloc[:, 1:].copy()
+    # Rename panel data columns to month indices
+    months = pd.Series(month_index.to_months(pd.to_datetime(col_names[3:])))
+    df_return.columns = pd.concat([pd.Series(["fundid", "secid"]), months])
+    # Drop date columns that have no non-nan entries
+    df_return.dropna(axis=1, how="all", inplace=True)
+
+    return df_return
+
+def wide_to_long(df_wide, value_names):
+    """
+    Reshape one or more aligned wide panels into a single tall
+    DataFrame containing only the observed cells.
+
+    Unlike DataFrame.melt, which emits a row for every secid-month
+    pair, this builds the tall table directly from the underlying
+    arrays and only emits a row where at least one of the panels has a
+    nonmissing value. Rows are ordered by date and then by the row
+    order of the wide data, which matches the order of a melt with the
+    missing cells removed.
+
+    Parameters
+    ----------
+    df_wide : DataFrame or sequence of DataFrames
+        Wide panels as returned by read_wide_panel. If more than one is
+        given, they must share the same rows and date columns.
+    value_names : str or sequence of str
+        A name for the time-series data component of each panel.
+
+    Returns
+    -------
+    df_return : DataFrame
+        A tall DataFrame with columns "fundid", "secid", "date" and one
+        column for each of value_names.
+    """
+    # Place solitary inputs into lists.
+    if isinstance(df_wide, pd.DataFrame):
+        df_wide = [df_wide]
+    if isinstance(value_names, str):
+        value_names = [value_names]
+
+    # Pull out the data of each panel as a (secid x month) array and
+    # flag every cell that is observed in at least one panel.
+    panel_values = [df.iloc[:, 2:].to_numpy() for df in df_wide]
+    observed = np.zeros(panel_values[0].shape, dtype=bool)
+    for values in panel_values:
+        observed |= pd.notna(values)
+
+    # Find the positions of the observed cells, ordered by month first.
+    date_ix, row_ix = np.nonzero(observed.T)
+
+    # Dates are already month indices, so they only need to be taken
+    # for each row.
+    dates = np.asarray(df_wide[0].columns[2:], dtype=month_index.MONTH_DTYPE)
+
+    # Identifier columns are taken through their arrays so that
+    # categorical identifiers stay categorical.
+    df_return = pd.DataFrame({
+        "fundid": df_wide[0].fundid.array.take(row_ix),
+        "secid": df_wide[0].secid.array.take(row_ix),
+        "date": dates[date_ix]
+    })
+    for name, values in zip(value_names, panel_values):
+        df_return[name] = values[row_ix, date_ix]
+
+    return df_return
+
+def _read_panel_pandas(filename, value_name, exp_dtype, sparse, categorical):
+    """
+    Read one wide panel csv with pandas and reshape it to tall format,
+    as in load_data.
+    """
+    df_return = read_wide_panel(filename, exp_dtype)
+
+    # Convert identifiers while the data is still wide, so that each
+    # identifier is only hashed once rather than once per month.
+    for col in ["fundid", "secid"]:
+        if col in categorical:
+            df_return[col] = df_return[col].astype("category")
+
+    if sparse:
+        # Build the tall table directly from the observed cells.
+        return wide_to_long(df_return, value_name)
+
+    # Reshape panel data to tall format
+    df_return = df_return.melt(id_vars=["fundid","secid"],
+                               var_name="date", value_name=value_name)
+
+    # The melted month indices are left as objects, since the column
+    # labels they came from were mixed with the identifier labels.
+    df_return.date = df_return.date.astype(month_index.MONTH_DTYPE)
+
+    return df_return
+
+@telemetry.timed
 def load_data(filename_base, country_group_code, series_type, value_name=None,\
-              exp_dtype=None, cs_dates=None):
+              exp_dtype=None, cs_dates=None, sparse=False, categorical=False,
+              use_cache=True, engine="arrow"):
     """
     Load one data table for one country.
 
@@ -36,14 +230,42 @@ def load_data(filename_base, country_group_code, series_type, value_name=None,\
         If provided (for cross-sectional data only), indicates which
         columns should be parsed as dates (using the new names provided
         in cs_columns if any are given)
+    sparse : bool, default False
+        If True (for panel data only), only observed (nonmissing) cells
+        are returned rather than the full secid x month grid. This is
+        only appropriate where the table will be left merged onto
+        another, since missing cells are then filled in by the merge.
+    categorical : bool or sequence of str, default False
+        If True, the "fundid" and "secid" columns (and, for panel data
+        with exp_dtype=object, the value column) are loaded as pandas
+        categoricals with lexically sorted categories. If a sequence of
+        column names is given, exactly those columns are converted.
+        Categorical tables that will be combined should be passed
+        through unify_categories first.
+    use_cache : bool, default True
+        If True, the loaded table is stored as a columnar sidecar file
+        (see shared/load_cache.py) and later calls with the same
+        arguments read the sidecar instead of the csv, for as long as
+        the csv is unchanged.
+    engine : {"arrow", "pandas"}, default "arrow"
+        The reader used for panel data with an exp_dtype. "arrow" parses
+        the file in blocks on several threads and reshapes each block
+        as it is read (see shared/panel_reader.py), so that the whole
+        wide table is never held in memory. It falls back to "pandas"
+        if pyarrow is not installed. Other tables are always read with
+        pandas.
 
     Returns
     -------
     df_return : DataFrame
-        The loaded and formatted data to be read.
+        The loaded and formatted data to be read. The dates of panel
+        data are month indices (see shared/month_index.py).
 
     """
     # --- SCRUB INPUTS ---
+    if engine not in ["arrow", "pandas"]:
+        raise ValueError("Parameter engine must be either 'arrow' or 'pandas'.")
+
     # Place solitary cs_dates input into a list.
     if isinstance(cs_dates, str):
         cs_dates = [cs_dates]
@@ -51,56 +273,301 @@ def load_data(filename_base, country_group_code, series_type, value_name=None,\
     # --- LOAD DATA ---
         
     # Declare the filename of the file to be loaded
-    filename = (
-        "data/mutual-funds/domicile-grouped/{base}/mf_{base}_{country}.csv"
-        .format(base=filename_base,country=country_group_code)
-    )
+    filename = data_filename(filename_base, country_group_code)
+
+    # Return the cached table if an up-to-date sidecar exists.
+    loader_args = {"series_type": series_type, "value_name": value_name,
+                   "exp_dtype": exp_dtype, "cs_dates": cs_dates,
+                   "sparse": sparse, "categorical": categorical}
+    if use_cache:
+        df_return = load_cache.read_sidecar(filename, loader_args)
+        if df_return is not None:
+            return df_return
+
+    # Declare which columns should be loaded as categoricals.
+    if categorical is True:
+        categorical = ["fundid", "secid"]
+        if series_type == "panel" and exp_dtype is object:
+            categorical.append(value_name)
+    elif not categorical:
+        categorical = []
+    elif isinstance(categorical, str):
+        categorical = [categorical]
+
     if series_type == "cross":
         # Read and combine the partial csv files
         df_return = pd.read_csv(filename, parse_dates=cs_dates, dayfirst=True)
     elif series_type == "panel":
         if value_name is None:
             raise ValueError("Parameter value_name must be provided for panel data.")
-        
-        # Pull out the columns names of the csv for use in declaring
-        # the start date and in setting explicit datatypes
-        col_names = pd.read_csv(filename, nrows=0).columns
-        
-        if exp_dtype is not None:
-            # Pull out column names to declare which columns should be
-            # typed in the next read
-            dict_dtypes = dict(zip(col_names[3:],
-                                   [exp_dtype]*(col_names.size-3)))
-            
-            # Read the csv
-            df_return = pd.read_csv(filename, dtype=dict_dtypes)
+
+        if (engine == "arrow" and exp_dtype is not None
+                and panel_reader.reader_available()):
+            # Read and reshape the panel block by block. The identifiers
+            # are returned as categoricals.
+            df_return = panel_reader.read_panel(filename, value_name,
+                                                exp_dtype, sparse)
+            for col in ["fundid", "secid"]:
+                if col not in categorical:
+                    df_return[col] = df_return[col].astype(object)
         else:
-            df_return = pd.read_csv(filename)
-    
-        # Remove the first column (Morningstar Direct doesn't allow you
-        # to drop Fund Name from the data)
-        df_return = df_return.iloc[:, 1:].copy()
-        # Rename panel data columns to datetime values
-        dates = pd.Series(pd.to_datetime(col_names[3:]))
-        df_return.columns = pd.concat([pd.Series(["fundid", "secid"]), dates])
-        # Drop date columns that have no non-nan entries
-        df_return.dropna(axis=1, how="all", inplace=True)
-
-        # Reshape panel data to tall format
-        df_return = df_return.melt(id_vars=["fundid","secid"],
-                                   var_name="date", value_name=value_name)
-
-        # Align dates to the end of the month
-        df_return.date = df_return.date + MonthEnd(0)
-        
+            df_return = _read_panel_pandas(filename, value_name, exp_dtype,
+                                           sparse, categorical)
+
     else:
         raise ValueError("Parameter series_type must be either 'panel' "
                          "or 'cross'.")
+
+    for col in categorical:
+        if df_return[col].dtype != "category":
+            df_return[col] = df_return[col].astype("category")
+
+    if use_cache:
+        load_cache.write_sidecar(df_return, filename, loader_args)
     
     # Return the loaded dataframe
     return df_return
 
-def panelmerge(dflist, how="outer"):
+def unify_categories(dflist, column_names):
+    """
+    Give a categorical column the same categories in every DataFrame
+    that contains it, so that the DataFrames can be merged, compared
+    and concatenated without decoding the column.
+
+    The shared categories are the lexically sorted union of the values
+    in every DataFrame, so sorting by a unified column gives the same
+    order as sorting by its string values. The DataFrames are modified
+    in place.
+
+    Parameters
+    ----------
+    dflist : sequence of DataFrames
+        The DataFrames to be unified.
+    column_names : str or sequence of str
+        The columns to unify. Columns that are not yet categorical are
+        converted.
+    """
+    if isinstance(column_names, str):
+        column_names = [column_names]
+
+    for col in column_names:
+        columns = [df[col] for df in dflist if col in df.columns]
+
+        # Collect the distinct values of each column, using the
+        # categories of columns that are already categorical.
+        uniques = [
+            column.cat.categories.to_numpy()
+            if column.dtype == "category"
+            else column.dropna().unique()
+            for column in columns
+        ]
+        categories = pd.Index(np.concatenate(uniques)).unique().sort_values()
+        dtype = pd.CategoricalDtype(categories)
+
+        for df in dflist:
+            if col in df.columns:
+                df[col] = df[col].astype(dtype)
+
+def load_panels(panels, country_group_code):
+    """
+    Load several panel data tables for one country in a single pass,
+    returning one aligned tall DataFrame.
+
+    The wide tables are aligned on their secid rows and date columns
+    before being reshaped, so no merge is required, and only cells
+    that are observed in at least one of the tables are emitted.
+
+    Parameters
+    ----------
+    panels : dict
+        A mapping from the value name of each table to either the base
+        string of its filename, or a (filename_base, exp_dtype) pair.
+    country_group_code : str
+        A filename suffix that selects the correct country group.
+
+    Returns
+    -------
+    df_return : DataFrame
+        A tall DataFrame with columns "fundid", "secid", "date" and one
+        column for each of the requested tables.
+    """
+    df_wides = []
+    for value_name, spec in panels.items():
+        if isinstance(spec, str):
+            filename_base, exp_dtype = spec, None
+        else:
+            filename_base, exp_dtype = spec
+        
+        df_wide = (
+            read_wide_panel(data_filename(filename_base, country_group_code),
+                            exp_dtype)
+            .set_index(["fundid", "secid"])
+        )
+
+        if not df_wide.index.is_unique:
+            raise ValueError(f"Duplicate secids found in {filename_base} for "
+                             f"{country_group_code}.")
+
+        df_wides.append(df_wide)
+
+    # Align every table to the union of all secids and all dates.
+    row_index = df_wides[0].index
+    date_index = df_wides[0].columns
+    for df_wide in df_wides[1:]:
+        row_index = row_index.union(df_wide.index, sort=False)
+        date_index = date_index.union(df_wide.columns)
+
+    df_wides = [
+        df_wide.reindex(index=row_index, columns=date_index).reset_index()
+        for df_wide in df_wides
+    ]
+
+    return wide_to_long(df_wides, list(panels.keys()))
+
+PANEL_KEYS = ["fundid", "secid", "date"]
+
+def encode_panel_keys(dflist, keys=PANEL_KEYS):
+    """
+    Encode the panel keys of several DataFrames into a single compact
+    int64 key space.
+
+    Each key column is factorised once across all of the DataFrames,
+    and the resulting codes are combined into one composite integer per
+    row. Composite keys are then numbered in order of first appearance
+    (through the first DataFrame, then the second, and so on), which is
+    the same order that a chain of pandas merges places rows in.
+
+    Parameters
+    ----------
+    dflist : sequence of DataFrames
+        The DataFrames whose keys should be encoded.
+    keys : sequence of str, default PANEL_KEYS
+        The key columns shared by every DataFrame.
+
+    Returns
+    -------
+    codes : list of ndarray
+        For each DataFrame, the int64 code of each of its rows.
+    first_positions : ndarray
+        For each code, the position of the first row carrying that code
+        across all of the DataFrames stacked end to end.
+    """
+    lengths = [len(df) for df in dflist]
+
+    composite = np.zeros(sum(lengths), dtype=np.int64)
+    for key in keys:
+        # Categorical keys that share their categories across every
+        # DataFrame are already integer encoded, so their codes can be
+        # used directly without decoding the values.
+        columns = [df[key] for df in dflist]
+        if all(column.dtype == "category"
+               and column.cat.categories.equals(columns[0].cat.categories)
+               for column in columns):
+            key_values = np.concatenate([column.cat.codes.to_numpy()
+                                         for column in columns])
+        else:
+            key_values = np.concatenate([column.to_numpy()
+                                         for column in columns])
+
+        # Factorise this key across every DataFrame at once. Missing
+        # values are given their own code, since pandas merges match
+        # missing keys with each other.
+        key_codes, key_uniques = pd.factorize(key_values,
+                                              use_na_sentinel=False)
+        composite = composite * (len(key_uniques) + 1) + key_codes
+
+        # Renumber the composite key whenever another level could
+        # overflow int64.
+        composite, composite_uniques = pd.factorize(composite)
+
+    split_points = np.cumsum(lengths)[:-1]
+    codes = np.split(composite, split_points)
+
+    # Find the first row holding each code. Writing positions in reverse
+    # leaves the earliest position for each code in place.
+    first_positions = np.empty(len(composite_uniques), dtype=np.int64)
+    first_positions[composite[::-1]] = np.arange(len(composite))[::-1]
+
+    return codes, first_positions
+
+def panel_keys_unique(df_in):
+    """
+    Return True if no two rows of a panel DataFrame share a secid and
+    date, and no row is missing either. Rows that share a secid and a
+    date would also share a fundid, so this implies that the full panel
+    keys are unique.
+
+    The check is made on a single integer per row built from the secid
+    codes and date codes. Returns False without checking if that integer
+    would not be small enough to count directly.
+    """
+    if df_in.secid.dtype == "category":
+        secid_codes = df_in.secid.cat.codes.to_numpy().astype(np.int64)
+        num_secids = len(df_in.secid.cat.categories)
+    else:
+        secid_codes, secid_uniques = pd.factorize(df_in.secid)
+        num_secids = len(secid_uniques)
+    date_codes, date_uniques = pd.factorize(df_in.date)
+
+    num_keys = num_secids * len(date_uniques)
+    if (len(df_in) == 0 or num_keys > 4*len(df_in)
+            or secid_codes.min() < 0 or date_codes.min() < 0):
+        return False
+
+    composite = secid_codes * len(date_uniques) + date_codes
+    return np.bincount(composite, minlength=num_keys).max() <= 1
+
+def encode_group_keys(df_in, by):
+    """
+    Number the groups of a DataFrame in order of their sorted keys.
+
+    Each key column is converted to sorted integer codes (categorical
+    columns use their own codes, so sort in category order) and the
+    codes are combined into a single integer per row. Unlike
+    DataFrame.groupby(by).ngroup(), no hash table of key combinations
+    is built, and groups of categorical keys are always numbered in
+    sorted order rather than in order of first appearance.
+
+    Parameters
+    ----------
+    df_in : DataFrame
+        The data to be grouped.
+    by : str or sequence of str
+        The columns to group by.
+
+    Returns
+    -------
+    codes : ndarray
+        The int64 code of each row, or -1 for rows with any missing
+        key. Codes sort in the same order as the keys, but need not be
+        consecutive.
+    """
+    if isinstance(by, str):
+        by = [by]
+
+    codes = np.zeros(len(df_in), dtype=np.int64)
+    is_missing = np.zeros(len(df_in), dtype=bool)
+    for key in by:
+        if df_in[key].dtype == "category":
+            key_codes = df_in[key].cat.codes.to_numpy().astype(np.int64)
+            num_codes = len(df_in[key].cat.categories)
+        else:
+            key_codes, key_uniques = pd.factorize(df_in[key], sort=True)
+            num_codes = len(key_uniques)
+        is_missing |= key_codes < 0
+
+        # Renumber the codes so far, keeping their order, whenever
+        # another level could overflow int64.
+        if (codes.max(initial=0) + 1) * (num_codes + 1) >= 2**62:
+            codes = np.unique(codes, return_inverse=True)[1]
+
+        codes = codes*num_codes + key_codes
+
+    codes[is_missing] = -1
+    return codes
+
+@telemetry.timed
+def panelmerge(dflist, how="outer", engine="keyed"):
     """
     Merge panel data into a single DataFrame.
     Parameters 
@@ -109,6 +576,14 @@ def panelmerge(dflist, how="outer"):
         A list of dataframes containing panel data to be merged.
     join : {"outer", "inner", "left", "right", "cross"}, default "outer"
         The join parameter to fed into the call to the merge call.
+    engine : {"keyed", "merge"}, default "keyed"
+        If "keyed", the panel keys are encoded as integers once and all
+        DataFrames are aligned to the result in a single pass. If
+        "merge", the DataFrames are merged pairwise on the panel keys.
+        The keyed engine supports outer and left joins of DataFrames
+        with unique panel keys and no other shared columns, and falls
+        back to the merge engine otherwise. Both engines return the
+        same rows in the same order.
         
     Returns
     -------
@@ -116,6 +591,13 @@ def panelmerge(dflist, how="outer"):
         The merged DataFrame.
     """
 
+    if engine == "keyed":
+        df_return = _panelmerge_keyed(dflist, how)
+        if df_return is not None:
+            return df_return
+    elif engine != "merge":
+        raise ValueError("engine must be 'keyed' or 'merge'.")
+
     # Start a progress bar
     for i in dflist:
         # For the first dataframe, set the return variable to that
@@ -124,53 +606,246 @@ def panelmerge(dflist, how="outer"):
         if i is dflist[0]:
             df_return = i.copy()
         else:
-            df_return = df_return.merge(i, on=["fundid", "secid", "date"],
-                                        how=how)
+            df_return = df_return.merge(i, on=PANEL_KEYS, how=how)
     
     return df_return
 
-def trim_nans(df_in, id_level="secid"):
+def _panelmerge_keyed(dflist, how):
     """
-    For a DataFrame of mutual fund data, drop any observations for a
-    fund class before the first nonmissing observation of gross return
-    and after the last nonmissing observation.
-    
+    Join panel DataFrames through integer-encoded panel keys. Returns
+    None if the join cannot be expressed this way, in which case the
+    caller should fall back to pairwise merges.
+    """
+    if how not in ["outer", "left"] or len(dflist) < 2:
+        return None
+
+    # Value columns shared between DataFrames would be suffixed by a
+    # merge, which this engine does not replicate.
+    value_columns = [[col for col in df.columns if col not in PANEL_KEYS]
+                     for df in dflist]
+    all_value_columns = [col for cols in value_columns for col in cols]
+    if len(set(all_value_columns)) != len(all_value_columns):
+        return None
+
+    # Panels read from files with the same rows and months (such as the
+    # dense return and cost panels) share their keys row for row. If
+    # those keys are unique, the join only places the value columns of
+    # each DataFrame side by side, so the keys need not be encoded.
+    if (all(df[key].equals(dflist[0][key])
+            for df in dflist[1:] for key in PANEL_KEYS)
+            and panel_keys_unique(dflist[0])):
+        df_return = dflist[0].copy()
+        df_return.reset_index(drop=True, inplace=True)
+        for df, df_value_columns in zip(dflist[1:], value_columns[1:]):
+            for col in df_value_columns:
+                if pd.api.types.is_extension_array_dtype(df[col]):
+                    df_return[col] = df[col].array.copy()
+                else:
+                    df_return[col] = df[col].to_numpy(copy=True)
+        return df_return
+
+    codes, first_positions = encode_panel_keys(dflist)
+
+    # Duplicate keys within a DataFrame would be multiplied out by a
+    # merge, which this engine also does not replicate.
+    for df_codes in codes:
+        if np.bincount(df_codes).max(initial=0) > 1:
+            return None
+
+    # For an outer join, the output holds every key in order of first
+    # appearance. For a left join, it holds the keys of the first
+    # DataFrame in their original order, which are numbered first.
+    if how == "outer":
+        n_out = len(first_positions)
+    else:
+        n_out = len(dflist[0])
+        first_positions = first_positions[:n_out]
+
+    # Take the key columns for each output row from the first row that
+    # carried that key.
+    df_return = pd.DataFrame({
+        key: pd.concat([df[key] for df in dflist], ignore_index=True)
+               .take(first_positions).reset_index(drop=True)
+        for key in PANEL_KEYS
+    })
+
+    # Scatter the values of each DataFrame into the output rows. Rows
+    # whose keys are missing from a DataFrame are filled with NaN.
+    for df, df_codes, df_value_columns in zip(dflist, codes, value_columns):
+        in_output = df_codes < n_out
+        row_indexer = np.full(n_out, -1, dtype=np.int64)
+        row_indexer[df_codes[in_output]] = np.flatnonzero(in_output)
+
+        for col in df_value_columns:
+            # Extension arrays (such as categoricals) are taken directly
+            # so that they keep their dtype.
+            if pd.api.types.is_extension_array_dtype(df[col]):
+                values = df[col].array
+            else:
+                values = df[col].to_numpy()
+            df_return[col] = pd.api.extensions.take(values, row_indexer,
+                                                    allow_fill=True)
+
+    # Match the column order of a merge, where the key columns sit
+    # wherever they were placed in the first DataFrame.
+    first_columns = list(dflist[0].columns)
+    later_columns = [col for cols in value_columns[1:] for col in cols]
+    return df_return[first_columns + later_columns]
+
+def keyed_lookup(df_in, df_lookup, key, value_names):
+    """
+    Attach columns from a small cross-sectional lookup table to a panel
+    DataFrame, keeping only the rows whose key appears in the lookup
+    table.
+
+    This is equivalent to an inner merge on the key, but maps each row
+    through a keyed index rather than joining full tables. The rows are
+    returned in the same order that an inner merge places them, that
+    being grouped by key in order of each key's first appearance.
+
     Parameters
     ----------
     df_in : DataFrame
-        DataFrame to be trimmed.
-    id_level : {"secid", "fundid"}, default "secid"
-        Inner-most level of ID still in the DataFrame
+        The panel data to be extended.
+    df_lookup : DataFrame
+        The lookup table. If its key column is not unique, the
+        DataFrames are merged instead.
+    key : str
+        The name of the key column shared by both DataFrames.
+    value_names : str or sequence of str
+        The columns of df_lookup to attach.
+
+    Returns
+    -------
+    df_return : DataFrame
+        The extended DataFrame.
+    """
+    if isinstance(value_names, str):
+        value_names = [value_names]
+
+    if not df_lookup[key].is_unique:
+        return df_in.merge(df_lookup.loc[:, [key] + value_names])
+
+    lookup_index = pd.Index(df_lookup[key])
+    row_positions = lookup_index.get_indexer(df_in[key])
+
+    # Group rows by key in order of first appearance, as an inner merge
+    # does, dropping any rows whose key is not in the lookup table.
+    key_codes = pd.factorize(df_in[key], use_na_sentinel=False)[0]
+    row_order = np.argsort(key_codes, kind="stable")
+    row_order = row_order[row_positions[row_order] >= 0]
+
+    df_return = df_in.take(row_order).reset_index(drop=True)
+    for col in value_names:
+        df_return[col] = (
+            df_lookup[col].take(row_positions[row_order])
+                          .reset_index(drop=True)
+        )
+
+    return df_return
+
+def keyed_assign(df_in, df_lookup, key, value_names):
+    """
+    Attach columns from a small lookup table to a DataFrame in place.
+
+    This gives the same columns as a left merge on the key, but keeps
+    the rows of df_in where they are rather than building a new
+    DataFrame, so only the new columns are allocated. Rows whose key is
+    not in the lookup table are given missing values.
+
+    Parameters
+    ----------
+    df_in : DataFrame
+        The data to be extended. The columns are added to it directly.
+    df_lookup : DataFrame
+        The lookup table. Its key column must be unique.
+    key : str
+        The name of the key column shared by both DataFrames.
+    value_names : str or sequence of str
+        The columns of df_lookup to attach.
+    """
+    if isinstance(value_names, str):
+        value_names = [value_names]
+
+    if not df_lookup[key].is_unique:
+        raise ValueError("The key of df_lookup must be unique.")
+
+    row_positions = pd.Index(df_lookup[key]).get_indexer(df_in[key])
+
+    for col in value_names:
+        # Extension arrays (such as categoricals) are taken directly so
+        # that they keep their dtype, as in _panelmerge_keyed.
+        if pd.api.types.is_extension_array_dtype(df_lookup[col]):
+            values = df_lookup[col].array
+        else:
+            values = df_lookup[col].to_numpy()
+        df_in[col] = pd.api.extensions.take(values, row_positions,
+                                            allow_fill=True)
+
+def trim_flag(df_in, id_level="secid"):
+    """
+    Return a boolean Series that is True for each row of a DataFrame of
+    mutual fund data that trim_nans keeps.
     """
-    
     # First, forward and back fill values of gross return. Then, delete
     # any observations for which either of the fills is null, because
     # observations before the first return will have null forward fill
     # values, and observations after the final return will have null
-    # back fill values.
-    df_in["before_first_ret_flag"] = (
-        df_in.groupby(id_level).ret_gross_m.ffill()
+    # back fill values. The fills are kept out of df_in so that the
+    # input is not modified, and can be shared between runs.
+    before_first_ret_flag = (
+        df_in.groupby(id_level, observed=True).ret_gross_m.ffill()
     )
-    df_in["after_final_ret_flag"] = (
-        df_in.groupby(id_level).ret_gross_m.bfill()
+    after_final_ret_flag = (
+        df_in.groupby(id_level, observed=True).ret_gross_m.bfill()
     )
+
+    return before_first_ret_flag.notna() & after_final_ret_flag.notna()
+
+@telemetry.timed
+def trim_nans(df_in, id_level="secid", inplace=False):
+    """
+    For a DataFrame of mutual fund data, drop any observations for a
+    fund class before the first nonmissing observation of gross return
+    and after the last nonmissing observation.
     
-    df_return = (
-        df_in.copy()
-             .dropna(subset=["before_first_ret_flag","after_final_ret_flag"],
-                     how="any")
-             .drop(["before_first_ret_flag", "after_final_ret_flag"], axis=1)
-    )
+    Parameters
+    ----------
+    df_in : DataFrame
+        DataFrame to be trimmed.
+    id_level : {"secid", "fundid"}, default "secid"
+        Inner-most level of ID still in the DataFrame
+    inplace : bool, default False
+        If True, the rows are dropped from df_in itself, which is then
+        returned, rather than from a copy. The index of df_in must be
+        unique.
+    """
+    keep_flag = trim_flag(df_in, id_level)
+
+    if inplace:
+        if not keep_flag.all():
+            df_in.drop(index=df_in.index[~keep_flag.to_numpy()], inplace=True)
+        return df_in
+
+    df_return = df_in.loc[keep_flag].copy()
 
     return df_return
 
-def agg_verify(df_in, column_names, return_concurrents=False):
+@telemetry.timed
+def agg_verify(df_in, column_names, return_concurrents=False,
+               return_conflicts=False):
     """
     Verify that secids can be aggregated into one fundid on each date.
     This function will take a list of column names and check to make
     sure there is at most one value in that column across all secids
     that share a fundid and a date. The function will return a list of
     the columns that contain discrepancies, or an empty list if none do
+
+    Rather than counting the unique values of every fundid-date pair,
+    each column is factorised into integer codes and a pair has
+    discrepancies if the smallest and largest of its non-missing codes
+    differ. Rows are sorted into their pairs once, and each column is
+    then checked with one pass over its sorted codes.
     
     Parameters
     ----------
@@ -181,6 +856,9 @@ def agg_verify(df_in, column_names, return_concurrents=False):
     return_concurrents : bool
         If True, the function will return the df_concurrents
         DataFrame instead of the list of discrepancies.
+    return_conflicts : bool, default False
+        If True, the function will return the df_conflicts DataFrame
+        instead of the list of discrepancies.
         
     Returns
     -------
@@ -192,57 +870,454 @@ def agg_verify(df_in, column_names, return_concurrents=False):
     df_concurrents : DataFrame
         A DataFrame containing the number of unique values of each of
         the input columns across all of their fundid-date pairs.
+
+    or
+
+    df_conflicts : DataFrame
+        A DataFrame with columns "fundid", "date" and "column", holding
+        one row for every fundid-date pair and column with more than one
+        value, sorted by fundid, date and then by the order of
+        column_names.
     """
     # If only one column name is given, add it to a list.
     if isinstance(column_names, str):
         column_names = [column_names]
-    
-    # Calculate the maximum number of unique values in each of the
-    # testable columns across all rows that share a fundid and date.
-    df_concurrents = (
-        df_in.groupby(["fundid", "date"])[column_names].nunique()
-    )
 
-    df_maxconcurrents = df_concurrents.max()
-    
+    # Sort rows into contiguous fundid-date pairs in the order of the
+    # sorted pairs. Rows with a missing fundid or date are left out, as
+    # they would be by a groupby.
+    group_codes = encode_group_keys(df_in, ["fundid", "date"])
+    order = np.argsort(group_codes, kind="stable")
+    order = order[group_codes[order] >= 0]
+    starts, lengths = segment_bounds(group_codes[order])
+    del group_codes
+
     # Initialise the return variable as an empty list.
     ret_list = []
-    
-    # Loop through every column name, check the max number of
-    # concurrent unique values, and add a discrepancy if that number
-    # is more than 1.
-    for i in df_maxconcurrents.index:
-        if df_maxconcurrents[i] == 0:
-            print("Warning: "+i+" contains no usable observations")
-        elif df_maxconcurrents[i] > 1:
-            ret_list += [i]
-    
+    conflict_groups, conflict_columns = [], []
+
+    # Loop through every column name, find the pairs with more than one
+    # distinct non-missing value, and add a discrepancy if there are any.
+    for i, col in enumerate(column_names):
+        if df_in[col].dtype == "category":
+            codes = df_in[col].cat.codes.to_numpy()[order]
+        else:
+            codes = pd.factorize(df_in[col])[0][order]
+
+        if len(starts) == 0:
+            continue
+
+        if codes.max() < 0:
+            print("Warning: "+col+" contains no usable observations")
+            continue
+
+        # Missing values have a code of -1 and, as with nunique, are not
+        # counted as a value. They are replaced by the largest possible
+        # code when finding the smallest code of each pair, so a pair
+        # with no values has a minimum above its maximum.
+        group_min = np.minimum.reduceat(
+            np.where(codes >= 0, codes, np.iinfo(codes.dtype).max), starts
+        )
+        group_max = np.maximum.reduceat(codes, starts)
+        is_conflict = group_min < group_max
+
+        if is_conflict.any():
+            ret_list += [col]
+            if return_conflicts:
+                conflict_groups.append(np.flatnonzero(is_conflict))
+                conflict_columns.append(
+                    np.full(conflict_groups[-1].shape, i, dtype=np.int64)
+                )
+
     if return_concurrents:
-        output = df_concurrents
+        output = (
+            df_in.groupby(["fundid", "date"], observed=True)[column_names]
+            .nunique()
+        )
+    elif return_conflicts:
+        conflict_groups = np.concatenate([np.zeros(0, dtype=np.int64)]
+                                         + conflict_groups)
+        conflict_columns = np.concatenate([np.zeros(0, dtype=np.int64)]
+                                          + conflict_columns)
+        sorted_conflicts = np.lexsort((conflict_columns, conflict_groups))
+
+        # Read the keys of each pair from its first row. Each key is taken
+        # as a Series, since taking both at once as a DataFrame can make
+        # pandas consolidate (and so copy) every column of df_in.
+        first_rows = order[starts[conflict_groups[sorted_conflicts]]]
+        output = pd.DataFrame({
+            key: df_in[key].iloc[first_rows].reset_index(drop=True)
+            for key in ["fundid", "date"]
+        })
+        output["column"] = pd.Categorical.from_codes(
+            conflict_columns[sorted_conflicts], categories=column_names
+        )
     else:
         output = ret_list
         
     return output
 
-def polate_assets(df_in, how="interpolate", keep=False, retain_testdata=False):
+def segment_bounds(codes):
     """
-    This function either interpolates, extrapolates or both interpolates
-    and extrapolates values of net assets within fund classes within a
-    given dataframe.
-    
+    Find the contiguous segments of a sorted array of group codes.
+
     Parameters
     ----------
-    df_in : DataFrame
-        The data to be interpolated and/or extrapolated.
-    how : {"interpolate", "extrapolate", "both", False},
-        default "interpolate"
-        The method to be used to add additional observations
-    keep : bool, default False
-        If True, the returned dataframe will retain the original net
-        assets column
-    retain_testdata : bool, default False
-        If true, the returned dataframe will contain some additional
+    codes : ndarray
+        Group codes in which the rows of each group are contiguous.
+
+    Returns
+    -------
+    starts : ndarray
+        The position of the first row of each segment.
+    lengths : ndarray
+        The number of rows in each segment.
+    """
+    n = len(codes)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    is_start = np.empty(n, dtype=bool)
+    is_start[0] = True
+    np.not_equal(codes[1:], codes[:-1], out=is_start[1:])
+
+    starts = np.flatnonzero(is_start)
+    lengths = np.diff(np.append(starts, n))
+    return starts, lengths
+
+def segment_ffill(values, first):
+    """
+    Forward fill NaN values of a float array within segments.
+
+    Parameters
+    ----------
+    values : ndarray
+        The values to be filled, ordered by segment.
+    first : ndarray
+        For each row, the position of the first row of its segment.
+    """
+    n = len(values)
+    positions = np.where(np.isnan(values), -1, np.arange(n))
+    np.maximum.accumulate(positions, out=positions)
+    return np.where(positions >= first, values[positions], np.nan)
+
+def segment_bfill(values, last):
+    """
+    Back fill NaN values of a float array within segments.
+
+    Parameters
+    ----------
+    values : ndarray
+        The values to be filled, ordered by segment.
+    last : ndarray
+        For each row, the position of the last row of its segment.
+    """
+    n = len(values)
+    positions = np.where(np.isnan(values), n, np.arange(n))
+    positions = np.minimum.accumulate(positions[::-1])[::-1]
+    return np.where(positions <= last,
+                    values[np.minimum(positions, n - 1)], np.nan)
+
+def segment_cumprod(values, starts, lengths):
+    """
+    Take the cumulative product of a float array within segments.
+
+    Each product is accumulated in row order, one multiplication at a
+    time, so the results are identical to those of a groupby cumprod.
+    The loop runs once per position within a segment (so as many times
+    as the longest segment is long), with every segment advanced
+    together.
+
+    Parameters
+    ----------
+    values : ndarray
+        The values to be multiplied, ordered by segment. Must not
+        contain NaN.
+    starts, lengths : ndarray
+        The segments of values, as returned by segment_bounds.
+    """
+    out = values.copy()
+    if len(lengths) == 0:
+        return out
+
+    # Order segments from longest to shortest, so that the segments
+    # still running at each step are always a leading slice.
+    longest_first = np.argsort(-lengths, kind="stable")
+    sorted_starts = starts[longest_first]
+    sorted_lengths = lengths[longest_first]
+
+    for step in range(1, sorted_lengths[0]):
+        n_running = np.searchsorted(-sorted_lengths, -step, side="left")
+        positions = sorted_starts[:n_running] + step
+        out[positions] = out[positions - 1] * values[positions]
+
+    return out
+
+def segment_sum(values, starts, lengths):
+    """
+    Sum a float array within segments, propagating NaN.
+
+    Each segment is summed exactly as np.sum would sum it on its own,
+    so a segment containing any NaN sums to NaN and results are
+    identical to calling np.sum on each group's values. Segments of
+    fewer than eight values (which np.sum adds in order) are summed
+    together one position at a time. Longer segments, which np.sum
+    adds pairwise, are passed to np.sum individually.
+
+    Parameters
+    ----------
+    values : ndarray
+        The values to be summed, ordered by segment.
+    starts, lengths : ndarray
+        The segments of values, as returned by segment_bounds.
+    """
+    out = values[starts].copy()
+
+    short = np.flatnonzero(lengths < 8)
+    short = short[np.argsort(-lengths[short], kind="stable")]
+    short_lengths = lengths[short]
+    for step in range(1, short_lengths.max(initial=1)):
+        n_running = np.searchsorted(-short_lengths, -step, side="left")
+        running = short[:n_running]
+        out[running] += values[starts[running] + step]
+
+    for i in np.flatnonzero(lengths >= 8):
+        out[i] = np.sum(values[starts[i]:starts[i] + lengths[i]])
+
+    return out
+
+def segment_mode(codes, starts, lengths):
+    """
+    Find the most common code within each segment.
+
+    Ties are broken in favour of the code that appears first in the
+    segment. Missing values should be given a code of their own (for
+    example -1), in which case they are counted like any other value.
+
+    Parameters
+    ----------
+    codes : ndarray
+        Integer codes, ordered by segment.
+    starts, lengths : ndarray
+        The segments of codes, as returned by segment_bounds.
+
+    Returns
+    -------
+    modes : ndarray
+        The modal code of each segment.
+    """
+    # Count each distinct (segment, code) pair and find where it first
+    # appears, using a single integer key per pair.
+    offset = codes.min(initial=0)
+    n_codes = codes.max(initial=0) - offset + 1
+    segment_ids = np.repeat(np.arange(len(starts)), lengths)
+    pair_keys = segment_ids * n_codes + (codes - offset)
+    pairs, first_seen, counts = np.unique(pair_keys, return_index=True,
+                                          return_counts=True)
+
+    # Rank the pairs of each segment by count, then by first appearance,
+    # and keep the top pair of each segment.
+    pair_segments = pairs // n_codes
+    ranked = np.lexsort((first_seen, -counts, pair_segments))
+    is_top = np.ones(len(ranked), dtype=bool)
+    is_top[1:] = pair_segments[ranked][1:] != pair_segments[ranked][:-1]
+
+    return pairs[ranked][is_top] % n_codes + offset
+
+def segment_first(codes, starts, lengths):
+    """
+    Return the first non-missing code of each contiguous segment, or -1
+    if every code in the segment is missing (negative).
+
+    Parameters
+    ----------
+    codes : ndarray of int
+        Integer codes, already sorted into contiguous segments.
+    starts, lengths : ndarray of int
+        The output of segment_bounds.
+    """
+    n = len(codes)
+    if n == 0:
+        return np.empty(0, dtype=codes.dtype)
+
+    # Replace the position of each missing code with n, so that the
+    # minimum position in each segment is its first non-missing code.
+    positions = np.where(codes >= 0, np.arange(n), n)
+    firsts = np.minimum.reduceat(positions, starts)
+
+    return np.where(firsts < n, np.append(codes, -1)[firsts], -1)
+
+def aggregate_groups(df_in, by, agg_dict, weights=None, weighted_columns=()):
+    """
+    Aggregate groups of rows, as DataFrame.groupby(by).agg(**agg_dict)
+    would, with vectorised versions of reducers that would otherwise
+    need a Python function to be called once per group.
+
+    Optionally, columns can first be weighted within each group, with
+    the group totals that the weights depend on found in the same pass
+    over the sorted groups, so no group-level table needs to be merged
+    back onto the rows.
+
+    Parameters
+    ----------
+    df_in : DataFrame
+        The data to be aggregated.
+    by : str or sequence of str
+        The columns to group by.
+    agg_dict : dict
+        A mapping from output column names to (column, reducer) pairs.
+        As well as any reducer accepted by GroupBy.agg, the reducer may
+        be one of:
+        "strict_sum"
+            The sum of the group, or NaN if any value in the group is
+            NaN. Identical to np.sum(x.values).
+        "mode"
+            The most common value in the group, counting missing values
+            as a value, with ties broken in favour of the value that
+            appears first in the group. Identical to the result of
+            scipy.stats.mode on non-numeric data.
+        "first" is also evaluated here for categorical columns, which
+        pandas would otherwise reduce with a Python loop over groups,
+        and "max" and "min" for numeric columns.
+    weights : str, default None
+        If provided, the name of a column (such as lagged net assets)
+        used to weight the rows within each group. Each row's weight is
+        its share of the strict sum of that column across its group,
+        or 1 if it is the only row in its group, and will be NaN if any
+        row in a larger group has a missing value.
+    weighted_columns : sequence of str, default ()
+        The columns to be multiplied by their row's weight before being
+        aggregated. Ignored if weights is None.
+
+    Returns
+    -------
+    df_return : DataFrame
+        The aggregated data, indexed by the sorted group keys.
+    """
+    # Sort rows into contiguous groups in order of the sorted group keys,
+    # keeping the row order within each group. Rows with a missing key
+    # are left out, as they would be by a groupby.
+    group_codes = encode_group_keys(df_in, by)
+    order = np.argsort(group_codes, kind="stable")
+    order = order[group_codes[order] >= 0]
+    starts, lengths = segment_bounds(group_codes[order])
+    del group_codes
+
+    # Index the output by the keys of the first row of each group.
+    first_rows = order[starts]
+    if isinstance(by, str):
+        group_index = pd.Index(df_in[by].iloc[first_rows], name=by)
+    else:
+        group_index = pd.MultiIndex.from_arrays(
+            [df_in[key].iloc[first_rows] for key in by], names=by
+        )
+
+    # Pass any reducers that pandas has native versions of straight
+    # through to pandas, unless they are evaluated here.
+    segment_dict = {
+        name: (col, reducer) for name, (col, reducer) in agg_dict.items()
+        if reducer in ["strict_sum", "mode"]
+        or (reducer == "first" and df_in[col].dtype == "category")
+        or (reducer in ["max", "min"]
+            and pd.api.types.is_numeric_dtype(df_in[col])
+            and not pd.api.types.is_extension_array_dtype(df_in[col]))
+    }
+    native_dict = {name: spec for name, spec in agg_dict.items()
+                   if name not in segment_dict}
+    if native_dict:
+        df_native = (
+            df_in.groupby(by, observed=True, sort=True).agg(**native_dict)
+                 .reindex(group_index)
+        )
+
+    # Weight columns within each group. The group totals and group sizes
+    # are found with segmented reductions over the sorted rows, then
+    # broadcast back to the rows of each group.
+    weighted_values = {}
+    if weights is not None and weighted_columns:
+        weight_base = df_in[weights].to_numpy(dtype=np.float64)[order]
+        group_totals = np.repeat(segment_sum(weight_base, starts, lengths),
+                                 lengths)
+        group_sizes = np.repeat(lengths, lengths)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            row_weights = np.where(group_sizes == 1, 1,
+                                   weight_base/group_totals)
+
+        for col in weighted_columns:
+            weighted_values[col] = (
+                df_in[col].to_numpy(dtype=np.float64)[order] * row_weights
+            )
+
+    df_return = pd.DataFrame(index=group_index)
+    for name, (col, reducer) in agg_dict.items():
+        if reducer == "strict_sum":
+            if col in weighted_values:
+                values = weighted_values[col]
+            else:
+                values = df_in[col].to_numpy(dtype=np.float64)[order]
+            df_return[name] = segment_sum(values, starts, lengths)
+        elif reducer == "mode":
+            if df_in[col].dtype == "category":
+                codes = df_in[col].cat.codes.to_numpy()[order]
+                df_return[name] = pd.Categorical.from_codes(
+                    segment_mode(codes, starts, lengths),
+                    dtype=df_in[col].dtype
+                )
+            else:
+                codes, uniques = pd.factorize(df_in[col],
+                                              use_na_sentinel=False)
+                df_return[name] = np.asarray(uniques, dtype=object)[
+                    segment_mode(codes[order], starts, lengths)
+                ]
+        elif reducer in ["max", "min"] and name in segment_dict:
+            # Missing values are skipped, as they are by pandas.
+            extreme = np.fmax if reducer == "max" else np.fmin
+            values = df_in[col].to_numpy()[order]
+            df_return[name] = (extreme.reduceat(values, starts)
+                               if len(starts) else values[:0])
+        elif name in segment_dict:
+            codes = df_in[col].cat.codes.to_numpy()[order]
+            df_return[name] = pd.Categorical.from_codes(
+                segment_first(codes, starts, lengths),
+                dtype=df_in[col].dtype
+            )
+        else:
+            df_return[name] = df_native[name]
+
+    return df_return
+
+@telemetry.timed
+def polate_assets(df_in, how="interpolate", keep=False, retain_testdata=False,
+                  engine="vectorised", inplace=False):
+    """
+    This function either interpolates, extrapolates or both interpolates
+    and extrapolates values of net assets within fund classes within a
+    given dataframe.
+    
+    Parameters
+    ----------
+    df_in : DataFrame
+        The data to be interpolated and/or extrapolated.
+    how : {"interpolate", "extrapolate", "both", False},
+        default "interpolate"
+        The method to be used to add additional observations
+    keep : bool, default False
+        If True, the returned dataframe will retain the original net
+        assets column
+    retain_testdata : bool, default False
+        If true, the returned dataframe will contain some additional
         columns useful for testing the accuracy of the algorithm
+    engine : {"vectorised", "groupby"}, default "vectorised"
+        If "vectorised", the data is sorted once and each step runs as
+        a single NumPy sweep over contiguous secid segments. If
+        "groupby", each step runs as a separate pandas groupby
+        operation. Both engines produce identical results. Input that
+        the vectorised engine cannot handle (missing secids or
+        repeated secid-date pairs) is passed to the groupby engine.
+    inplace : bool, default False
+        If True, net assets are filled (and any retained columns added)
+        in df_in itself, which is given a fresh RangeIndex and returned,
+        rather than in a copy.
         
     Returns
     -------
@@ -265,13 +1340,63 @@ def polate_assets(df_in, how="interpolate", keep=False, retain_testdata=False):
     # Validate retain_testdata
     if retain_testdata not in [True, False]:
         raise ValueError("retain_testdata must be True or False.")
+
+    # Validate engine
+    if engine not in ["vectorised", "groupby"]:
+        raise ValueError("engine must be 'vectorised' or 'groupby'.")
+    
+    # --- PROCESS DATA ---
+    # Calculate the recalculated net assets series (and the intermediate
+    # columns used to find it) for every row of the input.
+    df_main = None
+    if engine == "vectorised":
+        df_main = _polate_assets_vectorised(df_in, how, retain_testdata)
+    
+    if df_main is None:
+        df_main = _polate_assets_groupby(df_in, how)
+
+    # Ensure that the index of the inputted dataframe will align with
+    # the index of the recalculated asset values.
+    if inplace:
+        df_return = df_in
+        df_return.reset_index(drop=True, inplace=True)
+    else:
+        df_return = df_in.copy().reset_index(drop=True)
+
+    # Retain the original net assets if either of keep or
+    # retain_testdata is True.
+    if keep or retain_testdata:
+        df_return["net_assets_original"] = df_return.net_assets
+    
+    # If retain_testdata is True, also retain some of the intermediate
+    # columns. They are added one at a time, so that df_return is not
+    # copied.
+    if retain_testdata:
+        for col in ["multret_net", "cumret_net", "net_assets_recalculated",
+                    "net_assets_recalculated_exflows", "asset_discrepancy",
+                    "polation_id", "polation_duration", "polation_progress"]:
+            df_return[col] = df_main[col]
+            
+    # Fill null values of net_assets with the recalculated series.
+    df_return.net_assets.fillna(df_main.net_assets_recalculated, inplace=True)
     
+    return df_return
+
+def _polate_assets_groupby(df_in, how):
+    """
+    Calculate recalculated net assets for polate_assets through a
+    sequence of pandas groupby operations.
+
+    Returns a DataFrame aligned to the rows of df_in (with a fresh
+    RangeIndex) that holds the recalculated series and every
+    intermediate column.
+    """
     # --- PREPARE DATA ---
-    # Copy the input DataFrame, and drop all missing values of net
-    # assets, ensuring that all observations are ordered by secid and
-    # date. 
+    # Drop all missing values of net assets from a sorted copy of the
+    # input DataFrame, ensuring that all observations are ordered by
+    # secid and date.
     df_assetobs = (
-        df_in.copy().sort_values(by=["fundid", "secid", "date"])
+        df_in.sort_values(by=["fundid", "secid", "date"])
                     .dropna(subset=["net_assets"])
                     .loc[:, ["secid", "date"]]
     )
@@ -279,7 +1404,7 @@ def polate_assets(df_in, how="interpolate", keep=False, retain_testdata=False):
     # --- PROCESS DATA ---
 
     # Assign a cumulative count column grouped by secid.
-    df_assetobs["polation_id"] = df_assetobs.groupby("secid").cumcount()
+    df_assetobs["polation_id"] = df_assetobs.groupby("secid", observed=True).cumcount()
     
     # Left merge the cumulative count column back into the original
     # DataFrame by secid and date, providing a unique ID to each
@@ -289,7 +1414,7 @@ def polate_assets(df_in, how="interpolate", keep=False, retain_testdata=False):
     # Back fill the polation ID within each secid. The purpose of this
     # backfilling is so to group together consecutive missing
     # observations with the next available nonmissing observation.
-    df_main["polation_id"] = df_main.groupby("secid").polation_id.bfill()
+    df_main["polation_id"] = df_main.groupby("secid", observed=True).polation_id.bfill()
     
     # All nan values of polation_id now occur either after the last
     # non-missing observation for a given fund class or where a fund
@@ -316,10 +1441,10 @@ def polate_assets(df_in, how="interpolate", keep=False, retain_testdata=False):
     # polation group can see the most recent nonmissing value of net
     # assets.
     df_main["polation_group_asset_base"] = (
-        df_main.groupby("secid").net_assets.ffill()
+        df_main.groupby("secid", observed=True).net_assets.ffill()
     )
     df_main["polation_group_asset_base"] = (
-        df_main.groupby("secid").polation_group_asset_base.shift(1)
+        df_main.groupby("secid", observed=True).polation_group_asset_base.shift(1)
     )
 
     # For polation groups labelled 0, the asset target should be the net
@@ -327,7 +1452,7 @@ def polate_assets(df_in, how="interpolate", keep=False, retain_testdata=False):
     # are now the only ones with a nan value for
     # polation_group_asset_base, so we achieve this by filling nan
     # values with a backfilled series of net assets within each secid.
-    df_main.polation_group_asset_base.fillna(df_main.groupby("secid")
+    df_main.polation_group_asset_base.fillna(df_main.groupby("secid", observed=True)
                                                     .net_assets
                                                     .bfill(), inplace=True)
     
@@ -351,7 +1476,7 @@ def polate_assets(df_in, how="interpolate", keep=False, retain_testdata=False):
     # for use in predicting net assets within that group absent the
     # impact of fund inflows and outflows.
     df_main["cumret_net"] = (
-        df_main.groupby(["secid", "polation_id"]).multret_net.cumprod()
+        df_main.groupby(["secid", "polation_id"], observed=True).multret_net.cumprod()
     )
 
     # Cumulative return can be multiplied by the asset base to arrive at
@@ -380,7 +1505,9 @@ def polate_assets(df_in, how="interpolate", keep=False, retain_testdata=False):
     # can be backfilled, then backfill the new column within each secid.
     df_main["cumret_divisor"] = np.where(df_main.net_assets.isnull(),
                                         np.nan, df_main.cumret_net)
-    df_main["cumret_divisor"] = df_main.groupby(["secid"]).cumret_divisor.bfill()
+    df_main["cumret_divisor"] = (
+        df_main.groupby(["secid"], observed=True).cumret_divisor.bfill()
+    )
     
     # Divide the cumulative return by the divisor value for that
     # observation only if the polation group id is 0.
@@ -404,7 +1531,7 @@ def polate_assets(df_in, how="interpolate", keep=False, retain_testdata=False):
                 1, np.nan)
     )
     df_main["stop_backextrapolation_flag"] = (
-        df_main.groupby("secid").stop_backextrapolation_flag.bfill()
+        df_main.groupby("secid", observed=True).stop_backextrapolation_flag.bfill()
     )
     
     df_main["stop_forwardextrapolation_flag"] = (
@@ -412,7 +1539,7 @@ def polate_assets(df_in, how="interpolate", keep=False, retain_testdata=False):
                 1, np.nan)
     )
     df_main["stop_forwardextrapolation_flag"] = (
-        df_main.groupby("secid").stop_forwardextrapolation_flag.ffill()
+        df_main.groupby("secid", observed=True).stop_forwardextrapolation_flag.ffill()
     )
     
     # Now nullify flagged values of cumulative return
@@ -445,7 +1572,7 @@ def polate_assets(df_in, how="interpolate", keep=False, retain_testdata=False):
                 1, df_main.net_assets/df_main.net_assets_recalculated_exflows)
     )
     df_main["asset_discrepancy"] = (
-        df_main.groupby("secid").asset_discrepancy.bfill()
+        df_main.groupby("secid", observed=True).asset_discrepancy.bfill()
     )
 
     # Although the total discrepancy is known to each observation within
@@ -461,7 +1588,7 @@ def polate_assets(df_in, how="interpolate", keep=False, retain_testdata=False):
     # the original dataframe so that each observation within the group
     # can see that total.
     df_polationduration = (
-        df_main.groupby(["secid", "polation_id"]).polation_id.count()
+        df_main.groupby(["secid", "polation_id"], observed=True).polation_id.count()
             .to_frame().rename(columns={"polation_id": "polation_duration"})
             .reset_index()
     )
@@ -473,7 +1600,7 @@ def polate_assets(df_in, how="interpolate", keep=False, retain_testdata=False):
     # Second, assign a cumulative count column within each polation
     # group.
     df_main["polation_progress"] = (
-        df_main.groupby(["secid", "polation_id"]).cumcount() + 1
+        df_main.groupby(["secid", "polation_id"], observed=True).cumcount() + 1
     )
     
     # Update recaluculated net assets by taking into acccount asset
@@ -495,154 +1622,689 @@ def polate_assets(df_in, how="interpolate", keep=False, retain_testdata=False):
         df_main.loc[~df_main.polation_id.isin([0,"00"]),
                     "net_assets_recalculated"] = np.nan
     
-    # Ensure that the index of the inputted dataframe will align with
-    # the index of the recalculated asset values.
-    df_return = df_in.copy().reset_index(drop=True)
+    return df_main
 
-    # Retain the original net assets if either of keep or
-    # retain_testdata is True.
-    if keep or retain_testdata:
-        df_return["net_assets_original"] = df_return.net_assets
-    
-    # If retain_testdata is True, also retain some of the intermediate
-    # columns.
-    if retain_testdata:
-        df_return = (
-            pd.concat([df_return, df_main.loc[:, ["multret_net",
-                                                "cumret_net",
-                                                "net_assets_recalculated",
-                                                "net_assets_recalculated_exflows",
-                                                "asset_discrepancy",
-                                                "polation_id",
-                                                "polation_duration",
-                                                "polation_progress"]]],
-                    axis=1)
+def _polate_assets_vectorised(df_in, how, retain_testdata):
+    """
+    Calculate recalculated net assets for polate_assets with NumPy
+    sweeps over contiguous secid segments.
+
+    This follows the same steps as _polate_assets_groupby, and produces
+    identical values, but sorts the data once and replaces each groupby
+    and merge with a segmented array operation. Within each secid,
+    rows are processed in their input order, as groupby does. Polation
+    IDs are held as integers, with -1 standing in for the "00"
+    extrapolation group.
+
+    Returns None if the input is empty or contains missing secids or
+    repeated secid-date pairs, which the groupby engine handles
+    differently. Unless retain_testdata is True, only the recalculated
+    series is returned.
+    """
+    n = len(df_in)
+    if n == 0 or df_in.secid.isna().any():
+        return None
+
+    secid_codes = pd.factorize(df_in.secid)[0]
+    dates = df_in.date.to_numpy()
+    if pd.MultiIndex.from_arrays([secid_codes, dates]).has_duplicates:
+        return None
+
+    net_assets = df_in.net_assets.to_numpy(dtype=np.float64)
+    ret_net_m = df_in.ret_net_m.to_numpy(dtype=np.float64)
+
+    # --- ASSIGN POLATION IDS ---
+    # Number the nonmissing observations of net assets within each
+    # secid, in order of fundid and date. Codes from a sorted
+    # factorisation order the same way as the values themselves, with
+    # missing fundids placed last.
+    fundid_codes = pd.factorize(df_in.fundid, sort=True)[0]
+    fundid_codes[fundid_codes < 0] = fundid_codes.max() + 1
+    secid_sorted_codes = pd.factorize(df_in.secid, sort=True)[0]
+
+    obs = np.flatnonzero(~np.isnan(net_assets))
+    obs = obs[np.lexsort((dates[obs], secid_sorted_codes[obs],
+                          fundid_codes[obs]))]
+    obs = obs[np.argsort(secid_codes[obs], kind="stable")]
+    obs_starts, obs_lengths = segment_bounds(secid_codes[obs])
+
+    polation_id = np.full(n, np.nan)
+    polation_id[obs] = (np.arange(len(obs))
+                        - np.repeat(obs_starts, obs_lengths))
+    del fundid_codes, secid_sorted_codes, obs, obs_starts, obs_lengths
+
+    # --- SORT INTO SECID SEGMENTS ---
+    # A stable sort keeps the input order of rows within each secid.
+    order = np.argsort(secid_codes, kind="stable")
+    starts, lengths = segment_bounds(secid_codes[order])
+    first = np.repeat(starts, lengths)
+    last = np.repeat(starts + lengths - 1, lengths)
+
+    net_assets = net_assets[order]
+    ret_net_m = ret_net_m[order]
+
+    # Back fill polation IDs within each secid, and place everything
+    # after the last observation into the extrapolation group (-1).
+    polation_id = segment_bfill(polation_id[order], last)
+    polation_id = np.where(np.isnan(polation_id), -1,
+                           polation_id).astype(np.int64)
+    is_first_group = polation_id == 0
+    is_last_group = polation_id == -1
+
+    # --- GROUP POLATION SEGMENTS ---
+    # Polation groups are contiguous within a secid whenever rows are
+    # date ordered. If they are not, sort once more into polation
+    # segments, again keeping the input order within each group.
+    segment_ids = np.repeat(np.arange(len(starts)), lengths)
+    group_key = (segment_ids * (polation_id.max(initial=0) + 2)
+                 + np.where(is_last_group, polation_id.max(initial=0) + 1,
+                            polation_id))
+    if np.all(group_key[1:] >= group_key[:-1]):
+        group_order = None
+        group_starts, group_lengths = segment_bounds(group_key)
+    else:
+        group_order = np.argsort(group_key, kind="stable")
+        group_starts, group_lengths = segment_bounds(group_key[group_order])
+    del segment_ids, group_key
+
+    def to_groups(values):
+        return values if group_order is None else values[group_order]
+
+    def from_groups(values):
+        if group_order is None:
+            return values
+        out = np.empty_like(values)
+        out[group_order] = values
+        return out
+
+    # --- CALCULATE RECALCULATED NET ASSETS ---
+    # Each step mirrors the corresponding step of the groupby engine.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # The asset base of each polation group is the last nonmissing
+        # observation before it, or the first observation for group 0.
+        asset_base = segment_ffill(net_assets, first)
+        asset_base = np.concatenate([[np.nan], asset_base[:-1]])
+        asset_base[starts] = np.nan
+        asset_base = np.where(np.isnan(asset_base),
+                              segment_bfill(net_assets, last), asset_base)
+
+        multret_net = ret_net_m/100 + 1
+        multret_filled = np.where(np.isnan(multret_net), 1, multret_net)
+        del multret_net
+
+        cumret_net = from_groups(segment_cumprod(to_groups(multret_filled),
+                                                 group_starts, group_lengths))
+
+        cumret_divisor = segment_bfill(
+            np.where(np.isnan(net_assets), np.nan, cumret_net), last
         )
-            
-    # Fill null values of net_assets with the recalculated series.
-    df_return.net_assets.fillna(df_main.net_assets_recalculated, inplace=True)
-    
+        cumret_net = np.where(is_first_group, cumret_net/cumret_divisor,
+                              cumret_net)
+        del cumret_divisor
+
+        # Stop extrapolation across missing returns.
+        stop_back = segment_bfill(
+            np.where(is_first_group & np.isnan(ret_net_m), 1.0, np.nan), last
+        )
+        stop_forward = segment_ffill(
+            np.where(is_last_group & np.isnan(ret_net_m), 1.0, np.nan), first
+        )
+        cumret_net = np.where((stop_back == 1) | (stop_forward == 1),
+                              np.nan, cumret_net)
+        del stop_back, stop_forward
+
+        recalculated_exflows = cumret_net * asset_base
+
+        asset_discrepancy = segment_bfill(
+            np.where(is_first_group | is_last_group, 1,
+                     net_assets/recalculated_exflows), last
+        )
+
+        polation_duration = from_groups(np.repeat(group_lengths,
+                                                  group_lengths))
+        polation_progress = from_groups(
+            np.arange(n) - np.repeat(group_starts, group_lengths) + 1
+        )
+
+        recalculated = (
+            recalculated_exflows
+            * asset_discrepancy**(polation_progress / polation_duration)
+        )
+
+    if how == "interpolate":
+        recalculated[is_first_group | is_last_group] = np.nan
+    elif how == "extrapolate":
+        recalculated[~(is_first_group | is_last_group)] = np.nan
+
+    # --- RETURN TO INPUT ORDER ---
+    def unsort(values):
+        out = np.empty_like(values)
+        out[order] = values
+        return out
+
+    # Only the recalculated series is used unless the intermediate
+    # columns are retained, so the rest are only returned to input order
+    # when they are.
+    if not retain_testdata:
+        return pd.DataFrame({"net_assets_recalculated": unsort(recalculated)})
+
+    df_main = pd.DataFrame({
+        "multret_net": unsort(multret_filled),
+        "cumret_net": unsort(cumret_net),
+        "net_assets_recalculated": unsort(recalculated),
+        "net_assets_recalculated_exflows": unsort(recalculated_exflows),
+        "asset_discrepancy": unsort(asset_discrepancy),
+        "polation_duration": unsort(polation_duration),
+        "polation_progress": unsort(polation_progress)
+    })
+
+    # Rebuild the mixed-type polation ID column of the groupby engine.
+    polation_id = unsort(polation_id)
+    df_main["polation_id"] = np.where(polation_id == -1, "00",
+                                      polation_id.astype(np.float64)
+                                                 .astype(object))
+
+    return df_main
+
+def fund_shards(fundids, num_shards):
+    """
+    Assign each row to one of num_shards shards by a stable hash of its
+    fundid, so that every row of a fund is placed in the same shard in
+    every table and in every process. Rows with a missing fundid are
+    placed in the first shard.
+
+    Parameters
+    ----------
+    fundids : Series
+        The fundid column. Categorical columns are hashed once per
+        category rather than once per row.
+    num_shards : int
+        The number of shards.
+
+    Returns
+    -------
+    shards : ndarray of int
+        The shard of each row.
+    """
+    fundids = fundids.astype("category")
+    category_shards = np.array(
+        [zlib.crc32(str(fundid).encode("utf-8")) % num_shards
+         for fundid in fundids.cat.categories],
+        dtype=np.int64
+    )
+
+    # Missing fundids have a code of -1, which selects the appended 0.
+    return np.append(category_shards, 0)[fundids.cat.codes.to_numpy()]
+
+def load_fund_panel(filename_base, country_group_code, value_name, exp_dtype,
+                    sparse=False, spill=None, shard=None):
+    """
+    Load one panel of fund data with categorical identifiers, either from
+    its source file with load_data or, if spill is given, from one of
+    the partitions that an out-of-core run spilled it into (see
+    shared/partition_spill.py).
+
+    spill is a (spill_dir, partition) pair. shard is a (shard_index,
+    num_shards) pair, as in load_fund_panels. If shard is given, only
+    the funds in the shard are loaded, and the rows of other funds are
+    dropped as the source file is read, so that the whole group is never
+    held in memory. This needs pyarrow, without which the whole panel is
+    loaded. Other parameters are as in load_data.
+    """
+    if spill is not None:
+        spill_dir, partition = spill
+        df_return = partition_spill.read_panel(spill_dir, filename_base,
+                                               partition, value_name, exp_dtype,
+                                               sparse)
+    elif shard is not None and panel_reader.reader_available():
+        shard_index, num_shards = shard
+
+        def select_rows(fundids):
+            return fund_shards(pd.Series(fundids), num_shards) == shard_index
+
+        df_return = panel_reader.read_panel_rows(
+            data_filename(filename_base, country_group_code), value_name,
+            exp_dtype, select_rows, sparse
+        )
+    else:
+        return load_data(filename_base, country_group_code, series_type="panel",
+                         value_name=value_name, exp_dtype=exp_dtype,
+                         sparse=sparse, categorical=True)
+
+    if exp_dtype is object:
+        df_return[value_name] = df_return[value_name].astype("category")
+
     return df_return
 
-def process_fund_data(country_group_code, currency_type, raw_ret_only, polation_method,
-                      strict_eq, exc_finre, inv_targets, inc_agefilter):
+def load_fund_panels(country_group_code, currency_type, shard=None,
+                     spill_dir=None):
     """
+    Load the fund information and panel data for one country group and
+    currency, and merge together the returns data.
+
     Parameters
     ----------
     country_group_code : str
         The country group code to load data for.
     currency_type : ["local", "usd"]
         The currency group that returns are denominated in.
-    raw_ret_only : bool
-        If True, raw gross returns only will be used in the final dataset. If False,
-        missing values of gross returns will be calculated using net returns and
-        representative costs where available.
-    polation_method : [False, "interpolate", "extrapolate", "both"]
-        If "interpolate", net asset values will be interpolated. If "extrapolate", net
-        assets values will be extrapolated. If "both", net asset values will be both
-        extrapolated and interpolated. If False, neither extrapolation or interpolation
-        will occur.
-    strict_eq : bool
-        If True, only Morningstar categories classified as being "strict" equity categories
-        will be included in the final dataset.
-    exc_finre : bool
-        If True, funds classified as investing primarily in financial, infrastructure and
-        real estate securities will be excluded.
-    inv_targets : bool
-        If True, the resultant DataFrame will include information about the investment
-        target of each fund, at levels of MSCI class, region, group and country.
-    inc_agefilter : bool
-        If True, additional DataFrames will be saved that include only age-filtered mutual
-        fund data, as well as the non-filtered DataFrames.
-    """    
-    # Grab the process ID and start time
-    process_id = os.getpid()
-    start_time = datetime.now()
+    shard : (int, int), default None
+        If provided, a (shard_index, num_shards) pair. Only the funds
+        that fund_shards assigns to shard_index will be kept, and only
+        their rows of each panel are loaded (see load_fund_panel).
+    spill_dir : str, default None
+        If provided, the panels are read from the partitions spilled into
+        this directory by process_fund_data_out_of_core, with each shard
+        being one partition, rather than from the source files. The fund
+        information, which has one row per secid, is still read from its
+        source file.
+
+    Returns
+    -------
+    panels : dict of DataFrame
+        The fund information ("info"), the date sorted returns and
+        costs ("rets"), the monthly net assets ("na") and the monthly
+        Morningstar categories ("cat"). None of these are modified by
+        the later stages, so they can be shared between runs.
+    """
+    # Identifiers and labels are loaded as categoricals, and are kept
+    # that way until the output is written.
 
     # Fund information
     df_mfinfo = load_data("info", country_group_code, series_type="cross",
-                            cs_dates = ["inception-date"])
+                            cs_dates = ["inception-date"],
+                            categorical=["fundid", "secid", "domicile"])
+
+    spill = None if spill_dir is None else (spill_dir, shard[0])
+    panel_options = {"spill": spill, "shard": shard}
 
     # Gross monthly returns
-    df_mfret_g = load_data(f"{currency_type}-monthly-gross-returns", country_group_code,
-                            series_type="panel", value_name="ret_gross_m",
-                            exp_dtype=np.float64)
+    df_mfret_g = load_fund_panel(f"{currency_type}-monthly-gross-returns",
+                                 country_group_code, "ret_gross_m", np.float64,
+                                 **panel_options)
 
     # Net monthly returns
-    df_mfret_n = load_data(f"{currency_type}-monthly-net-returns", country_group_code,
-                            series_type="panel", value_name="ret_net_m",
-                            exp_dtype=np.float64)
+    df_mfret_n = load_fund_panel(f"{currency_type}-monthly-net-returns",
+                                 country_group_code, "ret_net_m", np.float64,
+                                 **panel_options)
 
-    # Monthly net assets
-    df_mfna = load_data("monthly-net-assets", country_group_code,
-                        series_type="panel", value_name="net_assets",
-                        exp_dtype=np.float64)
+    # Monthly net assets. This table and the category table below are
+    # only ever left merged onto the returns data, so only their
+    # observed cells need to be loaded.
+    df_mfna = load_fund_panel("monthly-net-assets", country_group_code,
+                              "net_assets", np.float64, sparse=True,
+                              **panel_options)
 
     # Monthly representative costs
-    df_mfcosts = load_data("monthly-costs", country_group_code,
-                        series_type="panel", value_name="rep_costs",
-                        exp_dtype=np.float64)
+    df_mfcosts = load_fund_panel("monthly-costs", country_group_code,
+                                 "rep_costs", np.float64, **panel_options)
 
     # Monthly Morningstar category
-    df_mfcat = load_data("monthly-morningstar-category", country_group_code,
-                        series_type="panel", value_name="morningstar_category",
-                        exp_dtype=object)
-    
-    elapsed_time = datetime.now() - start_time
-    print(f"Process {process_id} ({country_group_code}): Finished loading data ({elapsed_time} passed since process start)")
-    
+    df_mfcat = load_fund_panel("monthly-morningstar-category", country_group_code,
+                               "morningstar_category", object, sparse=True,
+                               **panel_options)
+
+    # In sharded mode, keep only the funds in this shard. Every later
+    # stage works within funds, apart from the winsorisation of fund
+    # flows, which is finished across every shard by finish_fund_data.
+    # Spilled panels, and panels read with the panel reader, hold only
+    # the funds of the shard already.
+    if shard is not None:
+        shard_index, num_shards = shard
+
+        def in_shard(df):
+            return (df.loc[fund_shards(df.fundid, num_shards) == shard_index]
+                      .reset_index(drop=True))
+
+        df_mfinfo = in_shard(df_mfinfo)
+        if spill is None and not panel_reader.reader_available():
+            df_mfret_g, df_mfret_n, df_mfna, df_mfcosts, df_mfcat = [
+                in_shard(df)
+                for df in [df_mfret_g, df_mfret_n, df_mfna, df_mfcosts, df_mfcat]
+            ]
+
+    # Share identifier categories across every table so that they can be
+    # joined on their integer codes.
+    unify_categories([df_mfinfo, df_mfret_g, df_mfret_n, df_mfna, df_mfcosts,
+                      df_mfcat], ["fundid", "secid"])
+
     # Combine panel data
     # Combine only the data that is required to remove unneccessary return rows, that being
     # "gross returns", "net returns" and "representative costs". Other data can be combined
     # later after unneccessary rows have been removed to save time in the merge.
 
     # Merge all returns data together. The resultant dataframe needs to be
-    # sorted by date to enable removal of unnecessary rows.
-    df_mfrets = (
-        panelmerge([df_mfret_g, df_mfret_n, df_mfcosts]).sort_values(by="date")
-    )
-
-    # Clear unused memory
+    # sorted by date to enable removal of unnecessary rows. Panels are read
+    # in date order, in which case the merged data is already sorted and is
+    # not copied again.
+    #
+    # The sort is stable, so the secids of a fund keep the order they were
+    # read in within each date. That order breaks ties when secids are
+    # aggregated into funds: the "first" fields (domicile and the
+    # investment targets), the modal approx_morningstar_category and the
+    # order that weighted sums are added in. With the default quicksort,
+    # ties were broken by an order that depended on every other row in
+    # the table, so sharded, out-of-core and incremental runs could not
+    # reproduce them. Output written before the sort was made stable can
+    # differ in those fields, and in the last bits of the weighted values.
+    df_mfrets = panelmerge([df_mfret_g, df_mfret_n, df_mfcosts])
     del df_mfret_g, df_mfret_n, df_mfcosts
+    if not df_mfrets.date.is_monotonic_increasing:
+        df_mfrets = df_mfrets.sort_values(by="date", kind="stable")
 
-    # Recalculate monthly gross returns and correct for zero net return observations
-    # (if raw_ret_only equals False).
+    return {"info": df_mfinfo, "rets": df_mfrets, "na": df_mfna, "cat": df_mfcat}
 
-    if not raw_ret_only:
-        # Recalculate monthly gross returns using representative costs and
-        # the monthly net return.
-        df_mfrets["ret_gross_m_recalculated"] = (
-            ((df_mfrets.ret_net_m/100 + 1)/(1-df_mfrets.rep_costs/100) - 1) * 100
-        )
+def effective_equity_flag(df_in, strict_eq, exc_finre):
+    """
+    Return a single effective equity classification for each row of a
+    DataFrame holding the equity definition fields of
+    morningstar_categories.csv, based on the values of strict_eq and
+    exc_finre (see filter_equity_funds). The classification is 1 for
+    equity, 0 for non-equity and nan where it is ambiguous.
+    """
+    if strict_eq:
+        flag = df_in.strict_equity
+    else:
+        flag = df_in.equity
 
-        # Fill missing values of monthly return with the recalculated
-        # values.
-        df_mfrets.ret_gross_m.fillna(df_mfrets.ret_gross_m_recalculated,
-                                    inplace=True)
-        
-        # There are an inordinate number of ret_net_m observations equal to
-        # exactly zero (125x more frequently occuring than the next most
-        # common return value to 5 decimal places). Clearly, gross returns
-        # in these cases should not be expected to have exactly offset
+    if exc_finre:
+        flag = flag * (1-df_in.fin_or_re)
+
+    return flag
+
+def nonequity_fund_rows(df_mfrets, df_mfcat, df_mfinfo, equity_filters, rows=None):
+    """
+    Find the rows of the returns data that belong to funds that the
+    equity filter would remove entirely.
+
+    filter_equity_funds removes every return of a fund in a month if
+    any secid of the fund is classified as non-equity in that month,
+    and keeps them if no secid has a classification. A fund therefore
+    loses all of its returns, and is dropped whole by trim_nans, exactly
+    when each of its fundid-date pairs holds a secid whose monthly
+    category is classified as non-equity. No stage before the filter
+    works across funds, so the rows of those funds can be dropped before
+    the remaining panels are merged and net assets are interpolated
+    without changing the output.
+
+    Parameters
+    ----------
+    df_mfrets : DataFrame
+        The returns data, as merged by load_fund_panels.
+    df_mfcat : DataFrame
+        The monthly Morningstar categories.
+    df_mfinfo : DataFrame
+        The fund information. Secids without fund information are
+        dropped by combine_fund_panels, so they do not count towards
+        any fundid-date pair.
+    equity_filters : sequence of (bool, bool)
+        The (strict_eq, exc_finre) options of every equity filter that
+        the data will be passed to. A fund is only flagged if every one
+        of these filters would remove it.
+    rows : array of bool, default None
+        If provided, only the rows of df_mfrets flagged here, such as
+        the rows that trim_nans keeps, are taken to reach the filter.
+
+    Returns
+    -------
+    is_nonequity : ndarray
+        A boolean array, True for each row of df_mfrets that belongs to
+        a flagged fund.
+    """
+    is_nonequity = np.zeros(len(df_mfrets), dtype=bool)
+
+    df_equity_categories = (
+        pd.read_csv("./data/mappings/morningstar_categories.csv")
+    )
+
+    # Categories are merged onto the data by value, so a repeated or
+    # missing category in the mappings would duplicate rows or classify
+    # rows with no category. Flag nothing in either case.
+    mapped_categories = df_equity_categories.morningstar_category
+    if (len(equity_filters) == 0 or len(df_mfrets) == 0
+            or not mapped_categories.is_unique or mapped_categories.isna().any()):
+        return is_nonequity
+
+    # Rows are matched to categories on grids of secid and date codes,
+    # which needs the identifiers of both tables to share their
+    # categories, as load_fund_panels leaves them. Flag nothing otherwise.
+    for key in ["fundid", "secid"]:
+        if not (df_mfrets[key].dtype == "category"
+                and df_mfcat[key].dtype == "category"
+                and df_mfrets[key].cat.categories.equals(
+                    df_mfcat[key].cat.categories)):
+            return is_nonequity
+
+    row_funds = df_mfrets.fundid.cat.codes.to_numpy().astype(np.int64)
+    row_secids = df_mfrets.secid.cat.codes.to_numpy().astype(np.int64)
+    row_dates, dates = pd.factorize(df_mfrets.date)
+    cell_funds = df_mfcat.fundid.cat.codes.to_numpy().astype(np.int64)
+    cell_secids = df_mfcat.secid.cat.codes.to_numpy().astype(np.int64)
+    cell_dates = pd.Index(dates).get_indexer(df_mfcat.date)
+    num_funds = len(df_mfrets.fundid.cat.categories)
+    num_secids = len(df_mfrets.secid.cat.categories)
+    num_dates = len(dates)
+
+    # Rows missing a key are never grouped by the filter, so they keep
+    # their returns and their fund.
+    if rows is None:
+        rows = np.ones(len(df_mfrets), dtype=bool)
+    else:
+        rows = np.asarray(rows, dtype=bool)
+    has_keys = rows & (row_funds >= 0) & (row_secids >= 0) & (row_dates >= 0)
+
+    # A category matches a row if it shares its secid, date and fundid,
+    # as in a left merge. If every secid belongs to one fund in the
+    # returns data, the fundid of a row follows from its secid, so a
+    # category only needs its fundid checked against that of its secid.
+    fund_of_secid = np.full(num_secids, -1, dtype=np.int64)
+    fund_of_secid[row_secids[has_keys]] = row_funds[has_keys]
+    if (fund_of_secid[row_secids[has_keys]] != row_funds[has_keys]).any():
+        return is_nonequity
+
+    cell_matched = (cell_funds >= 0) & (cell_secids >= 0) & (cell_dates >= 0)
+    cell_matched[cell_matched] = (
+        fund_of_secid[cell_secids[cell_matched]] == cell_funds[cell_matched]
+    )
+    cell_cells = cell_secids[cell_matched]*num_dates + cell_dates[cell_matched]
+    row_cells = np.where(has_keys, row_secids*num_dates + row_dates, 0)
+    row_pairs = np.where(has_keys, row_funds*num_dates + row_dates, 0)
+
+    # Position of each monthly category in the mappings, or -1 for
+    # categories without a mapping. Category panels are loaded as
+    # categoricals, so only their categories need to be looked up.
+    if df_mfcat.morningstar_category.dtype == "category":
+        category_codes = df_mfcat.morningstar_category.cat.codes.to_numpy()
+        category_values = df_mfcat.morningstar_category.cat.categories
+    else:
+        category_codes, category_values = pd.factorize(
+            df_mfcat.morningstar_category
+        )
+    category_positions = pd.Index(mapped_categories.astype(object)).get_indexer(
+        pd.Index(category_values).astype(object)
+    )
+    cell_positions = np.where(category_codes >= 0,
+                              category_positions[category_codes], -1)[cell_matched]
+
+    # Secids without fund information are dropped by combine_fund_panels.
+    in_pair = has_keys & df_mfrets.secid.isin(df_mfinfo.secid).to_numpy()
+
+    is_nonequity[:] = True
+    for strict_eq, exc_finre in equity_filters:
+        category_flag = np.append(
+            effective_equity_flag(df_equity_categories, strict_eq, exc_finre)
+                .to_numpy(dtype=np.float64),
+            np.nan
+        )
+        cell_flag = category_flag[cell_positions]
+
+        # The filter takes the minimum classification of each pair and
+        # removes its returns if that minimum is 0. Find each pair with
+        # a secid classified as 0 and none classified below 0.
+        pair_zero = np.zeros(num_funds*num_dates, dtype=bool)
+        pair_negative = np.zeros(num_funds*num_dates, dtype=bool)
+        for flagged, pair_flag in [(cell_flag == 0, pair_zero),
+                                   (cell_flag < 0, pair_negative)]:
+            cell_flagged = np.zeros(num_secids*num_dates, dtype=bool)
+            cell_flagged[cell_cells[flagged]] = True
+            row_flagged = in_pair & cell_flagged[row_cells]
+            pair_flag[row_pairs[row_flagged]] = True
+            del cell_flagged, row_flagged
+        pair_removed = pair_zero & ~pair_negative
+        del pair_zero, pair_negative
+
+        # A fund is flagged if none of its rows keeps its returns. Rows
+        # without fund information are dropped regardless, so they do
+        # not keep their fund.
+        row_kept = rows & (~has_keys | (in_pair & ~pair_removed[row_pairs]))
+        fund_kept = np.zeros(num_funds + 1, dtype=bool)
+        fund_kept[row_funds[row_kept]] = True
+        fund_kept[-1] = True
+
+        # Only flag funds that every filter removes. Rows missing a
+        # fundid are never flagged.
+        is_nonequity &= ~fund_kept[row_funds]
+        del cell_flag, pair_removed, row_kept, fund_kept
+
+    return is_nonequity
+
+# The ISO code of each country of domicile.
+ISO_CODES = {
+    "Andorra": "AND", "Australia": "AUS", "Austria": "AUT", "Argentina": "ARG",
+    "Bahamas": "BHS", "Bahrain": "BHR", "Belgium": "BEL", "Bermuda": "BMU",
+    "Botswana": "BWA", "Brazil": "BRA", "British Virgin Islands": "VGB",
+    "Canada": "CAN", "Cayman Islands": "CYM", "Chile": "CHL", "China": "CHN",
+    "Colombia": "COL", "Curaçao": "CUW", "Czech Republic": "CZE",
+    "Denmark": "DNK", "Estonia": "EST", "Finland": "FIN", "France": "FRA",
+    "Germany": "DEU", "Gibraltar": "GIB", "Greece": "GRC", "Guernsey": "GGY",
+    "Hong Kong": "HKG", "Iceland": "ISL", "India": "IND", "Indonesia": "IDN",
+    "Ireland": "IRL", "Isle of Man": "IMN", "Israel": "ISR", "Italy": "ITA",
+    "Japan": "JPN", "Jersey": "JEY", "Kuwait": "KWT", "Latvia": "LVA",
+    "Lesotho": "LSO", "Liechtenstein": "LIE", "Lithuania": "LTU",
+    "Luxembourg": "LUX", "Malaysia": "MYS", "Malta": "MLT",
+    "Marshall Islands": "MHL", "Mauritius": "MUS", "Mexico": "MEX",
+    "Namibia": "NAM", "Netherlands": "NLD", "New Zealand": "NZL",
+    "Norway": "NOR", "Oman": "OMN", "Pakistan": "PAK", "Panama": "PAN",
+    "Philippines": "PHL", "Poland": "POL", "Portugal": "PRT",
+    "Puerto Rico": "PRI", "Qatar": "QAT", "Russian Federation": "RUS",
+    "Samoa": "WSM", "San Marino": "SMR", "Saudi Arabia": "SAU",
+    "Singapore": "SGP", "Slovenia": "SVN", "South Africa": "ZAF",
+    "South Korea": "KOR", "Spain": "ESP", "St Vincent-Grenadines": "VCT",
+    "Swaziland": "SWZ", "Sweden": "SWE", "Switzerland": "CHE", "Taiwan": "TWN",
+    "Thailand": "THA", "Turkey": "TUR", "Ukraine": "UKR",
+    "United Arab Emirates": "ARE", "United Kingdom": "GBR",
+    "United States": "USA"
+}
+
+def combine_fund_panels(panels, raw_ret_only, inc_agefilter, equity_filters=None,
+                        inplace=False):
+    """
+    Fill gross returns, remove unnecessary rows and merge the remaining
+    panel data onto the returns data.
+
+    Parameters
+    ----------
+    panels : dict of DataFrame
+        The output of load_fund_panels. It is not modified, unless
+        inplace is True.
+    raw_ret_only : bool
+        If True, raw gross returns only will be used in the final dataset. If False,
+        missing values of gross returns will be calculated using net returns and
+        representative costs where available.
+    inc_agefilter : bool
+        If True, an age column will be added for use by the age filter.
+    equity_filters : sequence of (bool, bool), default None
+        The (strict_eq, exc_finre) options of every equity filter that
+        the output will be passed to. If provided, the funds that every
+        one of these filters would remove entirely are dropped before
+        the remaining panels are merged (see nonequity_fund_rows), which
+        leaves the output of those filters unchanged.
+    inplace : bool, default False
+        If True, the panels are consumed. Each is removed from panels
+        as it is used, and the returns data is filled and trimmed in
+        place, so that no panel outlives the step that needs it.
+
+    Returns
+    -------
+    df_mf : DataFrame
+    """
+    if inplace:
+        df_mfrets = panels.pop("rets")
+    else:
+        df_mfrets = panels["rets"]
+
+    # Recalculate monthly gross returns and correct for zero net return observations
+    # (if raw_ret_only equals False).
+
+    if not raw_ret_only:
+        # Recalculate monthly gross returns using representative costs and
+        # the monthly net return. Unless the panels are being consumed,
+        # assigning the column returns a new DataFrame, so the loaded
+        # returns data is left untouched.
+        ret_gross_m_recalculated = (
+            ((df_mfrets.ret_net_m/100 + 1)/(1-df_mfrets.rep_costs/100) - 1) * 100
+        )
+        if inplace:
+            df_mfrets["ret_gross_m_recalculated"] = ret_gross_m_recalculated
+        else:
+            df_mfrets = df_mfrets.assign(
+                ret_gross_m_recalculated=ret_gross_m_recalculated
+            )
+        del ret_gross_m_recalculated
+
+        # Fill missing values of monthly return with the recalculated
+        # values.
+        df_mfrets.ret_gross_m.fillna(df_mfrets.ret_gross_m_recalculated,
+                                    inplace=True)
+
+        # There are an inordinate number of ret_net_m observations equal to
+        # exactly zero (125x more frequently occuring than the next most
+        # common return value to 5 decimal places). Clearly, gross returns
+        # in these cases should not be expected to have exactly offset
         # costs, so set gross returns also to zero for those observations.
         df_mfrets.loc[df_mfrets.ret_net_m == 0, "ret_gross_m"] = 0
 
-    # Remove unnecessary rows
-    df_mfrets = trim_nans(df_mfrets)
+    # Remove unnecessary rows, as trim_nans does. Funds that will not
+    # survive the equity filter are removed along with them, so that
+    # their net assets and categories are never merged or interpolated.
+    keep_flag = trim_flag(df_mfrets).to_numpy()
+    dropped_domiciles = None
+    if equity_filters:
+        is_nonequity = keep_flag & nonequity_fund_rows(
+            df_mfrets, panels["cat"], panels["info"], equity_filters,
+            rows=keep_flag
+        )
+        if is_nonequity.any():
+            df_mfinfo = panels["info"]
+            dropped_domiciles = df_mfinfo.domicile[
+                df_mfinfo.secid.isin(df_mfrets.secid[is_nonequity])
+            ]
+            keep_flag &= ~is_nonequity
+            del df_mfinfo
+        del is_nonequity
+
+    if inplace:
+        if not keep_flag.all():
+            df_mfrets.drop(index=df_mfrets.index[~keep_flag], inplace=True)
+    else:
+        df_mfrets = df_mfrets.loc[keep_flag].copy()
+    del keep_flag
 
     # Merge the rest of the fund time-series data together
-    df_mf = panelmerge([df_mfrets, df_mfna, df_mfcat], how="left")
-
-    # Merge in country of domicile.
-    df_mf = (
-        df_mf.merge(df_mfinfo.loc[:,["secid", "domicile"]])
-    )
+    if inplace:
+        df_mf = panelmerge([df_mfrets, panels.pop("na"), panels.pop("cat")],
+                           how="left")
+    else:
+        df_mf = panelmerge([df_mfrets, panels["na"], panels["cat"]], how="left")
 
     # Clear unused memory
-    del df_mfrets, df_mfna, df_mfcat
-    
-    elapsed_time = datetime.now() - start_time
-    print(f"Process {process_id} ({country_group_code}): Finished merging data ({elapsed_time} passed since process start)")
+    del df_mfrets
+
+    # Merge in country of domicile.
+    if inplace:
+        df_mf = keyed_lookup(df_mf, panels.pop("info"), "secid", "domicile")
+    else:
+        df_mf = keyed_lookup(df_mf, panels["info"], "secid", "domicile")
 
     # For the age-filtered funds dataset, we want eventually to only include
     # observations after the first 24 months, but many other filters need to
@@ -651,49 +2313,70 @@ def process_fund_data(country_group_code, currency_type, raw_ret_only, polation_
     # age. Return observations under 2 years old will be removed as one of
     # the final steps.
     if inc_agefilter:
-        df_mf["age"] = df_mf.groupby("secid").cumcount()
-
-    # Relabel countries as ISO codes
-    ISO = {
-        "Andorra": "AND", "Australia": "AUS", "Austria": "AUT", "Argentina": "ARG",
-        "Bahamas": "BHS", "Bahrain": "BHR", "Belgium": "BEL", "Bermuda": "BMU",
-        "Botswana": "BWA", "Brazil": "BRA", "British Virgin Islands": "VGB",
-        "Canada": "CAN", "Cayman Islands": "CYM", "Chile": "CHL", "China": "CHN",
-        "Colombia": "COL", "Curaçao": "CUW", "Czech Republic": "CZE",
-        "Denmark": "DNK", "Estonia": "EST", "Finland": "FIN", "France": "FRA",
-        "Germany": "DEU", "Gibraltar": "GIB", "Greece": "GRC", "Guernsey": "GGY",
-        "Hong Kong": "HKG", "Iceland": "ISL", "India": "IND", "Indonesia": "IDN",
-        "Ireland": "IRL", "Isle of Man": "IMN", "Israel": "ISR", "Italy": "ITA",
-        "Japan": "JPN", "Jersey": "JEY", "Kuwait": "KWT", "Latvia": "LVA",
-        "Lesotho": "LSO", "Liechtenstein": "LIE", "Lithuania": "LTU",
-        "Luxembourg": "LUX", "Malaysia": "MYS", "Malta": "MLT",
-        "Marshall Islands": "MHL", "Mauritius": "MUS", "Mexico": "MEX",
-        "Namibia": "NAM", "Netherlands": "NLD", "New Zealand": "NZL",
-        "Norway": "NOR", "Oman": "OMN", "Pakistan": "PAK", "Panama": "PAN",
-        "Philippines": "PHL", "Poland": "POL", "Portugal": "PRT",
-        "Puerto Rico": "PRI", "Qatar": "QAT", "Russian Federation": "RUS",
-        "Samoa": "WSM", "San Marino": "SMR", "Saudi Arabia": "SAU",
-        "Singapore": "SGP", "Slovenia": "SVN", "South Africa": "ZAF",
-        "South Korea": "KOR", "Spain": "ESP", "St Vincent-Grenadines": "VCT",
-        "Swaziland": "SWZ", "Sweden": "SWE", "Switzerland": "CHE", "Taiwan": "TWN",
-        "Thailand": "THA", "Turkey": "TUR", "Ukraine": "UKR",
-        "United Arab Emirates": "ARE", "United Kingdom": "GBR",
-        "United States": "USA"
-    }
+        df_mf["age"] = df_mf.groupby("secid", observed=True).cumcount()
 
-    df_mf.domicile = df_mf.domicile.apply(lambda x: ISO[x])
+    # Relabel countries as ISO codes, relabelling the categories rather
+    # than every row. Any country without an ISO code raises a KeyError,
+    # as a row-wise lookup would. The domiciles of funds dropped above
+    # are kept, as they would have been had those funds only been
+    # removed by the equity filter.
+    if dropped_domiciles is None:
+        df_mf.domicile = df_mf.domicile.cat.remove_unused_categories()
+    else:
+        domiciles = df_mf.domicile.cat.categories
+        domicile_used = (domiciles.isin(df_mf.domicile.unique())
+                         | domiciles.isin(dropped_domiciles.unique()))
+        df_mf.domicile = df_mf.domicile.cat.remove_categories(
+            domiciles[~domicile_used]
+        )
+    df_mf.domicile = df_mf.domicile.cat.rename_categories(
+        [ISO_CODES[country] for country in df_mf.domicile.cat.categories]
+    )
 
     # Clean net assets
     # Filter out asset observations equal to zero.
     df_mf.loc[df_mf.net_assets == 0, "net_assets"] = np.nan
-    
+
+    return df_mf
+
+def categorise_fund_panel(df_mf, polation_method, inv_targets, inplace=False):
+    """
+    Interpolate and/or extrapolate net assets, then merge in the
+    equity definitions of each Morningstar category.
+
+    Parameters
+    ----------
+    df_mf : DataFrame
+        The output of combine_fund_panels. It is not modified, unless
+        inplace is True.
+    polation_method : [False, "interpolate", "extrapolate", "both"]
+        If "interpolate", net asset values will be interpolated. If "extrapolate", net
+        assets values will be extrapolated. If "both", net asset values will be both
+        extrapolated and interpolated. If False, neither extrapolation or interpolation
+        will occur.
+    inv_targets : bool
+        If True, the investment target fields of each Morningstar
+        category will also be merged in.
+    inplace : bool, default False
+        If True, df_mf is consumed. Net assets are filled, the rows
+        sorted and the category fields added in df_mf itself, which is
+        then returned.
+
+    Returns
+    -------
+    df_mf_cat : DataFrame
+    """
     # Run the interpolation/extrapolation function under the declared
     # method. Results must be resorted by date to allow for further
-    # backfilling below.
-    df_mf_pol = polate_assets(df_mf, how=polation_method, keep=True).sort_values(by="date")
-
-    # Clear unused memory
-    del df_mf
+    # backfilling below. The sort is stable, for the reasons given in
+    # load_fund_panels.
+    if inplace:
+        df_mf_pol = polate_assets(df_mf, how=polation_method, keep=True,
+                                  inplace=True)
+        df_mf_pol.sort_values(by="date", kind="stable", inplace=True)
+        df_mf_pol.reset_index(drop=True, inplace=True)
+    else:
+        df_mf_pol = polate_assets(df_mf, how=polation_method, keep=True).sort_values(by="date", kind="stable")
 
     # Eliminate non-equity fund classes
     # Read a list of accepted morningstar categories
@@ -701,35 +2384,72 @@ def process_fund_data(country_group_code, currency_type, raw_ret_only, polation_
         pd.read_csv("./data/mappings/morningstar_categories.csv")
     )
 
+    # Keep the category and investment target labels categorical through
+    # the merge below.
+    unify_categories([df_mf_pol, df_equity_categories], "morningstar_category")
+    for col in ["inv_msci_class", "inv_region", "inv_group", "inv_country"]:
+        df_equity_categories[col] = df_equity_categories[col].astype("category")
+
     # If desired, merge Morningstar category fields into the main DataFrame.
     # Otherwise, just merge the equity definition categories.
     if inv_targets:
-        df_mf_cat = df_mf_pol.merge(df_equity_categories,
-                                    on="morningstar_category", how="left")
+        category_columns = [col for col in df_equity_categories.columns
+                            if col != "morningstar_category"]
+    else:
+        category_columns = ["equity", "strict_equity", "fin_or_re"]
+
+    # When consuming the data, add the fields to its rows directly, which
+    # gives the same result as a left merge on a unique category.
+    if inplace and df_equity_categories.morningstar_category.is_unique:
+        keyed_assign(df_mf_pol, df_equity_categories, "morningstar_category",
+                     category_columns)
+        df_mf_cat = df_mf_pol
     else:
         df_mf_cat = (
-            df_mf_pol.merge(df_equity_categories.loc[:,["morningstar_category",
-                                                        "equity",
-                                                        "strict_equity",
-                                                        "fin_or_re"]],
+            df_mf_pol.merge(df_equity_categories.loc[:, ["morningstar_category"]
+                                                        + category_columns],
                             on="morningstar_category", how="left")
         )
 
-    # Clear unused memory.
-    del df_mf_pol
-    
+    return df_mf_cat
+
+def filter_equity_funds(df_mf_cat, strict_eq, exc_finre, inplace=False):
+    """
+    Remove returns to fund classes that are not classified as equity.
+
+    Parameters
+    ----------
+    df_mf_cat : DataFrame
+        The output of categorise_fund_panel. It is not modified, unless
+        inplace is True.
+    strict_eq : bool
+        If True, only Morningstar categories classified as being "strict" equity categories
+        will be included in the final dataset.
+    exc_finre : bool
+        If True, funds classified as investing primarily in financial, infrastructure and
+        real estate securities will be excluded.
+    inplace : bool, default False
+        If True, df_mf_cat is consumed. The flags are added, returns
+        removed and rows trimmed in df_mf_cat itself, which is then
+        returned. Its index must be unique.
+
+    Returns
+    -------
+    df_mf_anyeq : DataFrame
+    """
     # TODO: Using the morningstar broad category is a better way of checking
     # strict equity than this. I will replace it.
 
     # Define a single effective equity classification category based on the
-    # values of strict_eq and exc_finre.
-    if strict_eq:
-        df_mf_cat["equity_flag"] = df_mf_cat.strict_equity
+    # values of strict_eq and exc_finre. Unless the data is being consumed,
+    # assigning the column returns a new DataFrame, so the categorised data
+    # is left untouched.
+    equity_flag = effective_equity_flag(df_mf_cat, strict_eq, exc_finre)
+    if inplace:
+        df_mf_cat["equity_flag"] = equity_flag
     else:
-        df_mf_cat["equity_flag"] = df_mf_cat.equity
-        
-    if exc_finre:
-        df_mf_cat.equity_flag = df_mf_cat.equity_flag * (1-df_mf_cat.fin_or_re)
+        df_mf_cat = df_mf_cat.assign(equity_flag=equity_flag)
+    del equity_flag
 
     # If any secid for a fundid-date pair has an equity classification,
     # then all secids with an ambiguous category (neither clearly equity
@@ -749,21 +2469,29 @@ def process_fund_data(country_group_code, currency_type, raw_ret_only, polation_
     # secids, 0 if it includes any non-equity-classified secids, and nan if
     # there are no nonmissing category observations across all secids. This
     # is achieved simply by calling min on the equity_flag column for each
-    # pair.
-    df_mf_eqfunds = (
-        df_mf_cat.groupby(["fundid", "date"]).equity_flag.min().to_frame()
-                .reset_index().rename(columns={"equity_flag":
-                                                "override_eq_flag"})
-    )
-
-    # Merge this new column back into the main DataFrame. For each
+    # pair. Then merge this new column back into the main DataFrame. For each
     # fundid-date pair where this value is 1, all missing classifications
     # should be set to 1, and where this value is 0, all classifications
     # should be set to 0, but the value will not be 1 unless there are no
     # secids for that fundid-date pair that have a 0 for equity_flag, so
     # this can be achieved simply by overwriting all secid classifications
     # for all fundid-date pairs with that pair's value of override_eq_flag.
-    df_mf_anyeq = df_mf_cat.merge(df_mf_eqfunds, on=["fundid", "date"], how="left")
+    # When consuming the data, the value of each pair is broadcast to its
+    # rows directly, which gives the same column as the merge.
+    if inplace:
+        df_mf_anyeq = df_mf_cat
+        df_mf_anyeq["override_eq_flag"] = (
+            df_mf_anyeq.groupby(["fundid", "date"], observed=True)
+                       .equity_flag.transform("min")
+        )
+    else:
+        df_mf_eqfunds = (
+            df_mf_cat.groupby(["fundid", "date"], observed=True).equity_flag.min().to_frame()
+                    .reset_index().rename(columns={"equity_flag":
+                                                    "override_eq_flag"})
+        )
+
+        df_mf_anyeq = df_mf_cat.merge(df_mf_eqfunds, on=["fundid", "date"], how="left")
 
     df_mf_anyeq.equity_flag = df_mf_anyeq.override_eq_flag
 
@@ -781,88 +2509,95 @@ def process_fund_data(country_group_code, currency_type, raw_ret_only, polation_
     # The method of trimming out non-equity returns has the benefit
     # of allowing returns to a fund that was at one point in time defined as
     # an equity category for the duration of definition as that category.
-    df_mf_anyeq = trim_nans(df_mf_anyeq)
+    df_mf_anyeq = trim_nans(df_mf_anyeq, inplace=inplace)
+
+    # Lag total net assets for use in weighting fund returns
+    df_mf_anyeq["net_assets_m1"] = (
+        df_mf_anyeq.groupby("secid", observed=True).net_assets.shift(1)
+    )
+
+    return df_mf_anyeq
+
+def report_conflicts(df_conflicts, country_group_code):
+    """
+    Print a warning for each column with conflicts found by agg_verify
+    (with return_conflicts=True), giving the number of conflicting
+    fundid-date pairs along with the first of them, so that a warning
+    can be followed up without rerunning the check.
+    """
+    for i, df_column_conflicts in df_conflicts.groupby("column", observed=True):
+        first_conflict = df_column_conflicts.iloc[0]
+        print("Warning: "+str(len(df_column_conflicts))+" fundid-date pairs "
+              "contain at least two secids that have different classifications "
+              "of "+i+", starting with "+str(first_conflict.fundid)+" on "
+              +month_index.to_month_ends([first_conflict.date])[0].strftime("%Y-%m-%d")
+              +". ("+country_group_code+")")
+
+def aggregate_fund_panel(df_mf_anyeq, country_group_code, polation_method,
+                         inv_targets, inc_agefilter):
+    """
+    Aggregate fund classes into funds and calculate fund flows. Flows
+    are not yet winsorised, as that depends on the whole country group.
+
+    Parameters
+    ----------
+    df_mf_anyeq : DataFrame
+        The output of filter_equity_funds. It is not modified.
+    country_group_code : str
+        The country group code the data was loaded for.
+    polation_method : [False, "interpolate", "extrapolate", "both"]
+        The method net assets were interpolated and/or extrapolated
+        with.
+    inv_targets : bool
+        If True, the resultant DataFrame will include information about the investment
+        target of each fund, at levels of MSCI class, region, group and country.
+    inc_agefilter : bool
+        If True, a fund age column will be included for use by the age
+        filter.
 
+    Returns
+    -------
+    df_mf_agg : DataFrame
+        The fund data, sorted by fundid and date.
+    """
     # Aggregate into fund groups
     # Check to see if it's safe to aggregate secids under the same fundid by
     # ensuring that no two secids that share a fundid and date have
     # differing values of any of their categorical columns.
 
     if inv_targets:
-        agg_check = agg_verify(df_mf_anyeq, ["inv_msci_class", "inv_region",
-                                             "inv_group", "inv_country",
-                                             "domicile"])
+        df_conflicts = agg_verify(df_mf_anyeq, ["inv_msci_class", "inv_region",
+                                                "inv_group", "inv_country",
+                                                "domicile"],
+                                  return_conflicts=True)
     else:
-        agg_check = agg_verify(df_mf_anyeq, "domicile")
-        
-    if agg_check != []:
-        for i in agg_check:
-            print("Warning: Some fundid-date pairs contain at least two secids "
-                  "that have different classifications of "+i+". ("+country_group_code+")")
-            
-    # Lag total net assets for use in weighting fund returns
-    df_mf_anyeq["net_assets_m1"] = (
-        df_mf_anyeq.groupby("secid").net_assets.shift(1)
-    )
-
-    # Calculate weights by summing net_assets across every secid for a given
-    # fundid on a given date. Also calculate the number of fund classes for
-    # a given fundid on a given date, as funds with only one class can be
-    # aggregated even when fund_assets is missing. np.sum is called on the
-    # values of net assets instead of simply calling the sum function to
-    # force NaNs to propagate such that any missing value of net assets for
-    # a class of a fund causes a missing value of fund_assets for that fund
-    # on that date.
-    df_fundassets = (
-        df_mf_anyeq.groupby(["fundid", "date"])
-                        .agg(fund_assets_m1=("net_assets_m1",
-                                            lambda x: np.sum(x.values)),
-                            num_classes=("secid", "count"))
-    )
+        df_conflicts = agg_verify(df_mf_anyeq, "domicile",
+                                  return_conflicts=True)
 
-    df_weightedfunds = df_mf_anyeq.merge(df_fundassets,
-                                            how="left", on=["fundid", "date"])
+    report_conflicts(df_conflicts, country_group_code)
 
-    # If the number of secids for a given fundid on a given date is exactly
-    # one, set the weight of that secid's returns to 1, otherwise use net
-    # asset weightings, which will be nan if any secid for that fundid-date
-    # had a missing value of net assets.
-    df_weightedfunds["return_weight"] = (
-        np.where(df_weightedfunds.num_classes == 1, 1,
-                df_weightedfunds.net_assets_m1/df_weightedfunds.fund_assets_m1)
-    )
-
-    # Weight all required columns
-    df_weightedfunds.ret_gross_m = (df_weightedfunds.ret_gross_m
-                                    * df_weightedfunds.return_weight)
-    df_weightedfunds.ret_net_m = (df_weightedfunds.ret_net_m
-                                * df_weightedfunds.return_weight)
-    df_weightedfunds.rep_costs = (df_weightedfunds.rep_costs
-                                * df_weightedfunds.return_weight)
-    
-    # Define the GroupBy.agg(...) keyword arguments as a dictionary based on
-    # the run options chosen at the start of the notebook. Begin with the
-    # columns that will always be aggregated. These are the return columns,
-    # the representative cost column, the domicile columns, and an
+    # Define the aggregate_groups(...) keyword arguments as a dictionary
+    # based on the run options chosen at the start of the notebook. Begin
+    # with the columns that will always be aggregated. These are the return
+    # columns, the representative cost column, the domicile columns, and an
     # "approximate" Morningstar category column that holds the modal secid
-    # category for that fundid-date pair, or simply whichever category is
-    # sorted first amongst all the modal categories if there are more than
-    # one. This column is useful to determine a probable investment
-    # category for that fund on that date at a glance.
+    # category for that fundid-date pair, or simply whichever of the modal
+    # categories appears first if there are more than one. This column is
+    # useful to determine a probable investment category for that fund on
+    # that date at a glance.
     agg_dict = {
-        "ret_gross_m": ("ret_gross_m", lambda x: np.sum(x.values)),
-        "ret_net_m": ("ret_net_m", lambda x: np.sum(x.values)),
-        "mean_costs": ("rep_costs", lambda x: np.sum(x.values)),
-        "approx_morningstar_category": ("morningstar_category",
-                                        lambda x: stats.mode(x)[0][0]),
+        "ret_gross_m": ("ret_gross_m", "strict_sum"),
+        "ret_net_m": ("ret_net_m", "strict_sum"),
+        "mean_costs": ("rep_costs", "strict_sum"),
+        "approx_morningstar_category": ("morningstar_category", "mode"),
         "domicile": ("domicile", "first")
     }
 
-    # Add aggregate fund_age as the maximum age of all secids in a 
+    # Add aggregate fund_age as the maximum age of all secids in a
     # fundid-date pair only if age filtered returns data is desired.
     if inc_agefilter:
         agg_dict["fund_age"] = ("age", "max")
-        
+
     # Always add a measure for fund assets, but the name of this measure
     # depends on the value set for polation_method.
     if polation_method in ["interpolate", "extrapolate", "both"]:
@@ -870,7 +2605,7 @@ def process_fund_data(country_group_code, currency_type, raw_ret_only, polation_
     else:
         assets_name = "net_assets"
 
-    agg_dict["fund_assets"] = (assets_name, lambda x: np.sum(x.values)) 
+    agg_dict["fund_assets"] = (assets_name, "strict_sum")
 
     # If investment targets are desired, all them all in.
     if inv_targets:
@@ -880,30 +2615,56 @@ def process_fund_data(country_group_code, currency_type, raw_ret_only, polation_
                     "inv_group": ("inv_group", "first"),
                     "inv_country": ("inv_country", "first")}
 
-    # Aggregate all secids for the same fundid. Ensure that entires are
-    # date sorted so that fund flows can be accurately calculated.
+    # Aggregate all secids for the same fundid, weighting returns and costs
+    # by lagged net assets. Each secid's weight is its share of the sum of
+    # lagged net assets across every secid for its fundid on that date. If
+    # the number of secids for a given fundid on a given date is exactly
+    # one, the weight of that secid's returns is set to 1, as funds with
+    # only one class can be aggregated even when fund assets are missing.
+    # Otherwise, NaNs propagate through the sum such that any missing value
+    # of net assets for a class of a fund causes missing weights for that
+    # fund on that date. Ensure that entires are date sorted so that fund
+    # flows can be accurately calculated.
     df_mf_agg = (
-        df_weightedfunds.groupby(["fundid", "date"]).agg(**agg_dict)
+        aggregate_groups(df_mf_anyeq, ["fundid", "date"], agg_dict,
+                         weights="net_assets_m1",
+                         weighted_columns=["ret_gross_m", "ret_net_m",
+                                           "rep_costs"])
                         .reset_index()
                         .sort_values(by=["fundid", "date"])
     )
-    
-    elapsed_time = datetime.now() - start_time
-    print(f"Process {process_id} ({country_group_code}): Finished aggregating funds ({elapsed_time} passed since process start)")
 
+    calculate_fund_flows(df_mf_agg)
+
+    return df_mf_agg
+
+def calculate_fund_flows(df_mf_agg):
+    """
+    Calculate unwinsorised fund flows in place.
+
+    Parameters
+    ----------
+    df_mf_agg : DataFrame
+        Aggregated fund data, sorted by fundid and date. The date_m1,
+        fund_assets_m1 and fund_flow columns are added, or replaced.
+    """
     # Lag fund_assets to calculate cash flows. Addtionally, lag the date
     # column to make sure changes in assets are only taken over a single
-    # month.
-    df_mf_agg[["date_m1", "fund_assets_m1"]] = (
-        df_mf_agg.groupby("fundid")[["date", "fund_assets"]].shift(1)
-    )
+    # month. Dates are month indices, so the first month of each fund is
+    # given a lagged date before every real month, which keeps the column
+    # an integer.
+    fund_groups = df_mf_agg.groupby("fundid", observed=True)
+    df_mf_agg["date_m1"] = fund_groups.date.shift(1,
+                                                  fill_value=month_index.FIRST_MONTH)
+    df_mf_agg["fund_assets_m1"] = fund_groups.fund_assets.shift(1)
+    del fund_groups
 
     # Define fund flows in month t as the ratio of fund_asset in t to
     # fund_assets in t-1 less the net returns to the fund at time t. If
     # month t is not one month after month t-1, set the fund flows to nan.
     df_mf_agg["fund_flow"] = (
         np.where(
-            (df_mf_agg.date == df_mf_agg.date_m1+MonthEnd(1))
+            (df_mf_agg.date == df_mf_agg.date_m1+1)
             & (df_mf_agg.fund_assets_m1 >= 10_000_000),
             df_mf_agg.fund_assets/df_mf_agg.fund_assets_m1
             - (1+df_mf_agg.ret_net_m/100),
@@ -911,19 +2672,141 @@ def process_fund_data(country_group_code, currency_type, raw_ret_only, polation_
         )
     )
 
+def aggregate_fund_data_lazy(country_group_code, currency_type, raw_ret_only,
+                             polation_method, strict_eq, exc_finre, inv_targets,
+                             inc_agefilter):
+    """
+    Load, combine, categorise, filter and aggregate the fund data of one
+    country group as lazy Polars queries (see shared/lazy_pipeline.py),
+    rather than stage by stage in pandas.
+
+    Parameters are as in process_fund_data. The output is that of
+    aggregate_fund_panel, with values that are the same up to rounding.
+
+    Returns
+    -------
+    df_mf_agg : DataFrame
+        The fund data, sorted by fundid and date.
+    """
+    filenames = dict(zip(["info", "gross", "net", "na", "costs", "cat"],
+                         fund_source_files(country_group_code, currency_type)))
+    df_mf_agg, df_conflicts = lazy_pipeline.aggregate_fund_data(
+        filenames, "./data/mappings/morningstar_categories.csv", raw_ret_only,
+        polation_method, strict_eq, exc_finre, inv_targets, inc_agefilter
+    )
+
+    report_conflicts(df_conflicts, country_group_code)
+
+    # Relabel countries as ISO codes, as combine_fund_panels does.
+    df_mf_agg.domicile = df_mf_agg.domicile.cat.rename_categories(
+        [ISO_CODES[country] for country in df_mf_agg.domicile.cat.categories]
+    )
+
+    calculate_fund_flows(df_mf_agg)
+
+    return df_mf_agg
+
+def flow_bounds(fund_flow):
+    """
+    Return the (lower, upper) bounds that fund flows are winsorised to,
+    being the 1st and 99th percentiles of the nonmissing flows. Both
+    bounds are observed values of fund_flow, so the bounds of a whole
+    country group can be found exactly from the flows of its shards.
+    """
+    return (fund_flow.quantile(0.01, interpolation="lower"),
+            fund_flow.quantile(0.99, interpolation="higher"))
+
+def pooled_flow_bounds(flow_sketches):
+    """
+    Return the (lower, upper) bounds that fund flows are winsorised to
+    when they are pooled across country groups, being the 1st and 99th
+    percentiles of the nonmissing flows of every group, as in
+    flow_bounds. The percentiles are read from the merged sketches of the
+    flows of each group, so each bound is within
+    quantile_sketch.RELATIVE_ACCURACY of the observed flow at its rank.
+    """
+    flow_sketch = quantile_sketch.merge(flow_sketches)
+
+    return (quantile_sketch.quantile(flow_sketch, 0.01, interpolation="lower"),
+            quantile_sketch.quantile(flow_sketch, 0.99, interpolation="higher"))
+
+def refine_fund_data(df_mf_agg, inc_agefilter, pooled_flows=False):
+    """
+    Run refine_fund_panel as the last stage of a run, returning a dict of
+    the fund data ("main") and the age-filtered fund data ("filt").
+
+    If pooled_flows is True, fund flows are left unwinsorised and the dict
+    also holds a quantile_sketch summary of the unwinsorised flows
+    ("flow_sketch"), for pooled_flow_bounds.
+    """
+    data = {}
+    if pooled_flows:
+        data["flow_sketch"] = quantile_sketch.summarise(df_mf_agg.fund_flow)
+
+    data["main"], data["filt"] = refine_fund_panel(df_mf_agg, inc_agefilter,
+                                                   winsorise=not pooled_flows)
+
+    return data
+
+def refine_fund_panel(df_mf_agg, inc_agefilter, winsorise=True):
+    """
+    Winsorise fund flows, apply the age filter and remove funds with too
+    few returns.
+
+    Parameters
+    ----------
+    df_mf_agg : DataFrame
+        The output of aggregate_fund_panel, or the output for every
+        shard of a country group concatenated and sorted by fundid and
+        date. It is modified in place.
+    inc_agefilter : bool
+        If True, an age-filtered DataFrame will also be returned.
+    winsorise : bool, default True
+        If False, fund flows are left unwinsorised, to be winsorised once
+        the data is saved (see clip_fund_flows).
+
+    Returns
+    -------
+    df_mf : DataFrame
+        The fund data.
+    df_mf_filt : DataFrame or None
+        The age-filtered fund data, or None if inc_agefilter is False.
+    """
     # There are extreme outliers of fund_flows on both the high and the
     # low end, which must be due to errors in either returns or net assets
     # data around those observations. Winsorise the fund_flows variable
     # at the 1st and 99th percentiles.
-    df_mf_agg.fund_flow = (
-        df_mf_agg.fund_flow.copy().clip(lower=df_mf_agg.fund_flow
-                                                       .quantile(0.01,
-                                                                 interpolation="lower"),
-                                        upper=df_mf_agg.fund_flow
-                                                       .quantile(0.99,
-                                                                 interpolation="higher"))
+    if winsorise:
+        lower, upper = flow_bounds(df_mf_agg.fund_flow)
+        df_mf_agg.fund_flow = df_mf_agg.fund_flow.clip(lower=lower, upper=upper)
+
+    df_mf_agg, df_mf_filt = age_filter_fund_panel(df_mf_agg, inc_agefilter)
+
+    mature_fundids, mature_fundids_filt = mature_funds(
+        fund_retcounts(df_mf_agg),
+        fund_retcounts(df_mf_filt) if inc_agefilter else None
     )
 
+    df_mf = select_mature_funds(df_mf_agg, mature_fundids)
+    if inc_agefilter:
+        df_mf_filt = select_mature_funds(df_mf_filt, mature_fundids_filt)
+
+    return df_mf, df_mf_filt
+
+def age_filter_fund_panel(df_mf_agg, inc_agefilter):
+    """
+    Split off the age-filtered fund data if required, and trim the
+    leading and trailing nans of each fund, as refine_fund_panel does.
+    df_mf_agg is modified in place.
+
+    Returns
+    -------
+    df_mf_agg : DataFrame
+        The trimmed fund data.
+    df_mf_filt : DataFrame or None
+        The trimmed age-filtered fund data, or None if inc_agefilter is
+        False.
+    """
     # Correct for incubation bias with an age filter
     # If desired, filter out the first 3 years of observations using the
     # existing age field.
@@ -934,20 +2817,39 @@ def process_fund_data(country_group_code, currency_type, raw_ret_only, polation_
 
         df_mf_agg.drop("fund_age", axis=1, inplace=True)
         df_mf_filt.drop("fund_age", axis=1, inplace=True)
+    else:
+        df_mf_filt = None
 
-    # Trim leading and trailing nans for the final time
-    df_mf_agg = trim_nans(df_mf_agg.copy(), id_level="fundid")
+    # Trim leading and trailing nans for the final time. Neither DataFrame
+    # is used again, so both are trimmed in place.
+    trim_nans(df_mf_agg, id_level="fundid", inplace=True)
     if inc_agefilter:
-        df_mf_filt = trim_nans(df_mf_filt.copy(), id_level="fundid")
-
-    # Filter out funds with fewer than 24 nonmissing monthly returns
-    # Count the number of nonmissing returns for each fundid (for filtered
-    # and unfiltered DataFrames if necessary).
-    df_mf_retcounts_agg = (
-        df_mf_agg.groupby("fundid").ret_gross_m.count().to_frame().reset_index()
-                                .rename(columns={"ret_gross_m": "retcount"})
+        trim_nans(df_mf_filt, id_level="fundid", inplace=True)
+
+    return df_mf_agg, df_mf_filt
+
+def fund_retcounts(df_mf):
+    """
+    Count the number of nonmissing returns of each fundid, in fundid
+    order, as a DataFrame with columns "fundid" and "retcount".
+    """
+    return (
+        df_mf.groupby("fundid", observed=True).ret_gross_m.count()
+             .to_frame().reset_index()
+             .rename(columns={"ret_gross_m": "retcount"})
     )
 
+def mature_funds(df_mf_retcounts_agg, df_mf_retcounts_filt=None):
+    """
+    Return the fundids with at least 24 nonmissing monthly returns, from
+    the output of fund_retcounts for the fund data and, if given, for
+    the age-filtered fund data (else None is returned in its place).
+
+    The age-filtered funds are selected by the return counts of the
+    unfiltered funds at the same position in fundid order, as
+    refine_fund_panel always has. The return counts of each must
+    therefore cover a whole country group.
+    """
     # Only retain fundids that have return counts greater than or equal to
     # 24.
     mature_fundids = (
@@ -955,31 +2857,35 @@ def process_fund_data(country_group_code, currency_type, raw_ret_only, polation_
                         .values
     )
 
-    df_mf = (
-        df_mf_agg.loc[df_mf_agg.fundid.isin(mature_fundids)]
-                .drop(["date_m1", "fund_assets_m1"], axis=1)
-    )
-
     # Repeat for filtered DataFrame if necessary.
-    if inc_agefilter:
+    if df_mf_retcounts_filt is None:
+        return mature_fundids, None
 
-        df_mf_retcounts_filt = (
-            df_mf_filt.groupby("fundid").ret_gross_m.count().to_frame()
-                    .reset_index().rename(columns={"ret_gross_m": "retcount"})
-        )
-        
-        mature_fundids = (
-            df_mf_retcounts_filt.loc[df_mf_retcounts_agg.retcount >= 24,
-                                    "fundid"]
-                                .values
-        )
+    mature_fundids_filt = (
+        df_mf_retcounts_filt.loc[df_mf_retcounts_agg.retcount >= 24,
+                                "fundid"]
+                            .values
+    )
 
-        df_mf_filt = (
-            df_mf_filt.loc[df_mf_filt.fundid.isin(mature_fundids)]
-                    .drop(["date_m1", "fund_assets_m1"], axis=1)
-        )
+    return mature_fundids, mature_fundids_filt
 
-    # Save refined data
+def select_mature_funds(df_mf, mature_fundids):
+    """
+    Keep the rows of the given fundids, dropping the columns that were
+    only needed to calculate fund flows.
+    """
+    return (
+        df_mf.loc[df_mf.fundid.isin(mature_fundids)]
+             .drop(["date_m1", "fund_assets_m1"], axis=1)
+    )
+
+def fund_data_foldername(currency_type, raw_ret_only, polation_method, strict_eq,
+                         exc_finre, inv_targets, **kwargs):
+    """
+    Return the post-processing folder name for a set of run options.
+    Any other keyword arguments (such as inc_agefilter) are ignored, so
+    that a full option set can be unpacked into this function.
+    """
     # Declare a filename suffix based on the particular run options that
     # were selected for this run.
     if currency_type == "local":
@@ -996,7 +2902,7 @@ def process_fund_data(country_group_code, currency_type, raw_ret_only, polation_
         folder_name += "_na-int"
     elif polation_method == "extrapolate":
         folder_name += "_na-exp"
-        
+
     if strict_eq:
         if exc_finre:
             folder_name += "_eq-strict-exfinre"
@@ -1008,47 +2914,1481 @@ def process_fund_data(country_group_code, currency_type, raw_ret_only, polation_
     if inv_targets:
         folder_name += "_targets"
 
-    folder_dir = (
-        "./data/mutual-funds/post-processing/{}/initialised".format(folder_name)
-    )
+    return folder_name
 
-    if not os.path.exists(folder_dir):
-        os.makedirs(folder_dir)
+def output_folder_dir(folder_name):
+    """Return the initialised post-processing folder for a folder name."""
+    return os.path.join("./data/mutual-funds/post-processing", folder_name,
+                        "initialised")
 
-    df_mf.to_csv("{fld}\\mf_{ctry}.csv"
-                .format(fld=folder_dir,
-                        ctry=country_group_code),
-                index=False)
+def save_fund_data(df_mf, df_mf_filt, folder_name, country_group_code,
+                   output_format="csv"):
+    """
+    Save refined fund data, and the age-filtered fund data if it is not
+    None, to their post-processing folders. See fund_output.write_part
+    for the available output formats.
+
+    The month indices of both are converted back to month-end dates in
+    place, as neither is used once it is saved.
+    """
+    for df in [df_mf, df_mf_filt]:
+        if df is not None:
+            df["date"] = month_index.to_month_ends(df.date)
+
+    folder_dir = output_folder_dir(folder_name)
+
+    if not os.path.exists(folder_dir):
+        os.makedirs(folder_dir)
+
+    fund_output.write_part(df_mf, folder_dir, country_group_code, output_format)
+
+    if df_mf_filt is not None:
+        folder_dir = output_folder_dir(folder_name + "_age-filtered")
 
-    if inc_agefilter:
-        folder_dir = (
-            "./data/mutual-funds/post-processing/{}_age-filtered/initialised"
-            .format(folder_name)
-        ) 
-        
         if not os.path.exists(folder_dir):
             os.makedirs(folder_dir)
 
-        df_mf_filt.to_csv("{fld}\\mf_{ctry}.csv"
-                    .format(fld=folder_dir,
-                            ctry=country_group_code),
-                    index=False)
-    
+        fund_output.write_part(df_mf_filt, folder_dir, country_group_code,
+                               output_format)
+
+def fund_source_files(country_group_code, currency_type):
+    """
+    Return the paths of the domicile-grouped files that
+    load_fund_panels reads for one country group and currency.
+    """
+    filename_bases = ["info",
+                      f"{currency_type}-monthly-gross-returns",
+                      f"{currency_type}-monthly-net-returns",
+                      "monthly-net-assets", "monthly-costs",
+                      "monthly-morningstar-category"]
+
+    return [data_filename(base, country_group_code) for base in filename_bases]
+
+def estimate_group_memory(country_group_code, currency_type="usd", inplace=False):
+    """
+    Estimate the peak memory, in bytes, of processing one country group
+    from the total size of its source files, either in place or not.
+    """
+    input_bytes = sum(os.path.getsize(filename)
+                      for filename in fund_source_files(country_group_code,
+                                                        currency_type)
+                      if os.path.exists(filename))
+
+    if inplace:
+        return input_bytes * MEMORY_PER_INPUT_BYTE_INPLACE
+
+    return input_bytes * MEMORY_PER_INPUT_BYTE
+
+def fund_stage_keys(country_group_code, currency_type, raw_ret_only, polation_method,
+                    strict_eq, exc_finre, inv_targets, inc_agefilter):
+    """
+    Return the checkpoint key of each stage of process_fund_data, as a
+    dict keyed by stage name. Each key depends on the source files read
+    by and the options passed to its stage and every stage before it.
+    """
+    keys = {}
+    keys["load"] = stage_cache.stage_key(
+        None, "load",
+        filenames=fund_source_files(country_group_code, currency_type),
+        country_group_code=country_group_code, currency_type=currency_type
+    )
+    keys["combine"] = stage_cache.stage_key(
+        keys["load"], "combine",
+        filenames=["./data/mappings/morningstar_categories.csv"],
+        raw_ret_only=raw_ret_only, inc_agefilter=inc_agefilter,
+        equity_filters=[[strict_eq, exc_finre]]
+    )
+    keys["categorise"] = stage_cache.stage_key(
+        keys["combine"], "categorise",
+        filenames=["./data/mappings/morningstar_categories.csv"],
+        polation_method=polation_method, inv_targets=inv_targets
+    )
+    keys["filter"] = stage_cache.stage_key(
+        keys["categorise"], "filter",
+        strict_eq=strict_eq, exc_finre=exc_finre
+    )
+    keys["aggregate"] = stage_cache.stage_key(
+        keys["filter"], "aggregate",
+        inv_targets=inv_targets, inc_agefilter=inc_agefilter
+    )
+
+    return keys
+
+def process_fund_data(country_group_code, currency_type, raw_ret_only, polation_method,
+                      strict_eq, exc_finre, inv_targets, inc_agefilter,
+                      checkpoint_dir=None,
+                      checkpoint_max_bytes=stage_cache.MAX_BYTES, shards=1,
+                      output_format="csv", incremental=False, inplace=False,
+                      engine="pandas", memory_limit=None, pooled_flows=False):
+    """
+    Parameters
+    ----------
+    country_group_code : str
+        The country group code to load data for.
+    currency_type : ["local", "usd"]
+        The currency group that returns are denominated in.
+    raw_ret_only : bool
+        If True, raw gross returns only will be used in the final dataset. If False,
+        missing values of gross returns will be calculated using net returns and
+        representative costs where available.
+    polation_method : [False, "interpolate", "extrapolate", "both"]
+        If "interpolate", net asset values will be interpolated. If "extrapolate", net
+        assets values will be extrapolated. If "both", net asset values will be both
+        extrapolated and interpolated. If False, neither extrapolation or interpolation
+        will occur.
+    strict_eq : bool
+        If True, only Morningstar categories classified as being "strict" equity categories
+        will be included in the final dataset.
+    exc_finre : bool
+        If True, funds classified as investing primarily in financial, infrastructure and
+        real estate securities will be excluded.
+    inv_targets : bool
+        If True, the resultant DataFrame will include information about the investment
+        target of each fund, at levels of MSCI class, region, group and country.
+    inc_agefilter : bool
+        If True, additional DataFrames will be saved that include only age-filtered mutual
+        fund data, as well as the non-filtered DataFrames.
+    checkpoint_dir : str, default None
+        If provided, the output of each stage will be saved as a checkpoint in this
+        directory (such as stage_cache.CHECKPOINT_DIR), and the run will resume from the
+        deepest stage with a checkpoint matching the current source files and options.
+    checkpoint_max_bytes : int, default stage_cache.MAX_BYTES
+        The limit on the total size of checkpoint_dir. The least recently used
+        checkpoints are deleted to keep the directory within this limit.
+    shards : int, default 1
+        If greater than 1, the funds in the country group will be split into this many
+        shards, which are processed in parallel by process_fund_shard and then combined by
+        finish_fund_data. The output is identical to that of an unsharded run. Cannot be
+        used with checkpoint_dir.
+    output_format : {"csv", "arrow", "parquet"}, default "csv"
+        The format to save the output in. Arrow and Parquet output is typed and
+        compressed, and listed in a manifest in each output folder. The Julia
+        scripts (see load_data_in_parts in CommonFunctions.jl) only read arrow
+        and csv output, so parquet output is for reading from Python.
+    incremental : bool, default False
+        If True, the run is handed to append_fund_data, which reprocesses only the
+        funds with observations in months appended since the previous incremental
+        run, and only from the latest month that the new months cannot change. The
+        country group is rebuilt if the earlier history has changed. Cannot be used
+        with checkpoint_dir or shards > 1.
+    inplace : bool, default False
+        If True, each stage consumes the output of the stage before it, filling,
+        trimming and extending the same panel in place rather than copying it, and
+        the output of a stage must not be used once the next stage has run. The
+        output is identical, but the peak memory of every stage is held under
+        INPLACE_MEMORY_MULTIPLE times the size of the merged panel, and the peak
+        memory of the run is estimated with MEMORY_PER_INPUT_BYTE_INPLACE rather than
+        MEMORY_PER_INPUT_BYTE. Cannot be used with incremental.
+    engine : {"pandas", "polars"}, default "pandas"
+        If "polars", the stages up to and including aggregation run as lazy Polars
+        queries (see aggregate_fund_data_lazy), which read only the columns they use
+        and run across the Polars thread pool. The output is the same as that of
+        the pandas engine up to rounding, which check_engines verifies. Requires
+        polars. Cannot be used with checkpoint_dir, shards > 1 or incremental, and
+        inplace is ignored.
+    memory_limit : int, default None
+        If provided, the run is handed to process_fund_data_out_of_core, which
+        spills fundid-hash partitions of the source files to local disk and
+        processes them one at a time, so that the estimated peak memory of the run
+        is held under this many bytes however large the country group is. The
+        output is identical. Cannot be used with checkpoint_dir, shards > 1,
+        incremental or engine "polars".
+    pooled_flows : bool, default False
+        If True, fund flows are saved unwinsorised, and the run returns a
+        quantile_sketch summary of the unwinsorised flows of the country group.
+        The summaries of several country groups can then be merged into pooled
+        winsorisation bounds with pooled_flow_bounds, and each group's saved
+        output winsorised to them with clip_fund_flows, without holding more
+        than one group in memory at once. Cannot be used with checkpoint_dir or
+        incremental.
+
+    Returns
+    -------
+    flow_sketch : dict or None
+        The summary of the unwinsorised fund flows if pooled_flows is True,
+        otherwise None.
+    """
+    if engine not in ["pandas", "polars"]:
+        raise ValueError("engine must be 'pandas' or 'polars'.")
+    if engine == "polars" and (checkpoint_dir is not None or shards > 1
+                               or incremental):
+        raise ValueError("engine 'polars' cannot be used with checkpoint_dir, "
+                         "shards > 1 or incremental.")
+
+    if pooled_flows and (checkpoint_dir is not None or incremental):
+        raise ValueError("pooled_flows cannot be used with checkpoint_dir or "
+                         "incremental.")
+
+    if memory_limit is not None:
+        if (checkpoint_dir is not None or shards > 1 or incremental
+                or engine != "pandas"):
+            raise ValueError("memory_limit cannot be used with checkpoint_dir, "
+                             "shards > 1, incremental or engine 'polars'.")
+
+        return process_fund_data_out_of_core(country_group_code, memory_limit,
+                                             currency_type, raw_ret_only,
+                                             polation_method, strict_eq,
+                                             exc_finre, inv_targets,
+                                             inc_agefilter,
+                                             output_format=output_format,
+                                             inplace=inplace,
+                                             pooled_flows=pooled_flows)
+
+    if incremental:
+        if checkpoint_dir is not None or shards > 1:
+            raise ValueError("incremental cannot be used with checkpoint_dir "
+                             "or shards > 1.")
+        if inplace:
+            raise ValueError("incremental cannot be used with inplace.")
+
+        append_fund_data(country_group_code, currency_type, raw_ret_only,
+                         polation_method, strict_eq, exc_finre, inv_targets,
+                         inc_agefilter, output_format=output_format)
+        return
+
+    # Grab the process ID and start time
+    process_id = os.getpid()
+    start_time = datetime.now()
+
+    if shards > 1:
+        if checkpoint_dir is not None:
+            raise ValueError("checkpoint_dir cannot be used with shards > 1.")
+
+        options = {"currency_type": currency_type, "raw_ret_only": raw_ret_only,
+                   "polation_method": polation_method, "strict_eq": strict_eq,
+                   "exc_finre": exc_finre, "inv_targets": inv_targets,
+                   "inc_agefilter": inc_agefilter}
+
+        # Each shard returns its telemetry records alongside its output.
+        run_shard = functools.partial(
+            telemetry.run_collected, process_fund_shard, country_group_code,
+            **options, inplace=inplace, trace_memory=telemetry.tracing(),
+            job_labels={"country_group": country_group_code}
+        )
+        with multiprocessing.Pool(processes=shards) as pool:
+            shard_results = pool.map(run_shard, [(shard_index, shards)
+                                                 for shard_index in range(shards)])
+
+        shard_aggs = []
+        for df_mf_agg, records in shard_results:
+            shard_aggs.append(df_mf_agg)
+            telemetry.extend(records)
+        del shard_results
+
+        flow_sketch = finish_fund_data(country_group_code, shard_aggs, **options,
+                                       output_format=output_format,
+                                       pooled_flows=pooled_flows)
+
+        elapsed_time = datetime.now() - start_time
+        print(f"Process {process_id} ({country_group_code}): Data saved and processed ended ({elapsed_time} passed since process start)")
+        return flow_sketch
+
+    # Define each stage as a function of the output of the stage before
+    # it, alongside the message to print once it has finished. The polars
+    # engine runs every stage up to aggregation at once.
+    if engine == "polars":
+        stages = [
+            ("aggregate",
+             lambda _: refine_fund_data(
+                 aggregate_fund_data_lazy(country_group_code, currency_type,
+                                          raw_ret_only, polation_method,
+                                          strict_eq, exc_finre, inv_targets,
+                                          inc_agefilter),
+                 inc_agefilter, pooled_flows
+             ),
+             "Finished aggregating funds"),
+        ]
+    else:
+        stages = [
+            ("load",
+             lambda _: load_fund_panels(country_group_code, currency_type),
+             "Finished loading data"),
+            ("combine",
+             lambda panels: combine_fund_panels(panels, raw_ret_only, inc_agefilter,
+                                                equity_filters=[(strict_eq, exc_finre)],
+                                                inplace=inplace),
+             "Finished merging data"),
+            ("categorise",
+             lambda df_mf: categorise_fund_panel(df_mf, polation_method, inv_targets,
+                                                 inplace=inplace),
+             None),
+            ("filter",
+             lambda df_mf_cat: filter_equity_funds(df_mf_cat, strict_eq, exc_finre,
+                                                   inplace=inplace),
+             None),
+            ("aggregate",
+             lambda df_mf_anyeq: refine_fund_data(
+                 aggregate_fund_panel(df_mf_anyeq, country_group_code,
+                                      polation_method, inv_targets, inc_agefilter),
+                 inc_agefilter, pooled_flows
+             ),
+             "Finished aggregating funds"),
+        ]
+
+    # If checkpoints are enabled, resume from the deepest stage that has
+    # a valid checkpoint.
+    data = None
+    first_stage = 0
+    if checkpoint_dir is not None:
+        keys = fund_stage_keys(country_group_code, currency_type, raw_ret_only,
+                               polation_method, strict_eq, exc_finre,
+                               inv_targets, inc_agefilter)
+        for depth in reversed(range(len(stages))):
+            stage = stages[depth][0]
+            data = stage_cache.read_checkpoint(stage, keys[stage], checkpoint_dir)
+            if data is not None:
+                first_stage = depth + 1
+                elapsed_time = datetime.now() - start_time
+                print(f"Process {process_id} ({country_group_code}): Resumed from {stage} checkpoint ({elapsed_time} passed since process start)")
+                break
+
+    # Run every remaining stage, replacing the output of each stage with
+    # the output of the next to clear unused memory.
+    for stage, run_stage, message in stages[first_stage:]:
+        with telemetry.measure(stage, telemetry.count_rows(data)) as record:
+            data = run_stage(data)
+            record["rows_out"] = telemetry.count_rows(data)
+
+        if checkpoint_dir is not None:
+            stage_cache.write_checkpoint(data, stage, keys[stage],
+                                         checkpoint_dir, checkpoint_max_bytes)
+
+        if message is not None:
+            elapsed_time = datetime.now() - start_time
+            print(f"Process {process_id} ({country_group_code}): {message} ({elapsed_time} passed since process start)")
+
+    df_mf, df_mf_filt = data["main"], data["filt"]
+
+    # Save refined data
+    with telemetry.measure("save", telemetry.count_rows(data)):
+        save_fund_data(df_mf, df_mf_filt,
+                       fund_data_foldername(currency_type, raw_ret_only,
+                                            polation_method, strict_eq,
+                                            exc_finre, inv_targets),
+                       country_group_code, output_format)
+
     elapsed_time = datetime.now() - start_time
     print(f"Process {process_id} ({country_group_code}): Data saved and processed ended ({elapsed_time} passed since process start)")
 
-def process_fund_data_wrapped(process_id):
-    process_fund_data(
-        COUNTRY_GROUPS[process_id], currency_type="usd", raw_ret_only=True,
-        polation_method="interpolate", strict_eq=True, exc_finre=False,
-        inv_targets=True, inc_agefilter=True
+    return data.get("flow_sketch")
+
+def check_engines(country_group_code, currency_type, raw_ret_only, polation_method,
+                  strict_eq, exc_finre, inv_targets, inc_agefilter, rtol=1e-9):
+    """
+    Check that the polars engine of process_fund_data gives the same output as the
+    pandas engine for one country group, without saving either.
+
+    Parameters are as in process_fund_data, with the addition of rtol, the relative
+    tolerance of the comparison of numeric values. Every other part of the output,
+    including its rows, categories and missing values, must match exactly.
+
+    Raises
+    ------
+    ValueError
+        If either output DataFrame differs between the engines.
+    """
+    df_mf_agg = aggregate_fund_panel(
+        filter_equity_funds(
+            categorise_fund_panel(
+                combine_fund_panels(
+                    load_fund_panels(country_group_code, currency_type),
+                    raw_ret_only, inc_agefilter,
+                    equity_filters=[(strict_eq, exc_finre)], inplace=True
+                ),
+                polation_method, inv_targets, inplace=True
+            ),
+            strict_eq, exc_finre, inplace=True
+        ),
+        country_group_code, polation_method, inv_targets, inc_agefilter
+    )
+    outputs_pandas = refine_fund_panel(df_mf_agg, inc_agefilter)
+    del df_mf_agg
+
+    outputs_polars = refine_fund_panel(
+        aggregate_fund_data_lazy(country_group_code, currency_type, raw_ret_only,
+                                 polation_method, strict_eq, exc_finre,
+                                 inv_targets, inc_agefilter),
+        inc_agefilter
+    )
+
+    # Compare the outputs as they are saved. The pandas engine widens month
+    # indices to int64 when it aggregates them, which month ends undo.
+    for name, df_pandas, df_polars in zip(["main", "filt"], outputs_pandas,
+                                          outputs_polars):
+        if df_pandas is None:
+            continue
+
+        for df in [df_pandas, df_polars]:
+            df["date"] = month_index.to_month_ends(df.date)
+        try:
+            pd.testing.assert_frame_equal(df_pandas.reset_index(drop=True),
+                                          df_polars.reset_index(drop=True),
+                                          check_exact=False, rtol=rtol)
+        except AssertionError as error:
+            raise ValueError(f"The {name} output of the polars engine differs from "
+                             f"that of the pandas engine for {country_group_code}: "
+                             f"{error}") from error
+
+def process_fund_shard(country_group_code, shard, currency_type, raw_ret_only,
+                       polation_method, strict_eq, exc_finre, inv_targets,
+                       inc_agefilter, inplace=False, spill_dir=None):
+    """
+    Run the first phase of a sharded run of process_fund_data, which
+    processes one shard of the funds in a country group up to the point
+    that fund flows are winsorised. Out-of-core runs process each of
+    their partitions in the same way.
+
+    Parameters
+    ----------
+    country_group_code : str
+        The country group code to load data for.
+    shard : (int, int)
+        The (shard_index, num_shards) pair selecting the funds to
+        process.
+    currency_type, raw_ret_only, polation_method, strict_eq, exc_finre,
+    inv_targets, inc_agefilter, inplace
+        As in process_fund_data.
+    spill_dir : str, default None
+        As in load_fund_panels.
+
+    Returns
+    -------
+    df_mf_agg : DataFrame
+        The aggregated fund data for the shard, to be passed to
+        finish_fund_data along with the output of every other shard.
+    """
+    process_id = os.getpid()
+    start_time = datetime.now()
+
+    # The stages of the shard, as in process_fund_data, up to the point
+    # that fund flows are winsorised.
+    stages = [
+        ("load",
+         lambda _: load_fund_panels(country_group_code, currency_type,
+                                    shard=shard, spill_dir=spill_dir)),
+        ("combine",
+         lambda panels: combine_fund_panels(panels, raw_ret_only, inc_agefilter,
+                                            equity_filters=[(strict_eq, exc_finre)],
+                                            inplace=inplace)),
+        ("categorise",
+         lambda df_mf: categorise_fund_panel(df_mf, polation_method, inv_targets,
+                                             inplace=inplace)),
+        ("filter",
+         lambda df_mf_cat: filter_equity_funds(df_mf_cat, strict_eq, exc_finre,
+                                               inplace=inplace)),
+        ("aggregate",
+         lambda df_mf_anyeq: aggregate_fund_panel(df_mf_anyeq, country_group_code,
+                                                  polation_method, inv_targets,
+                                                  inc_agefilter)),
+    ]
+
+    # Replace the output of each stage with the output of the next to
+    # clear unused memory.
+    data = None
+    with telemetry.labels(shard=f"{shard[0] + 1} of {shard[1]}"):
+        for stage, run_stage in stages:
+            with telemetry.measure(stage, telemetry.count_rows(data)) as record:
+                data = run_stage(data)
+                record["rows_out"] = telemetry.count_rows(data)
+    df_mf_agg = data
+
+    elapsed_time = datetime.now() - start_time
+    print(f"Process {process_id} ({country_group_code}): Finished aggregating shard {shard[0] + 1} of {shard[1]} ({elapsed_time} passed since process start)")
+
+    return df_mf_agg
+
+def finish_fund_data(country_group_code, shard_aggs, currency_type, raw_ret_only,
+                     polation_method, strict_eq, exc_finre, inv_targets,
+                     inc_agefilter, output_format="csv", pooled_flows=False):
+    """
+    Run the second phase of a sharded run of process_fund_data, which
+    combines the aggregated fund data of every shard, winsorises fund
+    flows across the whole country group and saves the result.
+
+    Parameters
+    ----------
+    country_group_code : str
+        The country group code the data was loaded for.
+    shard_aggs : sequence of DataFrame
+        The output of process_fund_shard for every shard of the country
+        group.
+    currency_type, raw_ret_only, polation_method, strict_eq, exc_finre,
+    inv_targets, inc_agefilter, output_format, pooled_flows
+        As in process_fund_data.
+
+    Returns
+    -------
+    flow_sketch : dict or None
+        As in process_fund_data.
+    """
+    # Categories that were trimmed to the values present in each shard
+    # (such as domicile) must be shared again before concatenating.
+    category_columns = [col for col in shard_aggs[0].columns
+                        if shard_aggs[0][col].dtype == "category"]
+    unify_categories(shard_aggs, category_columns)
+
+    # Every fund lies in exactly one shard, so sorting by fundid and date
+    # restores the order of an unsharded run. The winsorisation bounds are
+    # then order statistics of the flows of the whole country group, as in
+    # an unsharded run.
+    with telemetry.measure("finish", telemetry.count_rows(shard_aggs)) as record:
+        df_mf_agg = (
+            pd.concat(shard_aggs, ignore_index=True)
+              .sort_values(by=["fundid", "date"])
+              .reset_index(drop=True)
+        )
+
+        data = refine_fund_data(df_mf_agg, inc_agefilter, pooled_flows)
+        record["rows_out"] = telemetry.count_rows(data)
+
+    with telemetry.measure("save", record["rows_out"]):
+        save_fund_data(data["main"], data["filt"],
+                       fund_data_foldername(currency_type, raw_ret_only,
+                                            polation_method, strict_eq,
+                                            exc_finre, inv_targets),
+                       country_group_code, output_format)
+
+    return data.get("flow_sketch")
+
+def process_fund_data_out_of_core(country_group_code, memory_limit, currency_type,
+                                  raw_ret_only, polation_method, strict_eq,
+                                  exc_finre, inv_targets, inc_agefilter,
+                                  output_format="csv", inplace=False,
+                                  spill_dir=None, pooled_flows=False):
+    """
+    Run process_fund_data out of core, so that its estimated peak memory is
+    held under memory_limit however large the country group is. The output is
+    identical to that of an in-memory run.
+
+    The source panels are split into fundid-hash partitions (see fund_shards)
+    that are spilled to local disk (see shared/partition_spill.py), using just
+    enough partitions for estimate_group_memory to put each of them within
+    memory_limit. Each partition is then processed up to the point that fund
+    flows are winsorised, as a shard is, and spilled again. The winsorisation
+    bounds and the funds with enough returns are found across every partition,
+    as in finish_fund_data, and the partitions are then merged in fundid order
+    and streamed into the output files a chunk at a time.
+
+    Parameters
+    ----------
+    country_group_code : str
+        The country group code to load data for.
+    memory_limit : int
+        The ceiling, in bytes, on the estimated peak memory of the run.
+    currency_type, raw_ret_only, polation_method, strict_eq, exc_finre,
+    inv_targets, inc_agefilter, output_format, inplace, pooled_flows
+        As in process_fund_data.
+    spill_dir : str, default None
+        The directory to spill partitions into, within a temporary directory
+        that is deleted once the run ends. If None, the system's temporary
+        directory is used.
+
+    Returns
+    -------
+    flow_sketch : dict or None
+        As in process_fund_data.
+    """
+    if not partition_spill.spill_available():
+        raise ValueError("Out-of-core runs require pyarrow.")
+
+    process_id = os.getpid()
+    start_time = datetime.now()
+
+    num_partitions = max(1, -(-estimate_group_memory(country_group_code,
+                                                     currency_type, inplace)
+                              // memory_limit))
+    block_size = min(panel_reader.BLOCK_SIZE,
+                     max(memory_limit // SPILL_BLOCK_MULTIPLE, 2**20))
+    panel_dtypes = {f"{currency_type}-monthly-gross-returns": np.float64,
+                    f"{currency_type}-monthly-net-returns": np.float64,
+                    "monthly-net-assets": np.float64,
+                    "monthly-costs": np.float64,
+                    "monthly-morningstar-category": object}
+    outputs = ["main", "filt"] if inc_agefilter else ["main"]
+
+    spill_root = tempfile.mkdtemp(prefix=f"mf_{country_group_code}_",
+                                  dir=spill_dir)
+    try:
+        with telemetry.measure("spill", None):
+            for filename_base, exp_dtype in panel_dtypes.items():
+                partition_spill.spill_panel(
+                    data_filename(filename_base, country_group_code), spill_root,
+                    filename_base, exp_dtype,
+                    lambda fundids: fund_shards(pd.Series(fundids), num_partitions),
+                    num_partitions, block_size
+                )
+
+        elapsed_time = datetime.now() - start_time
+        print(f"Process {process_id} ({country_group_code}): Spilled {num_partitions} partitions ({elapsed_time} passed since process start)")
+
+        # Process each partition up to the point that fund flows are
+        # winsorised, keeping only what is needed to winsorise flows and
+        # select funds across the whole country group.
+        flows = []
+        categories = {}
+        retcounts = {output: [] for output in outputs}
+        fund_rows = {output: [] for output in outputs}
+        for partition in range(num_partitions):
+            df_mf_agg = process_fund_shard(
+                country_group_code, (partition, num_partitions), currency_type,
+                raw_ret_only, polation_method, strict_eq, exc_finre, inv_targets,
+                inc_agefilter, inplace=inplace, spill_dir=spill_root
+            )
+            flows.append(df_mf_agg.fund_flow.dropna().to_numpy())
+            for col in df_mf_agg.columns:
+                if df_mf_agg[col].dtype == "category":
+                    categories.setdefault(col, []).append(
+                        df_mf_agg[col].cat.categories.to_numpy()
+                    )
+
+            data = dict(zip(["main", "filt"],
+                            age_filter_fund_panel(df_mf_agg, inc_agefilter)))
+            del df_mf_agg
+            for output in outputs:
+                retcounts[output].append(fund_retcounts(data[output]))
+                fund_rows[output].append(
+                    data[output].groupby("fundid", observed=True).size()
+                )
+                partition_spill.spill_frame(
+                    data[output].reset_index(drop=True),
+                    os.path.join(spill_root, f"{output}_{partition}.arrow")
+                )
+            del data
+
+        # The flows and return counts of every partition together are those
+        # of an in-memory run, once the return counts are in fundid order.
+        flows = pd.Series(np.concatenate(flows))
+        if pooled_flows:
+            flow_sketch = quantile_sketch.summarise(flows)
+        else:
+            flow_sketch = None
+            lower, upper = flow_bounds(flows)
+        del flows
+        mature_fundids = dict(zip(["main", "filt"], mature_funds(*[
+            pd.concat(retcounts[output], ignore_index=True)
+              .astype({"fundid": str})
+              .sort_values(by="fundid", kind="stable")
+              .reset_index(drop=True)
+            for output in outputs
+        ])))
+
+        # Share categories across every partition, as unify_categories
+        # does for the shards of a sharded run.
+        category_dtypes = {
+            col: pd.CategoricalDtype(
+                pd.Index(np.concatenate(uniques)).unique().sort_values()
+            )
+            for col, uniques in categories.items()
+        }
+
+        folder_name = fund_data_foldername(currency_type, raw_ret_only,
+                                           polation_method, strict_eq,
+                                           exc_finre, inv_targets)
+        for output in outputs:
+            folder_dir = output_folder_dir(
+                folder_name + ("_age-filtered" if output == "filt" else "")
+            )
+            if not os.path.exists(folder_dir):
+                os.makedirs(folder_dir)
+
+            # Each chunk holds about as many rows as a partition.
+            max_rows = max(1, sum(counts.sum() for counts in fund_rows[output])
+                              // num_partitions)
+            paths = [os.path.join(spill_root, f"{output}_{partition}.arrow")
+                     for partition in range(num_partitions)]
+            with telemetry.measure("save", None), \
+                    fund_output.part_writer(folder_dir, country_group_code,
+                                            output_format) as write:
+                for dflist in partition_spill.merge_partition_rows(
+                        paths, fund_rows[output], max_rows):
+                    for df in dflist:
+                        for col, dtype in category_dtypes.items():
+                            df[col] = df[col].astype(dtype)
+                    df_chunk = (
+                        pd.concat(dflist, ignore_index=True)
+                          .sort_values(by="fundid", kind="stable")
+                    )
+                    if not pooled_flows:
+                        df_chunk.fund_flow = df_chunk.fund_flow.clip(
+                            lower=lower, upper=upper
+                        )
+                    df_chunk = select_mature_funds(df_chunk,
+                                                   mature_fundids[output])
+                    df_chunk["date"] = month_index.to_month_ends(df_chunk.date)
+                    write(df_chunk)
+    finally:
+        shutil.rmtree(spill_root, ignore_errors=True)
+
+    elapsed_time = datetime.now() - start_time
+    print(f"Process {process_id} ({country_group_code}): Data saved and processed ended ({elapsed_time} passed since process start)")
+
+    return flow_sketch
+
+def clip_fund_flows(country_group_code, lower, upper, currency_type, raw_ret_only,
+                    polation_method, strict_eq, exc_finre, inv_targets,
+                    inc_agefilter, output_format="csv"):
+    """
+    Winsorise the fund flows of the saved output of a pooled_flows run of
+    process_fund_data, as a final pass over the saved files (see
+    fund_output.clip_part). The fund data and the age-filtered fund data
+    are both clipped to the same bounds, as in refine_fund_panel.
+
+    Parameters
+    ----------
+    country_group_code : str
+        The country group code the data was saved for.
+    lower, upper : float
+        The winsorisation bounds, such as those of pooled_flow_bounds.
+    currency_type, raw_ret_only, polation_method, strict_eq, exc_finre,
+    inv_targets, inc_agefilter, output_format
+        As in process_fund_data.
+    """
+    folder_name = fund_data_foldername(currency_type, raw_ret_only,
+                                       polation_method, strict_eq, exc_finre,
+                                       inv_targets)
+    for suffix in (["", "_age-filtered"] if inc_agefilter else [""]):
+        fund_output.clip_part(output_folder_dir(folder_name + suffix),
+                              country_group_code, "fund_flow", lower, upper,
+                              output_format)
+
+def gross_return_observed(df_mfrets, raw_ret_only):
+    """
+    Return a boolean array that is True for each row of the returns data
+    (the "rets" panel of load_fund_panels) that has a gross return once
+    combine_fund_panels has filled in missing gross returns.
+    """
+    observed = df_mfrets.ret_gross_m.notna()
+    if not raw_ret_only:
+        ret_gross_m_recalculated = (
+            ((df_mfrets.ret_net_m/100 + 1)/(1-df_mfrets.rep_costs/100) - 1) * 100
+        )
+        observed |= ret_gross_m_recalculated.notna() | (df_mfrets.ret_net_m == 0)
+
+    return observed.to_numpy()
+
+def _lookup_by_id(ids, values_by_id, fill_value=month_index.LAST_MONTH):
+    """
+    Look up the value of each row's identifier in a Series indexed by
+    identifier, returning fill_value for identifiers that are missing
+    from the Series. The default fill is the month after every real
+    month, so that missing identifiers fall before no month.
+    """
+    ids = ids.astype("category")
+    by_code = values_by_id.reindex(ids.cat.categories.astype(object),
+                                   fill_value=fill_value).to_numpy()
+
+    # Missing identifiers have a code of -1, which selects the appended
+    # fill value.
+    return np.append(by_code, np.array([fill_value], dtype=by_code.dtype))[
+        ids.cat.codes.to_numpy()
+    ]
+
+def fund_history(panels, last_month):
+    """
+    Return the observed source data of a country group up to and
+    including last_month, for hashing by append_state.history_hash.
+    The fund information is limited to the secids observed by then, so
+    that secids first seen in later months do not change the history.
+    """
+    df_mfrets = panels["rets"]
+    value_names = ["ret_gross_m", "ret_net_m", "rep_costs"]
+    history = [
+        df_mfrets.loc[(df_mfrets.date <= last_month)
+                      & df_mfrets[value_names].notna().any(axis=1)],
+        panels["na"].loc[panels["na"].date <= last_month],
+        panels["cat"].loc[panels["cat"].date <= last_month],
+    ]
+
+    secids = pd.concat([df.secid for df in history]).unique()
+    history.append(panels["info"].loc[panels["info"].secid.isin(secids)])
+
+    return history
+
+def append_windows(panels, first_new, raw_ret_only, polation_method, strict_eq,
+                   exc_finre):
+    """
+    Find the funds with observations in newly appended months, and the
+    month from which each of them must be reprocessed.
+
+    A fund is cut at the latest month w before the new months at which
+    every secid of the fund either has no gross returns from w onwards,
+    has no gross returns until after w, or has a gross return, nonzero
+    net assets (if net assets are interpolated or extrapolated) and no
+    category classified as non-equity at w. Rows of the fund up to and
+    including w are then the same as in the previous run, and every row
+    after w is the same whether or not the source data before w is
+    included, since:
+
+    - trim_nans keeps each secid's rows from w (or from its first
+      return after w) in either case, and no secid gains new rows
+      before w;
+    - every interpolation group in polate_assets that spans w closes at
+      the net assets observed at w, and no later group reaches back
+      past it;
+    - no secid of the fund at w is classified as non-equity, so the
+      equity filter keeps each secid's return at w and trim_nans keeps
+      its rows from w in either case;
+    - lagged net assets (and so the weights of every secid) after w
+      depend only on rows from w onwards.
+
+    Lagged fund assets and fund flows are recalculated across the whole
+    fund once the old and new rows are joined, and ages are corrected by
+    the age offsets returned here. Funds without such a month are
+    reprocessed from the start of their history.
+
+    Parameters
+    ----------
+    panels : dict of DataFrame
+        The output of load_fund_panels for the whole history, including
+        the new months.
+    first_new : int
+        The month index of the first month after the last month of the
+        previous run.
+    raw_ret_only, polation_method, strict_eq, exc_finre
+        As in process_fund_data.
+
+    Returns
+    -------
+    cuts : Series
+        The cut month of every fund with observations in the new months,
+        indexed by fundid, or month_index.FIRST_MONTH for funds that must
+        be reprocessed from the start of their history.
+    age_offsets : Series
+        For each secid, the number of rows of the returns data before the
+        cut of its fund that combine_fund_panels keeps, which is the age
+        of the secid at the first row it keeps after the cut.
+    secid_ranks : Series
+        The position of each secid in the order that combine_fund_panels
+        groups secids in over the whole history, being the order of their
+        first gross returns. The reprocessed rows must be put back in
+        this order, as it sets the order in which secids are summed and
+        which secid comes first within each fund.
+    """
+    df_mfrets = panels["rets"]
+    value_names = ["ret_gross_m", "ret_net_m", "rep_costs"]
+
+    # Find the funds with any observation in the new months.
+    touched = pd.concat([
+        df_mfrets.loc[(df_mfrets.date >= first_new)
+                      & df_mfrets[value_names].notna().any(axis=1), "fundid"],
+        panels["na"].loc[panels["na"].date >= first_new, "fundid"],
+        panels["cat"].loc[panels["cat"].date >= first_new, "fundid"],
+    ]).dropna().astype(object).unique()
+
+    # Find the first and last month with a gross return for each secid.
+    # The returns data is sorted by date, so these are its first and last
+    # rows.
+    gross_observed = gross_return_observed(df_mfrets, raw_ret_only)
+    df_gross = df_mfrets.loc[gross_observed, PANEL_KEYS]
+    df_first = df_gross.drop_duplicates("secid")
+    df_last = df_gross.drop_duplicates("secid", keep="last")
+
+    # Find the secid-months before the new months at which a secid can be
+    # cut. Rows are matched through their encoded panel keys.
+    df_anchors = df_gross.loc[df_gross.date < first_new]
+    df_mfna = panels["na"]
+    df_mfcat = panels["cat"]
+
+    # Use the same equity classification as filter_equity_funds. Returns
+    # are kept unless some secid of the fund is classified as non-equity
+    # in that month, so missing classifications do not prevent a cut.
+    df_equity_categories = (
+        pd.read_csv("./data/mappings/morningstar_categories.csv")
+    )
+    equity_flag = effective_equity_flag(df_equity_categories, strict_eq,
+                                        exc_finre)
+    nonequity_categories = (
+        df_equity_categories.morningstar_category[equity_flag == 0]
+    )
+
+    codes, _ = encode_panel_keys([
+        df_anchors,
+        df_mfna.loc[df_mfna.net_assets.notna() & (df_mfna.net_assets != 0),
+                    PANEL_KEYS],
+        df_mfcat.loc[df_mfcat.morningstar_category.astype(object)
+                             .isin(nonequity_categories), PANEL_KEYS]
+    ])
+    is_anchor = ~np.isin(codes[0], codes[2])
+    if polation_method in ["interpolate", "extrapolate", "both"]:
+        is_anchor &= np.isin(codes[0], codes[1])
+    df_anchors = df_anchors.loc[is_anchor]
+
+    df_anchor_counts = (
+        df_anchors.groupby(["fundid", "date"], observed=True).size()
+                  .rename("anchors").reset_index()
+    )
+
+    # A fund can be cut at a month if every secid that has gross returns
+    # both at or before and at or after that month can be cut there.
+    # Count those secids at each candidate month by adding one at the
+    # first month of each secid and removing one after its last month.
+    df_events = pd.concat([
+        df_first[["fundid", "date"]].assign(change=1, candidate=False),
+        df_last[["fundid", "date"]].assign(change=-1, candidate=False),
+        df_anchor_counts.assign(change=0, candidate=True),
+    ], ignore_index=True)
+    df_events.loc[df_events.change == -1, "date"] += 1
+
+    # Candidates are sorted after the changes in the same month.
+    df_events = (
+        df_events.sort_values(by=["fundid", "date", "candidate"], kind="stable")
+                 .reset_index(drop=True)
+    )
+    df_events["active"] = (
+        df_events.groupby("fundid", observed=True).change.cumsum()
+    )
+
+    df_cuts = df_events.loc[df_events.candidate
+                            & (df_events.anchors == df_events.active)]
+    cuts = df_cuts.groupby("fundid", observed=True).date.max()
+    cuts.index = cuts.index.astype(object)
+    cuts = (
+        cuts.reindex(touched).fillna(month_index.FIRST_MONTH)
+            .astype(month_index.MONTH_DTYPE)
+    )
+
+    # Count the rows that each secid keeps before the cut of its fund.
+    # The returns data holds a row for every secid in every loaded month,
+    # so these are the rows from its first gross return up to the cut.
+    first_return = df_first.set_index(df_first.secid.astype(object)).date
+    dates = df_mfrets.date.to_numpy()
+    before_cut = (
+        (dates >= _lookup_by_id(df_mfrets.secid, first_return))
+        & (dates < _lookup_by_id(df_mfrets.fundid, cuts,
+                                 month_index.FIRST_MONTH))
+    )
+    age_offsets = df_mfrets.loc[before_cut].groupby("secid", observed=True).size()
+    age_offsets.index = age_offsets.index.astype(object)
+
+    secid_ranks = pd.Series(np.arange(len(df_first)),
+                            index=df_first.secid.astype(object))
+
+    return cuts, age_offsets, secid_ranks
+
+def tail_fund_panels(panels, cuts):
+    """
+    Keep only the rows of the panels of load_fund_panels that belong to
+    a fund in cuts and fall on or after the fund's cut month. The fund
+    information is kept whole.
+    """
+    tail = {"info": panels["info"]}
+    for name in ["rets", "na", "cat"]:
+        df = panels[name]
+        in_tail = df.date.to_numpy() >= _lookup_by_id(df.fundid, cuts)
+        tail[name] = df.loc[in_tail].reset_index(drop=True)
+
+    return tail
+
+def append_fund_data(country_group_code, currency_type, raw_ret_only,
+                     polation_method, strict_eq, exc_finre, inv_targets,
+                     inc_agefilter, output_format="csv",
+                     state_dir=append_state.STATE_DIR):
+    """
+    Process the fund data of one country group incrementally, reusing
+    the aggregated fund data of the previous run for every month that
+    newly appended months cannot change.
+
+    If the source data up to the last month of the previous run is
+    unchanged (see append_state), only the funds with observations in
+    the new months are reprocessed, each from the month chosen by
+    append_windows, and their new rows replace the old rows after that
+    month. Otherwise, or if there is no previous run with the same
+    options, the country group is rebuilt from its whole history. Either
+    way, fund flows are then winsorised across the whole country group
+    and the output of the country group is rewritten, as the
+    winsorisation bounds can change every row. The output is the same
+    as that of process_fund_data.
+
+    Parameters
+    ----------
+    country_group_code : str
+        The country group code to load data for.
+    currency_type, raw_ret_only, polation_method, strict_eq, exc_finre,
+    inv_targets, inc_agefilter, output_format
+        As in process_fund_data.
+    state_dir : str, default append_state.STATE_DIR
+        The directory that holds the state of each incremental run.
+    """
+    process_id = os.getpid()
+    start_time = datetime.now()
+
+    def log(message):
+        elapsed_time = datetime.now() - start_time
+        print(f"Process {process_id} ({country_group_code}): {message} ({elapsed_time} passed since process start)")
+
+    options = {"currency_type": currency_type, "raw_ret_only": raw_ret_only,
+               "polation_method": polation_method, "strict_eq": strict_eq,
+               "exc_finre": exc_finre, "inv_targets": inv_targets,
+               "inc_agefilter": inc_agefilter}
+    key = append_state.state_key(country_group_code, **options)
+
+    with telemetry.measure("load") as record:
+        panels = load_fund_panels(country_group_code, currency_type)
+        record["rows_out"] = telemetry.count_rows(panels)
+    log("Finished loading data")
+
+    last_month = max(panels[name].date.max() for name in ["rets", "na", "cat"])
+    mapping_key = append_state.file_hash("./data/mappings/morningstar_categories.csv")
+
+    # Only reuse the previous run if the history it was built from and
+    # the category mappings are unchanged.
+    cuts = None
+    meta, df_mf_agg_old = append_state.read_state(key, state_dir)
+    if meta is not None and meta["mapping"] == mapping_key:
+        old_last_month = month_index.to_months([meta["last_month"]])[0]
+        with telemetry.measure("history"):
+            history = append_state.history_hash(fund_history(panels,
+                                                             old_last_month))
+        if history == meta["history"]:
+            with telemetry.measure("windows") as record:
+                cuts, age_offsets, secid_ranks = append_windows(
+                    panels, old_last_month + 1, raw_ret_only,
+                    polation_method, strict_eq, exc_finre
+                )
+                record["rows_out"] = len(cuts)
+            log(f"Reprocessing {len(cuts)} funds with new observations")
+        else:
+            log("Source data before the new months has changed")
+
+    if cuts is None:
+        log("Rebuilding from the full history")
+        del df_mf_agg_old
+        tail = panels
+    elif len(cuts) > 0:
+        tail = tail_fund_panels(panels, cuts)
+    else:
+        tail = None
+
+    # The history hash of the state to be saved covers every month.
+    with telemetry.measure("history"):
+        last_month_end = month_index.to_month_ends([last_month])[0]
+        meta = {"last_month": last_month_end.isoformat(), "mapping": mapping_key,
+                "history": append_state.history_hash(fund_history(panels,
+                                                                  last_month))}
+    del panels
+
+    df_mf_agg = None
+    if tail is not None:
+        with telemetry.measure("combine", telemetry.count_rows(tail)) as record:
+            df_mf = combine_fund_panels(tail, raw_ret_only, inc_agefilter,
+                                        equity_filters=[(strict_eq, exc_finre)])
+            if cuts is not None:
+                # Restore the order of secids over the whole history, and
+                # their ages.
+                df_mf = df_mf.take(np.argsort(
+                    _lookup_by_id(df_mf.secid, secid_ranks, -1), kind="stable"
+                )).reset_index(drop=True)
+                if inc_agefilter:
+                    df_mf["age"] += _lookup_by_id(df_mf.secid, age_offsets, 0)
+            record["rows_out"] = len(df_mf)
+        del tail
+
+        with telemetry.measure("categorise", len(df_mf)) as record:
+            df_mf = categorise_fund_panel(df_mf, polation_method, inv_targets)
+            record["rows_out"] = len(df_mf)
+
+        with telemetry.measure("filter", len(df_mf)) as record:
+            df_mf = filter_equity_funds(df_mf, strict_eq, exc_finre)
+            record["rows_out"] = len(df_mf)
+
+        with telemetry.measure("aggregate", len(df_mf)) as record:
+            df_mf_agg = aggregate_fund_panel(df_mf, country_group_code,
+                                             polation_method, inv_targets,
+                                             inc_agefilter)
+            record["rows_out"] = len(df_mf_agg)
+        del df_mf
+        log("Finished aggregating funds")
+
+    if cuts is not None:
+        # Keep the old rows of each fund up to its cut, and the old rows of
+        # every fund without new observations, then add the new rows
+        # after each cut.
+        with telemetry.measure("splice", len(df_mf_agg_old)) as record:
+            df_parts = [
+                df_mf_agg_old.loc[~(df_mf_agg_old.date.to_numpy()
+                                    > _lookup_by_id(df_mf_agg_old.fundid, cuts))]
+                             .reset_index(drop=True)
+            ]
+            if df_mf_agg is not None:
+                df_parts.append(
+                    df_mf_agg.loc[df_mf_agg.date.to_numpy()
+                                  > _lookup_by_id(df_mf_agg.fundid, cuts)]
+                             .reset_index(drop=True)
+                )
+            del df_mf_agg_old
+
+            category_columns = [col for col in df_parts[0].columns
+                                if df_parts[0][col].dtype == "category"]
+            unify_categories(df_parts, category_columns)
+
+            df_mf_agg = (
+                pd.concat(df_parts, ignore_index=True)
+                  .sort_values(by=["fundid", "date"])
+                  .reset_index(drop=True)
+            )
+            del df_parts
+
+            calculate_fund_flows(df_mf_agg)
+            record["rows_out"] = len(df_mf_agg)
+    else:
+        df_mf_agg = df_mf_agg.reset_index(drop=True)
+
+    # Save the unwinsorised data for the next run before refine_fund_panel
+    # modifies it.
+    append_state.write_state(df_mf_agg, meta, key, state_dir)
+
+    with telemetry.measure("refine", len(df_mf_agg)) as record:
+        df_mf, df_mf_filt = refine_fund_panel(df_mf_agg, inc_agefilter)
+        record["rows_out"] = telemetry.count_rows([df_mf, df_mf_filt])
+
+    with telemetry.measure("save", record["rows_out"]):
+        save_fund_data(df_mf, df_mf_filt, fund_data_foldername(**options),
+                       country_group_code, output_format)
+
+    log("Data saved and processed ended")
+
+# The run options of process_fund_data, in the order that a sweep
+# branches on them. Each option is grouped under every option before it,
+# so each stage of the pipeline runs once per distinct value of the
+# options it depends on.
+SWEEP_STAGES = [
+    ("load", ["currency_type"]),
+    ("combine", ["raw_ret_only"]),
+    ("categorise", ["polation_method"]),
+    ("filter", ["strict_eq", "exc_finre"]),
+    ("aggregate", ["inv_targets"]),
+]
+
+def plan_sweep(option_sets):
+    """
+    Group a list of run option sets into a tree of shared pipeline
+    stages.
+
+    Parameters
+    ----------
+    option_sets : sequence of dict
+        Each dict holds a full set of process_fund_data keyword
+        arguments, excluding country_group_code.
+
+    Returns
+    -------
+    plan : dict
+        A nested dict with one level per stage of SWEEP_STAGES. Keys at
+        each level are tuples of that stage's option values, in the
+        order they first appear in option_sets. The leaves are lists of
+        the option sets that share every stage.
+    """
+    option_names = [name for _, names in SWEEP_STAGES for name in names]
+    option_names += ["inc_agefilter"]
+
+    plan = {}
+    for options in option_sets:
+        missing = [name for name in option_names if name not in options]
+        unknown = [name for name in options if name not in option_names]
+        if missing or unknown:
+            raise ValueError("Each option set must have exactly the options "
+                             + ", ".join(option_names) + ".")
+
+        node = plan
+        for depth, (_, names) in enumerate(SWEEP_STAGES):
+            key = tuple(options[name] for name in names)
+            default = [] if depth == len(SWEEP_STAGES) - 1 else {}
+            node = node.setdefault(key, default)
+
+        node.append(options)
+
+    return plan
+
+def _plan_options(node):
+    """Return every option set below a node of a sweep plan."""
+    if isinstance(node, list):
+        return node
+
+    return [options for child in node.values() for options in _plan_options(child)]
+
+def process_fund_data_sweep(country_group_code, option_sets, output_format="csv"):
+    """
+    Run process_fund_data for many sets of run options at once, sharing
+    the intermediate data between option sets wherever the options that
+    a stage depends on are the same.
+
+    Data is loaded and the returns merged once per currency type, the
+    remaining panels merged once per value of raw_ret_only, net assets
+    interpolated once per polation method, and the equity filter and
+    aggregation run once per distinct set of their options. The plan is
+    walked depth first, so only one branch of intermediate data is held
+    in memory at a time. The output of each option set is saved to the
+    same folder that process_fund_data would have saved it to.
+
+    Parameters
+    ----------
+    country_group_code : str
+        The country group code to load data for.
+    option_sets : sequence of dict
+        Each dict holds a full set of process_fund_data keyword
+        arguments, excluding country_group_code.
+    output_format : {"csv", "arrow", "parquet"}, default "csv"
+        The format to save the output in, as in process_fund_data.
+    """
+    process_id = os.getpid()
+    start_time = datetime.now()
+    plan = plan_sweep(option_sets)
+
+    def log(message):
+        elapsed_time = datetime.now() - start_time
+        print(f"Process {process_id} ({country_group_code}): {message} ({elapsed_time} passed since process start)")
+
+    # The age and investment target columns are only carried through
+    # the shared stages if some option set below them needs them.
+    for (currency_type,), load_node in plan.items():
+        panels = load_fund_panels(country_group_code, currency_type)
+        log(f"Finished loading {currency_type} data")
+
+        for (raw_ret_only,), combine_node in load_node.items():
+            with_age = any(options["inc_agefilter"]
+                           for options in _plan_options(combine_node))
+            # Only the funds that every equity filter below would remove
+            # are dropped early.
+            equity_filters = list(dict.fromkeys(
+                (options["strict_eq"], options["exc_finre"])
+                for options in _plan_options(combine_node)
+            ))
+            df_mf = combine_fund_panels(panels, raw_ret_only, with_age,
+                                        equity_filters=equity_filters)
+            log(f"Finished merging data (raw_ret_only={raw_ret_only})")
+
+            for (polation_method,), categorise_node in combine_node.items():
+                with_targets = any(options["inv_targets"]
+                                   for options in _plan_options(categorise_node))
+                df_mf_cat = categorise_fund_panel(df_mf, polation_method,
+                                                  with_targets)
+
+                for (strict_eq, exc_finre), filter_node in categorise_node.items():
+                    df_mf_anyeq = filter_equity_funds(df_mf_cat, strict_eq,
+                                                      exc_finre)
+
+                    for (inv_targets,), leaf in filter_node.items():
+                        # Option sets that differ only in inc_agefilter
+                        # share an aggregation, as the unfiltered output
+                        # does not depend on it.
+                        inc_agefilter = any(options["inc_agefilter"]
+                                            for options in leaf)
+                        df_mf_out, df_mf_filt = refine_fund_panel(
+                            aggregate_fund_panel(df_mf_anyeq, country_group_code,
+                                                 polation_method, inv_targets,
+                                                 inc_agefilter),
+                            inc_agefilter
+                        )
+
+                        save_fund_data(df_mf_out, df_mf_filt,
+                                       fund_data_foldername(**leaf[0]),
+                                       country_group_code, output_format)
+                        log("Saved "+fund_data_foldername(**leaf[0]))
+
+                    # Clear unused memory
+                    del df_mf_anyeq
+
+                del df_mf_cat
+
+            del df_mf
+
+        del panels
+
+    log("Sweep complete")
+
+# The run options and output format used when this script is run directly.
+# Typed "arrow" output is opt-in. bundle-mf-data.jl reads arrow or csv
+# output, but not parquet.
+RUN_OPTIONS = {"currency_type": "usd", "raw_ret_only": True,
+               "polation_method": "interpolate", "strict_eq": True,
+               "exc_finre": False, "inv_targets": True, "inc_agefilter": True}
+OUTPUT_FORMAT = "csv"
+
+# Whether a direct run only reprocesses the months appended since the
+# previous direct run (see append_fund_data). Incremental runs are not
+# split into shards.
+INCREMENTAL = False
+
+# Whether the stages of a direct run consume their input rather than
+# copying it (see process_fund_data), which lets more country groups run
+# at once within MEMORY_BUDGET. Ignored for incremental runs. Off by
+# default, as its peak-memory contract has only been measured on
+# synthetic data.
+INPLACE = False
+
+# The engine that runs the stages of a direct run (see process_fund_data).
+# Polars runs are not split into shards, and cannot be incremental.
+ENGINE = "pandas"
+
+# The memory ceiling, in bytes, of each country group in a direct run. A
+# group estimated to need more runs out of core within the ceiling (see
+# process_fund_data) rather than being split into shards. None disables
+# out-of-core runs. Ignored for incremental and polars runs.
+MEMORY_LIMIT = None
+
+# Whether a direct run winsorises fund flows at pooled percentiles across
+# every country group rather than within each group (see pooled_flows in
+# process_fund_data). Each group is saved unwinsorised and then clipped
+# once every group has finished. Ignored for incremental runs.
+POOLED_FLOWS = False
+
+# Whether the telemetry report of a direct run includes the peak memory
+# allocated through Python by each stage and call. This slows the run
+# down considerably.
+TRACE_MEMORY = False
+
+def group_memory_limit(country_group_code):
+    """
+    Return the memory ceiling that a direct run of a country group runs
+    out of core within, or None if it runs in memory.
+    """
+    if MEMORY_LIMIT is None or INCREMENTAL or ENGINE != "pandas":
+        return None
+
+    memory = estimate_group_memory(country_group_code, inplace=INPLACE)
+    return MEMORY_LIMIT if memory > MEMORY_LIMIT else None
+
+def run_job(job):
+    """
+    Run one scheduled job, being either a whole country group (if shard
+    is None) or one shard of a country group. A whole country group
+    returns the output of process_fund_data.
+    """
+    process_id, shard = job
+    if shard is None:
+        return process_fund_data(COUNTRY_GROUPS[process_id], **RUN_OPTIONS,
+                                 output_format=OUTPUT_FORMAT,
+                                 incremental=INCREMENTAL,
+                                 inplace=INPLACE and not INCREMENTAL,
+                                 engine=ENGINE,
+                                 memory_limit=group_memory_limit(
+                                     COUNTRY_GROUPS[process_id]
+                                 ),
+                                 pooled_flows=POOLED_FLOWS and not INCREMENTAL)
+
+    return process_fund_shard(COUNTRY_GROUPS[process_id], shard, **RUN_OPTIONS,
+                              inplace=INPLACE)
+
+def process_fund_data_wrapped(job):
+    """
+    Run one scheduled job with telemetry on, returning the output of
+    the job and its telemetry records.
+    """
+    return telemetry.run_collected(
+        run_job, job, trace_memory=TRACE_MEMORY,
+        job_labels={"country_group": COUNTRY_GROUPS[job[0]]}
     )
 
 if __name__ == "__main__":
     main_start_time = datetime.now()
-    num_groups = len(COUNTRY_GROUPS)
-    
-    with multiprocessing.Pool(processes=4) as pool:
-        pool.map(process_fund_data_wrapped, range(num_groups))
+    telemetry.start(TRACE_MEMORY)
+
+    # Country group codes given as arguments (as run-pipeline.py passes
+    # them) restrict the run to those groups.
+    unknown_codes = set(sys.argv[1:]) - set(COUNTRY_GROUPS.values())
+    if unknown_codes:
+        raise ValueError(f"Unknown country groups: {sorted(unknown_codes)}.")
+    if sys.argv[1:] and POOLED_FLOWS and not INCREMENTAL:
+        raise ValueError("Pooled fund flows need every country group to be run.")
+    process_ids = [process_id
+                   for process_id, country_group_code in COUNTRY_GROUPS.items()
+                   if not sys.argv[1:] or country_group_code in sys.argv[1:]]
+
+    # Estimate the peak memory of each country group so that the largest
+    # groups start first, and so that no more groups run at once than
+    # fit within the memory budget. Large groups are split into shards of
+    # funds, which are scheduled as separate jobs, unless they run out of
+    # core.
+    job_memory = {}
+    for process_id in process_ids:
+        country_group_code = COUNTRY_GROUPS[process_id]
+        memory_limit = group_memory_limit(country_group_code)
+        if memory_limit is not None:
+            job_memory[(process_id, None)] = memory_limit
+            continue
+
+        if INCREMENTAL or ENGINE == "polars":
+            num_shards = 1
+        else:
+            num_shards = GROUP_SHARDS.get(country_group_code, 1)
+        memory = estimate_group_memory(
+            country_group_code, inplace=INPLACE and not INCREMENTAL
+        )
+
+        # Shards only load their own funds with the panel reader, and
+        # otherwise load the whole group before selecting them.
+        if panel_reader.reader_available():
+            memory //= num_shards
+        if num_shards == 1:
+            job_memory[(process_id, None)] = memory
+        else:
+            for shard_index in range(num_shards):
+                job_memory[(process_id, (shard_index, num_shards))] = memory
+
+    shard_aggs = {}
+    flow_sketches = {}
+    failed_groups = set()
+    for (process_id, shard), result, error in scheduler.imap_budgeted(
+            process_fund_data_wrapped, job_memory, workers=NUM_WORKERS,
+            memory_budget=MEMORY_BUDGET):
+        country_group_code = COUNTRY_GROUPS[process_id]
+        if error is not None:
+            telemetry.extend(getattr(error, "telemetry_records", []))
+            if shard is not None:
+                country_group_code += f" (shard {shard[0] + 1} of {shard[1]})"
+            print(f"Country group {country_group_code} failed: {error!r}")
+            failed_groups.add(process_id)
+            continue
+
+        result, records = result
+        telemetry.extend(records)
+
+        # Once every shard of a group is done, winsorise and save the
+        # combined group.
+        if shard is not None:
+            shard_aggs.setdefault(process_id, {})[shard[0]] = result
+            if (len(shard_aggs[process_id]) < shard[1]
+                    or process_id in failed_groups):
+                continue
+
+            with telemetry.labels(country_group=country_group_code):
+                result = finish_fund_data(country_group_code,
+                                          [shard_aggs[process_id][shard_index]
+                                           for shard_index in range(shard[1])],
+                                          **RUN_OPTIONS,
+                                          output_format=OUTPUT_FORMAT,
+                                          pooled_flows=POOLED_FLOWS)
+            del shard_aggs[process_id]
+
+        if result is not None:
+            flow_sketches[process_id] = result
+
+        print(f"Country group {country_group_code} complete ({datetime.now() - main_start_time} passed since start)")
+
+    # Winsorise the saved flows of every group at the percentiles of the
+    # flows of every group together. Only the summaries of each group's
+    # flows are merged, never the groups' data.
+    if flow_sketches:
+        lower, upper = pooled_flow_bounds(list(flow_sketches.values()))
+        print(f"Pooled fund flow bounds: {lower} to {upper}")
+        for process_id in flow_sketches:
+            with telemetry.labels(country_group=COUNTRY_GROUPS[process_id]), \
+                    telemetry.measure("clip", None):
+                clip_fund_flows(COUNTRY_GROUPS[process_id], lower, upper,
+                                **RUN_OPTIONS, output_format=OUTPUT_FORMAT)
+
+    # Every group has now saved its part, so rebuild each manifest once
+    # more in case parallel groups raced to rebuild it.
+    if OUTPUT_FORMAT != "csv":
+        folder_name = fund_data_foldername(**RUN_OPTIONS)
+        for suffix in ["", "_age-filtered"]:
+            folder_dir = output_folder_dir(folder_name + suffix)
+            if os.path.exists(folder_dir):
+                fund_output.write_manifest(folder_dir)
+
+    # Write the telemetry of every stage and call across every worker as
+    # a single report for the run.
+    report_paths = telemetry.write_report(telemetry.stop())
+    print(f"Telemetry saved to {report_paths[0]} and {report_paths[1]}")
 
-    print(f"All processes complete in {datetime.now() - main_start_time}")
\ No newline at end of file
+    print(f"All processes complete in {datetime.now() - main_start_time}")
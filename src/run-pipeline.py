@@ -0,0 +1,177 @@
+import importlib.util
+import os
+import sys
+from datetime import datetime
+
+from shared import pipeline
+
+# Run every out-of-date script of the pipeline in dependency order (see
+# _notes/Notes/Script Run Order.ipynb and shared/pipeline.py), running
+# independent branches at once. Run from the root of the repository, as
+# every other script is. The names of any stages given as arguments are
+# run even if they are up to date.
+#
+# process-mf-data.py is split into its country groups, so that only the
+# groups whose domicile-grouped files have changed are rebuilt. It is
+# run as a whole if it pools fund flows across groups (POOLED_FLOWS).
+#
+# estimate-decay-coefficient.jl and analyse-betas.ipynb are left out, as
+# neither saves anything that a later script reads (the decay coefficient
+# is set by hand in CommonConstants.jl).
+
+# process-mf-data.py cannot be imported by name, so load it from its path.
+_spec = importlib.util.spec_from_file_location(
+    "process_mf_data", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    "process-mf-data.py")
+)
+pmf = importlib.util.module_from_spec(_spec)
+sys.modules["process_mf_data"] = pmf
+_spec.loader.exec_module(pmf)
+
+SCRIPT_DIR = "src"
+
+# The commands that run Julia and Python scripts.
+JULIA_COMMAND = ["julia", "--threads=auto"]
+PYTHON_COMMAND = [sys.executable]
+
+# The maximum number of scripts to run at once. process-mf-data.py runs
+# several country groups at once by itself (see NUM_WORKERS there).
+PIPELINE_WORKERS = 2
+
+POST_PROCESSING_DIR = "data/mutual-funds/post-processing"
+
+def script_stage(script, deps, inputs, outputs):
+    """
+    Return the stage that runs one script, which also depends on the
+    script itself and on the shared files it includes.
+    """
+    script_path = os.path.join(SCRIPT_DIR, script)
+    if script.endswith(".jl"):
+        command = JULIA_COMMAND + [script_path]
+        shared_files = os.path.join(SCRIPT_DIR, "shared", "*.jl")
+    else:
+        command = PYTHON_COMMAND + [script_path]
+        shared_files = os.path.join(SCRIPT_DIR, "shared", "*.py")
+
+    return {"command": command, "deps": deps,
+            "inputs": [script_path, shared_files] + inputs, "outputs": outputs}
+
+def options_outputs(subfolder):
+    """
+    Return the pattern of one subfolder of every options folder in the
+    post-processing folder.
+    """
+    return [os.path.join(POST_PROCESSING_DIR, "*", subfolder)]
+
+def fund_data_stage():
+    """
+    Return the stage that runs process-mf-data.py, split into a unit for
+    each country group unless fund flows are pooled across groups.
+    """
+    currency_type = pmf.RUN_OPTIONS["currency_type"]
+    folder_name = pmf.fund_data_foldername(**pmf.RUN_OPTIONS)
+    suffixes = ["", "_age-filtered"] if pmf.RUN_OPTIONS["inc_agefilter"] else [""]
+
+    units = {}
+    for country_group_code in pmf.COUNTRY_GROUPS.values():
+        units[country_group_code] = (
+            pmf.fund_source_files(country_group_code, currency_type),
+            [os.path.join(pmf.output_folder_dir(folder_name + suffix),
+                          f"mf_{country_group_code}.*")
+             for suffix in suffixes]
+        )
+
+    stage = script_stage("process-mf-data.py", ["group-raw-mf-data-by-country.jl"],
+                         ["data/mappings/morningstar_categories.csv"], [])
+    if pmf.POOLED_FLOWS and not pmf.INCREMENTAL:
+        for inputs, outputs in units.values():
+            stage["inputs"] += inputs
+            stage["outputs"] += outputs
+    else:
+        stage["units"] = units
+
+    return stage
+
+PIPELINE_STAGES = {
+    "group-raw-mf-data-by-country.jl": script_stage(
+        "group-raw-mf-data-by-country.jl", [],
+        ["data/mutual-funds/raw"],
+        ["data/mutual-funds/domicile-grouped"]
+    ),
+    "refine-raw-currency-data.jl": script_stage(
+        "refine-raw-currency-data.jl", [],
+        ["data/currencies/raw"],
+        ["data/currencies/combined"]
+    ),
+    "refine-raw-equity-factors.jl": script_stage(
+        "refine-raw-equity-factors.jl", [],
+        ["data/equities/raw/factors"],
+        ["data/equities/factor-series/equity_factors.arrow"]
+    ),
+    # aggregate-mf-info.jl also reads the bundled fund data of the default
+    # options when it is loaded.
+    "aggregate-mf-info.jl": script_stage(
+        "aggregate-mf-info.jl",
+        ["group-raw-mf-data-by-country.jl", "bundle-mf-data.jl"],
+        ["data/mutual-funds/domicile-grouped/info",
+         os.path.join(POST_PROCESSING_DIR, "*", "main", "fund_data.arrow")],
+        ["data/mutual-funds/info"]
+    ),
+    "process-mf-data.py": fund_data_stage(),
+    "build-currency-factors.jl": script_stage(
+        "build-currency-factors.jl", ["refine-raw-currency-data.jl"],
+        ["data/currencies/combined/currency_rates.arrow"],
+        ["data/currencies/factor-series"]
+    ),
+    "process-market-data.jl": script_stage(
+        "process-market-data.jl", ["refine-raw-currency-data.jl"],
+        ["data/equities/raw/country_market_data.csv",
+         "data/equities/raw/usd_riskfree.csv",
+         "data/currencies/combined/currency_rates.arrow"],
+        ["data/equities/factor-series/unhedged_global_mkt.arrow"]
+    ),
+    "bundle-mf-data.jl": script_stage(
+        "bundle-mf-data.jl", ["process-mf-data.py"],
+        options_outputs("initialised") + ["data/mappings/currency_to_country.csv"],
+        options_outputs("main")
+    ),
+    "regress-fund-returns.jl": script_stage(
+        "regress-fund-returns.jl",
+        ["aggregate-mf-info.jl", "bundle-mf-data.jl", "build-currency-factors.jl",
+         "process-market-data.jl", "refine-raw-equity-factors.jl"],
+        options_outputs("main") + ["data/currencies/factor-series",
+                                   "data/equities/factor-series"],
+        options_outputs("factor-betas")
+    ),
+    "decompose-fund-returns.jl": script_stage(
+        "decompose-fund-returns.jl", ["regress-fund-returns.jl"],
+        options_outputs("main") + options_outputs("factor-betas")
+        + ["data/currencies/factor-series", "data/equities/factor-series"],
+        options_outputs("decompositions")
+    ),
+    "time-weight-return-components.jl": script_stage(
+        "time-weight-return-components.jl", ["decompose-fund-returns.jl"],
+        options_outputs("decompositions"),
+        options_outputs("weighted-decompositions")
+    ),
+    "regress-fund-flows.jl": script_stage(
+        "regress-fund-flows.jl", ["time-weight-return-components.jl"],
+        options_outputs("main") + options_outputs("weighted-decompositions")
+        + ["data/mutual-funds/info"],
+        options_outputs("flow-betas")
+    ),
+}
+
+if __name__ == "__main__":
+    start_time = datetime.now()
+
+    unknown_stages = set(sys.argv[1:]) - set(PIPELINE_STAGES)
+    if unknown_stages:
+        raise ValueError(f"Unknown stages: {sorted(unknown_stages)}.")
+
+    outcomes = pipeline.run_stages(PIPELINE_STAGES, workers=PIPELINE_WORKERS,
+                                   force=sys.argv[1:])
+
+    for stage in PIPELINE_STAGES:
+        print(f"{stage:<36} {outcomes[stage]}")
+    print(f"Pipeline complete in {datetime.now() - start_time}")
@@ -327,7 +327,19 @@ function load_data_in_parts(dirstring; select=nothing)
 
     for file in readdir(dirstring)
         filestring = joinpath(dirstring, file)
-        file_data = CSV.read(filestring, DataFrame, select=select)
+        if endswith(file, ".arrow")
+            file_data = DataFrame(Arrow.Table(filestring))
+            !isnothing(select) && select!(file_data, select)
+        elseif endswith(file, ".csv")
+            file_data = CSV.read(filestring, DataFrame, select=select)
+        elseif file == "manifest.json" || endswith(file, ".tmp")
+            # Skip the manifest of typed parts and any partly written part.
+            continue
+        else
+            # Parquet parts, among others, cannot be read here. Save output
+            # for the Julia scripts as arrow or csv instead.
+            error("Cannot read part $filestring. Only .arrow and .csv parts are supported.")
+        end
         push!(output_data, file_data)
     end
 
@@ -0,0 +1,173 @@
+"""
+Saved state for the incremental (monthly append) mode of
+process-mf-data.py.
+
+Each month the source files gain a new column of observations, while
+the history before it is usually unchanged. An incremental run keeps the
+aggregated fund data of the previous run (before fund flows are
+winsorised) along with a hash of the history it was built from. The
+next run checks that the history up to the previous run's last month
+still hashes the same. If so, only the funds with new observations are
+reprocessed, and only from a point late enough in their history that
+the rows before it cannot change. Otherwise the whole country group is
+rebuilt.
+
+The state of each country group and set of run options is stored as
+one uncompressed Arrow IPC file plus a small json manifest that is
+written last, as in stage_cache.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from shared import load_cache
+
+try:
+    import pyarrow
+    import pyarrow.feather as feather
+except ImportError:
+    pyarrow = None
+    feather = None
+
+STATE_DIR = "data/mutual-funds/cache/append"
+
+# Bump this whenever the layout of the saved state or the output of the
+# pipeline changes so that any state written by older code is ignored.
+STATE_VERSION = 2
+
+def state_available():
+    """Return True if the optional pyarrow dependency is installed."""
+    return feather is not None
+
+def state_key(country_group_code, **options):
+    """Hash a country group code and the run options of its output."""
+    return load_cache._hash({"version": STATE_VERSION,
+                             "country_group_code": country_group_code,
+                             "options": options})
+
+def _manifest_path(key, state_dir):
+    return os.path.join(state_dir, f"{key}.json")
+
+def _data_path(key, state_dir):
+    return os.path.join(state_dir, f"{key}.arrow")
+
+def history_hash(dflist):
+    """
+    Hash the rows of a list of DataFrames, regardless of their order.
+
+    Rows are hashed individually and the hashes summed, so that the
+    result does not depend on the order the source files list their
+    rows in. Categorical columns are hashed by their values, not their
+    codes.
+
+    Parameters
+    ----------
+    dflist : sequence of DataFrame
+
+    Returns
+    -------
+    key : str
+    """
+    table_hashes = []
+    for df in dflist:
+        row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+        table_hashes.append([list(df.columns),
+                             int(row_hashes.sum(dtype=np.uint64))])
+
+    return load_cache._hash(table_hashes)
+
+def file_hash(filename):
+    """
+    Hash the contents of a file, such as the category mappings, which
+    unlike load_cache.source_key does not change when the file is only
+    copied or touched.
+    """
+    with open(filename, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()[:16]
+
+def read_state(key, state_dir=STATE_DIR):
+    """
+    Load the saved state of a country group and set of run options.
+
+    Parameters
+    ----------
+    key : str
+        The state key, as returned by state_key.
+    state_dir : str, default STATE_DIR
+        The directory that holds the saved state.
+
+    Returns
+    -------
+    meta : dict or None
+        The metadata saved with the state, or None if there is no
+        complete state.
+    df_mf_agg : DataFrame or None
+        The saved aggregated fund data.
+    """
+    if not state_available():
+        return None, None
+
+    manifest_path = _manifest_path(key, state_dir)
+    data_path = _data_path(key, state_dir)
+    if not (os.path.exists(manifest_path) and os.path.exists(data_path)):
+        return None, None
+
+    with open(manifest_path) as f:
+        meta = json.load(f)
+
+    df_mf_agg = feather.read_table(data_path).to_pandas()
+
+    # Restore NaN for missing strings, as in load_cache.
+    for col in df_mf_agg.columns[df_mf_agg.dtypes == object]:
+        df_mf_agg[col] = df_mf_agg[col].fillna(np.nan)
+
+    return meta, df_mf_agg
+
+def write_state(df_mf_agg, meta, key, state_dir=STATE_DIR):
+    """
+    Save the aggregated fund data and metadata of a run, replacing any
+    earlier state with the same key.
+
+    Parameters
+    ----------
+    df_mf_agg : DataFrame
+        The aggregated fund data, before fund flows are winsorised.
+    meta : dict
+        Json-serialisable metadata, such as the last month of the
+        source data and the hash of its history.
+    key : str
+        The state key, as returned by state_key.
+    state_dir : str, default STATE_DIR
+        The directory that holds the saved state.
+
+    Returns
+    -------
+    written : bool
+        True if the state was written.
+    """
+    if not state_available():
+        return False
+
+    os.makedirs(state_dir, exist_ok=True)
+
+    # Remove the old manifest first, so that the old manifest is never
+    # read alongside the new data if the run stops part way through.
+    manifest_path = _manifest_path(key, state_dir)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    data_path = _data_path(key, state_dir)
+    tmp_path = f"{data_path}.{os.getpid()}.tmp"
+    table = pyarrow.Table.from_pandas(df_mf_agg, preserve_index=False)
+    feather.write_feather(table, tmp_path, compression="uncompressed")
+    os.replace(tmp_path, data_path)
+
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, manifest_path)
+
+    return True
@@ -0,0 +1,311 @@
+"""
+Typed, partitioned output files for process-mf-data.py.
+
+process_fund_data saves one file per country group into each
+post-processing folder, which bundle-mf-data.jl then concatenates. As
+well as csv, this module can save those parts as compressed Arrow IPC
+or Parquet files, which keep their column types (dates, categories and
+floats) and can be memory mapped or concatenated without parsing text.
+The Julia scripts read csv and Arrow parts only, so Parquet parts are
+only for reading from Python.
+
+Alongside typed parts, each folder holds a manifest.json listing every
+part in the folder, its country group and its row count. The manifest
+is rebuilt from the part files themselves whenever a part is written.
+Processes that save parts into the same folder at the same time can
+race to rebuild it, so a parallel run should call write_manifest once
+more after every part has been saved.
+"""
+import contextlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.feather as feather
+    import pyarrow.ipc
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+
+OUTPUT_FORMATS = {"csv": ".csv", "arrow": ".arrow", "parquet": ".parquet"}
+
+MANIFEST_NAME = "manifest.json"
+
+# The compression codec used for typed parts. Arrow.jl can read zstd
+# compressed Arrow IPC files.
+COMPRESSION = "zstd"
+
+# The number of rows of a csv part read at a time when it is clipped.
+CSV_CHUNK_ROWS = 1_000_000
+
+def part_path(folder_dir, country_group_code, output_format):
+    """Return the path of the part for one country group."""
+    return os.path.join(folder_dir,
+                        f"mf_{country_group_code}"
+                        + OUTPUT_FORMATS[output_format])
+
+def _to_table(df):
+    """
+    Convert a DataFrame to an Arrow table, storing datetime columns as
+    dates, since every date in the fund data is a month end.
+    """
+    table = pyarrow.Table.from_pandas(df, preserve_index=False)
+    for i, field in enumerate(table.schema):
+        if pyarrow.types.is_timestamp(field.type):
+            table = table.set_column(i, field.name,
+                                     table.column(i).cast(pyarrow.date32()))
+
+    return table
+
+def write_part(df, folder_dir, country_group_code, output_format="csv"):
+    """
+    Save the fund data of one country group into a post-processing
+    folder, replacing any part for that group saved in another format.
+
+    Parameters
+    ----------
+    df : DataFrame
+        The data to be saved.
+    folder_dir : str
+        The folder to save the part into. It must already exist.
+    country_group_code : str
+        The country group that the data belongs to.
+    output_format : {"csv", "arrow", "parquet"}, default "csv"
+        The format of the saved part. Typed formats also update the
+        folder's manifest.
+
+    Returns
+    -------
+    path : str
+        The path of the saved part.
+    """
+    _check_format(output_format)
+
+    path = part_path(folder_dir, country_group_code, output_format)
+
+    # Write to a temporary file first so that a reader never sees a
+    # partly written part.
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if output_format == "csv":
+        df.to_csv(tmp_path, index=False)
+    elif output_format == "arrow":
+        feather.write_feather(_to_table(df), tmp_path, compression=COMPRESSION)
+    else:
+        parquet.write_table(_to_table(df), tmp_path, compression=COMPRESSION)
+    _replace_part(tmp_path, folder_dir, country_group_code, output_format)
+
+    return path
+
+@contextlib.contextmanager
+def part_writer(folder_dir, country_group_code, output_format="csv"):
+    """
+    Save the fund data of one country group into a post-processing
+    folder chunk by chunk, so that it never needs to be held in memory
+    at once. The saved part is the same as if the chunks were
+    concatenated and saved with write_part, and only replaces an
+    earlier part once every chunk has been written.
+
+    Parameters are as in write_part, without the data.
+
+    Yields
+    ------
+    write : callable
+        A function that appends one DataFrame to the part. Every chunk
+        must have the same columns and types, including the categories
+        of categorical columns, and at least one chunk must be written.
+    """
+    _check_format(output_format)
+
+    path = part_path(folder_dir, country_group_code, output_format)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    writers = []
+
+    def write(df):
+        if output_format == "csv":
+            df.to_csv(tmp_path, index=False, header=not writers,
+                      mode="a" if writers else "w")
+            writers.append(None)
+            return
+
+        table = _to_table(df)
+        if not writers:
+            if output_format == "arrow":
+                writers.append(pyarrow.ipc.new_file(
+                    tmp_path, table.schema,
+                    options=pyarrow.ipc.IpcWriteOptions(compression=COMPRESSION)
+                ))
+            else:
+                writers.append(parquet.ParquetWriter(tmp_path, table.schema,
+                                                     compression=COMPRESSION))
+        writers[0].write_table(table)
+
+    try:
+        yield write
+    except BaseException:
+        if writers and writers[0] is not None:
+            writers[0].close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    if not writers:
+        raise ValueError("No data was written to the part.")
+    if writers[0] is not None:
+        writers[0].close()
+    _replace_part(tmp_path, folder_dir, country_group_code, output_format)
+
+def clip_part(folder_dir, country_group_code, column, lower, upper,
+              output_format="csv"):
+    """
+    Clip one numeric column of a saved part to bounds, leaving every other
+    column as it was saved.
+
+    Csv parts are rewritten text for text, replacing only the values that
+    lie outside the bounds, so that no other value is re-formatted. Typed
+    parts are clipped column-wise in Arrow. Missing values stay missing.
+
+    Parameters
+    ----------
+    folder_dir, country_group_code, output_format
+        As in write_part. The part must already exist in this format.
+    column : str
+        The column to clip.
+    lower, upper : float
+        The bounds to clip the column to.
+
+    Returns
+    -------
+    path : str
+        The path of the clipped part.
+    """
+    _check_format(output_format)
+
+    path = part_path(folder_dir, country_group_code, output_format)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        if output_format == "csv":
+            # Read every column as text, so that only clipped values are
+            # written differently.
+            chunks = pd.read_csv(path, dtype=str, keep_default_na=False,
+                                 na_filter=False, chunksize=CSV_CHUNK_ROWS)
+            for i, df in enumerate(chunks):
+                values = df[column].replace("", np.nan).astype(np.float64)
+                df.loc[values < lower, column] = repr(float(lower))
+                df.loc[values > upper, column] = repr(float(upper))
+                df.to_csv(tmp_path, index=False, header=i == 0,
+                          mode="a" if i else "w")
+        else:
+            if output_format == "arrow":
+                table = feather.read_table(path, memory_map=True)
+            else:
+                table = parquet.read_table(path)
+
+            i = table.schema.get_field_index(column)
+            clipped = pyarrow.compute.min_element_wise(
+                pyarrow.compute.max_element_wise(table.column(i), lower,
+                                                 skip_nulls=False),
+                upper, skip_nulls=False
+            )
+            table = table.set_column(i, table.schema.field(i), clipped)
+
+            if output_format == "arrow":
+                feather.write_feather(table, tmp_path, compression=COMPRESSION)
+            else:
+                parquet.write_table(table, tmp_path, compression=COMPRESSION)
+            del table
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _replace_part(tmp_path, folder_dir, country_group_code, output_format)
+
+    return path
+
+def _check_format(output_format):
+    """Raise a ValueError if an output format cannot be written."""
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("output_format must be 'csv', 'arrow' or 'parquet'.")
+
+    if output_format != "csv" and pyarrow is None:
+        raise ValueError(f"output_format '{output_format}' requires pyarrow.")
+
+def _replace_part(tmp_path, folder_dir, country_group_code, output_format):
+    """
+    Move a fully written part into place, removing any part for the
+    same group in another format, and update the folder's manifest.
+    """
+    path = part_path(folder_dir, country_group_code, output_format)
+    os.replace(tmp_path, path)
+
+    # A part saved in another format by an earlier run would otherwise be
+    # read alongside this one.
+    for other_format in OUTPUT_FORMATS:
+        other_path = part_path(folder_dir, country_group_code, other_format)
+        if other_format != output_format and os.path.exists(other_path):
+            os.remove(other_path)
+
+    # Csv parts are not listed in the manifest, but replacing a typed part
+    # with a csv part must remove it from the manifest.
+    if pyarrow is not None and (
+            output_format != "csv"
+            or os.path.exists(os.path.join(folder_dir, MANIFEST_NAME))):
+        write_manifest(folder_dir)
+
+def _count_rows(path):
+    """Return the number of rows in a typed part from its metadata."""
+    if path.endswith(OUTPUT_FORMATS["parquet"]):
+        return parquet.ParquetFile(path).metadata.num_rows
+
+    with pyarrow.memory_map(path) as source:
+        reader = pyarrow.ipc.open_file(source)
+        return sum(reader.get_batch(i).num_rows
+                   for i in range(reader.num_record_batches))
+
+def write_manifest(folder_dir):
+    """
+    Rebuild the manifest of a post-processing folder from the typed
+    parts it holds. Csv parts are not listed.
+
+    Parameters
+    ----------
+    folder_dir : str
+        The post-processing folder.
+
+    Returns
+    -------
+    manifest : dict
+        The manifest that was written, holding a list of parts, each
+        with its file name, format, country group and row count, as
+        well as the total row count.
+    """
+    typed_formats = {extension: output_format
+                     for output_format, extension in OUTPUT_FORMATS.items()
+                     if output_format != "csv"}
+
+    parts = []
+    for entry in sorted(os.listdir(folder_dir)):
+        stem, extension = os.path.splitext(entry)
+        if extension not in typed_formats or not stem.startswith("mf_"):
+            continue
+
+        parts.append({
+            "file": entry,
+            "format": typed_formats[extension],
+            "country_group": stem[len("mf_"):],
+            "rows": _count_rows(os.path.join(folder_dir, entry))
+        })
+
+    manifest = {"parts": parts, "rows": sum(part["rows"] for part in parts)}
+
+    manifest_path = os.path.join(folder_dir, MANIFEST_NAME)
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, manifest_path)
+
+    return manifest
@@ -0,0 +1,356 @@
+"""
+A fund-indexed columnar store of the domicile-grouped inputs and the
+initialised outputs of process-mf-data.py, for looking up the history
+of single funds (see analyse-input-data.ipynb).
+
+Checking one fund otherwise means parsing a whole country group's csv
+with load_data, or rerunning process_fund_data. Instead, each source
+file is stored once as an uncompressed Arrow IPC file, in tall format
+and sorted by fundid (then secid and date for the inputs), alongside an
+index of the rows that each fundid spans. Tables are memory mapped when
+read, so the rows of a few funds are read without reading the rest of
+the table.
+
+The store mirrors the layout of data/mutual-funds: the stored table of
+domicile-grouped/monthly-costs/mf_monthly-costs_lux.csv is
+domicile-grouped/monthly-costs/mf_monthly-costs_lux.arrow within
+STORE_DIR, and its index is mf_monthly-costs_lux.index.arrow beside it.
+Both hold the fingerprint of their source file (see
+load_cache.source_key) in their schema metadata, and are rebuilt the
+next time they are read once the source file has changed. Arrow.jl can
+read both directly.
+
+Panels only hold their observed cells, and their dates are stored as
+month-end dates, as in the saved output.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from shared import load_cache
+from shared import month_index
+from shared import panel_reader
+
+try:
+    import pyarrow
+    import pyarrow.feather as feather
+    import pyarrow.ipc
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+    feather = None
+
+FUND_DIR = "data/mutual-funds"
+STORE_DIR = "data/mutual-funds/cache/fund-store"
+
+# Bump this whenever the layout of stored tables changes so that every
+# table is rebuilt.
+STORE_VERSION = 1
+
+# The name and datatype of the values of each domicile-grouped panel, as
+# loaded by load_fund_panels.
+PANEL_VALUES = {
+    "local-monthly-gross-returns": ("ret_gross_m", np.float64),
+    "local-monthly-net-returns": ("ret_net_m", np.float64),
+    "usd-monthly-gross-returns": ("ret_gross_m", np.float64),
+    "usd-monthly-net-returns": ("ret_net_m", np.float64),
+    "monthly-net-assets": ("net_assets", np.float64),
+    "monthly-costs": ("rep_costs", np.float64),
+    "monthly-morningstar-category": ("morningstar_category", object),
+}
+
+def store_available():
+    """Return True if the optional pyarrow dependency is installed."""
+    return feather is not None
+
+def input_filename(filename_base, country_group_code):
+    """
+    Return the path of one domicile-grouped data file, as data_filename
+    does in process-mf-data.py.
+    """
+    return os.path.join(FUND_DIR, "domicile-grouped", filename_base,
+                        f"mf_{filename_base}_{country_group_code}.csv")
+
+def output_filename(folder_name, country_group_code):
+    """
+    Return the path of the saved part of one country group in an
+    initialised post-processing folder, in whichever format it was saved.
+    """
+    folder_dir = os.path.join(FUND_DIR, "post-processing", folder_name,
+                              "initialised")
+    for extension in [".arrow", ".parquet", ".csv"]:
+        filename = os.path.join(folder_dir, f"mf_{country_group_code}{extension}")
+        if os.path.exists(filename):
+            return filename
+
+    raise ValueError(f"No output has been saved for {country_group_code} in "
+                     f"{folder_name}.")
+
+def store_paths(filename, store_dir=STORE_DIR):
+    """
+    Return the paths of the stored table and index of a source file
+    within data/mutual-funds.
+    """
+    relpath = os.path.relpath(os.path.splitext(filename)[0], FUND_DIR)
+    if relpath.startswith(".."):
+        raise ValueError(f"{filename} is not within {FUND_DIR}.")
+
+    stem = os.path.join(store_dir, relpath)
+    return f"{stem}.arrow", f"{stem}.index.arrow"
+
+def _store_key(filename):
+    """Return the key that a stored table of a source file must carry."""
+    return load_cache._hash([STORE_VERSION, load_cache.source_key(filename)])
+
+def _is_current(path, key):
+    """Return True if a stored file exists and was built with key."""
+    if not os.path.exists(path):
+        return False
+
+    with pyarrow.memory_map(path) as source:
+        metadata = pyarrow.ipc.open_file(source).schema.metadata or {}
+
+    return metadata.get(b"fund_store_key") == key.encode("utf-8")
+
+def _read_source(filename):
+    """
+    Read a source file into a tall DataFrame sorted by fundid, with the
+    rows of each fund in their original order.
+    """
+    base = os.path.basename(os.path.dirname(filename))
+    if base in PANEL_VALUES:
+        value_name, exp_dtype = PANEL_VALUES[base]
+        df = panel_reader.read_panel(filename, value_name, exp_dtype, sparse=True)
+        for col in ["fundid", "secid"]:
+            df[col] = df[col].astype(object)
+        df["date"] = month_index.to_month_ends(df.date)
+        sort_columns = ["fundid", "secid", "date"]
+    elif base == "info":
+        df = pd.read_csv(filename, parse_dates=["inception-date"], dayfirst=True)
+        sort_columns = ["fundid", "secid"]
+    elif filename.endswith(".csv"):
+        df = pd.read_csv(filename, parse_dates=["date"])
+        sort_columns = ["fundid"]
+    elif filename.endswith(".arrow"):
+        df = feather.read_table(filename).to_pandas()
+        sort_columns = ["fundid"]
+    else:
+        df = parquet.read_table(filename).to_pandas()
+        sort_columns = ["fundid"]
+
+    return df.sort_values(by=sort_columns, kind="stable").reset_index(drop=True)
+
+def build_table(filename, store_dir=STORE_DIR):
+    """
+    Store a source file, unless an up-to-date table of it is already
+    stored.
+
+    Parameters
+    ----------
+    filename : str
+        The path of a domicile-grouped data file, or of a part saved in
+        an initialised post-processing folder.
+    store_dir : str, default STORE_DIR
+        The directory that holds the store.
+
+    Returns
+    -------
+    paths : (str, str)
+        The paths of the stored table and its index.
+    """
+    if not store_available():
+        raise ValueError("The fund store requires pyarrow.")
+
+    table_path, index_path = store_paths(filename, store_dir)
+    key = _store_key(filename)
+    if _is_current(table_path, key) and _is_current(index_path, key):
+        return table_path, index_path
+
+    df = _read_source(filename)
+
+    # Missing fundids are sorted last, and are not indexed.
+    fundids = df.fundid.to_numpy()
+    indexed = pd.notna(fundids)
+    starts = np.flatnonzero(
+        indexed & np.r_[True, fundids[1:] != fundids[:-1]]
+    )
+    stops = np.r_[starts[1:], indexed.sum()]
+    df_index = pd.DataFrame({"fundid": fundids[starts].astype(str),
+                             "start": starts, "stop": stops})
+
+    os.makedirs(os.path.dirname(table_path), exist_ok=True)
+
+    # The index is replaced before the table, and each is only current
+    # once both carry the new key.
+    metadata = {"fund_store_key": key}
+    for frame, path in [(df_index, index_path), (df, table_path)]:
+        table = pyarrow.Table.from_pandas(frame, preserve_index=False)
+        table = table.replace_schema_metadata(
+            {**(table.schema.metadata or {}), **metadata}
+        )
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        feather.write_feather(table, tmp_path, compression="uncompressed")
+        os.replace(tmp_path, path)
+
+    return table_path, index_path
+
+def read_funds(filename, fundids, store_dir=STORE_DIR):
+    """
+    Read the rows of some funds from the stored table of a source file,
+    storing the file first if needed.
+
+    Parameters
+    ----------
+    filename : str
+        The source file, as in build_table.
+    fundids : str or sequence of str
+        The funds to read.
+    store_dir : str, default STORE_DIR
+        The directory that holds the store.
+
+    Returns
+    -------
+    df_return : DataFrame
+        The rows of each fund, in the order of fundids and then in the
+        order of the stored table. Funds that are not in the table have
+        no rows.
+    """
+    if isinstance(fundids, str):
+        fundids = [fundids]
+
+    table_path, index_path = build_table(filename, store_dir)
+    df_index = feather.read_table(index_path, memory_map=True).to_pandas()
+    table = feather.read_table(table_path, memory_map=True)
+
+    index_fundids = df_index.fundid.to_numpy()
+    positions = np.searchsorted(index_fundids, np.asarray(fundids, dtype=object))
+    slices = []
+    for fundid, position in zip(fundids, positions):
+        if position < len(index_fundids) and index_fundids[position] == fundid:
+            start, stop = df_index.start[position], df_index.stop[position]
+            slices.append(table.slice(start, stop - start))
+
+    return (pyarrow.concat_tables(slices) if slices
+            else table.slice(0, 0)).to_pandas()
+
+def build_store(country_group_codes, currency_types=("local", "usd"),
+                folder_names=(), store_dir=STORE_DIR):
+    """
+    Store every domicile-grouped input of some country groups, and their
+    saved output in some post-processing folders, ahead of reading them.
+    Tables that are already up to date are left as they are.
+
+    Parameters
+    ----------
+    country_group_codes : sequence of str
+        The country groups to store.
+    currency_types : sequence of str, default ("local", "usd")
+        The currency groups of the returns to store.
+    folder_names : sequence of str, default ()
+        The initialised post-processing folders to store the output of,
+        as in fund_outputs.
+    store_dir : str, default STORE_DIR
+        The directory that holds the store.
+    """
+    filename_bases = ["info", "monthly-net-assets", "monthly-costs",
+                      "monthly-morningstar-category"]
+    for currency_type in currency_types:
+        filename_bases += [f"{currency_type}-monthly-gross-returns",
+                           f"{currency_type}-monthly-net-returns"]
+
+    for country_group_code in country_group_codes:
+        for base in filename_bases:
+            build_table(input_filename(base, country_group_code), store_dir)
+        for folder_name in folder_names:
+            build_table(output_filename(folder_name, country_group_code),
+                        store_dir)
+
+def fund_inputs(fundids, country_group_code, currency_type="usd",
+                store_dir=STORE_DIR):
+    """
+    Read the domicile-grouped inputs of some funds, as process_fund_data
+    would load them for a country group and currency.
+
+    Parameters
+    ----------
+    fundids : str or sequence of str
+        The funds to read.
+    country_group_code : str
+        The country group that the funds belong to (see locate_funds).
+    currency_type : ["local", "usd"], default "usd"
+        The currency group of the returns.
+    store_dir : str, default STORE_DIR
+        The directory that holds the store.
+
+    Returns
+    -------
+    inputs : dict of DataFrame
+        The rows of the funds in each input, keyed by the base name of the
+        input file, such as "info" or "monthly-costs".
+    """
+    filename_bases = ["info", f"{currency_type}-monthly-gross-returns",
+                      f"{currency_type}-monthly-net-returns",
+                      "monthly-net-assets", "monthly-costs",
+                      "monthly-morningstar-category"]
+
+    return {base: read_funds(input_filename(base, country_group_code), fundids,
+                             store_dir)
+            for base in filename_bases}
+
+def fund_outputs(fundids, folder_name, country_group_code, store_dir=STORE_DIR):
+    """
+    Read the saved output of process_fund_data for some funds.
+
+    Parameters
+    ----------
+    fundids : str or sequence of str
+        The funds to read.
+    folder_name : str
+        The post-processing folder, as returned by fund_data_foldername,
+        with "_age-filtered" appended for the age-filtered output.
+    country_group_code : str
+        The country group that the funds belong to.
+    store_dir : str, default STORE_DIR
+        The directory that holds the store.
+
+    Returns
+    -------
+    df_return : DataFrame
+        The output rows of the funds.
+    """
+    return read_funds(output_filename(folder_name, country_group_code), fundids,
+                      store_dir)
+
+def locate_funds(fundids, country_group_codes, store_dir=STORE_DIR):
+    """
+    Find the country group of some funds from the indexes of their fund
+    information.
+
+    Parameters
+    ----------
+    fundids : str or sequence of str
+        The funds to find.
+    country_group_codes : sequence of str
+        The country groups to search.
+    store_dir : str, default STORE_DIR
+        The directory that holds the store.
+
+    Returns
+    -------
+    groups : Series
+        The country group of each fund that was found, indexed by fundid.
+    """
+    if isinstance(fundids, str):
+        fundids = [fundids]
+
+    groups = {}
+    for country_group_code in country_group_codes:
+        _, index_path = build_table(input_filename("info", country_group_code),
+                                    store_dir)
+        indexed = feather.read_table(index_path, memory_map=True,
+                                     columns=["fundid"]).to_pandas().fundid
+        for fundid in pd.Index(fundids).intersection(indexed):
+            groups.setdefault(fundid, country_group_code)
+
+    return pd.Series(groups, name="country_group", dtype=object)
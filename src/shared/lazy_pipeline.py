@@ -0,0 +1,520 @@
+"""
+A lazy query-plan backend for process-mf-data.py, built on Polars.
+
+The pandas backend runs each step of process_fund_data eagerly, so the
+returns data, the merged panel, the filled and categorised panels and
+the equity-filtered panel are each materialised in full, even though
+later steps drop most of their rows and columns. This module instead
+expresses the steps from reading the source files to aggregating
+secids into funds as Polars query plans, one to combine the panels and
+one to categorise, filter and aggregate them, which are each optimised
+as a whole and run across the Polars thread pool. Only the columns each
+step uses are read from the source files (projection pushdown), and
+row filters are pushed down as far as the wide layout of the panel
+files allows, which is to just after the panels are reshaped, since a
+cell can only be tested once it is a row.
+
+The result is the aggregated fund data that aggregate_fund_panel
+returns before fund flows are calculated, with the same rows, columns,
+categories and row order. Values are the same up to rounding, as
+Polars and numpy add the values of a group in different orders.
+
+Polars is an optional dependency, as is pyarrow, which converting the
+result to pandas requires.
+"""
+import csv
+
+import numpy as np
+import pandas as pd
+
+from shared import month_index
+
+try:
+    import polars as pl
+    import pyarrow.csv as pacsv
+except ImportError:
+    pl = None
+    pacsv = None
+
+# The fields of the category mappings used to classify equity, and the
+# investment target fields, which are categorical.
+EQUITY_FIELDS = ["equity", "strict_equity", "fin_or_re"]
+TARGET_FIELDS = ["inv_msci_class", "inv_region", "inv_group", "inv_country"]
+
+# The strings read as missing values by pd.read_csv, which reads the fund
+# information and the category mappings in the pandas backend. The panel
+# files are read with pyarrow's defaults instead (see panel_reader).
+PANDAS_NA_VALUES = ["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN",
+                    "-NaN", "-nan", "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA",
+                    "NULL", "NaN", "None", "n/a", "nan", "null"]
+
+# Rows of the returns data are ordered by the table that first holds
+# their panel keys (gross returns, then net returns, then costs) and
+# then by their row in that table's file, as the pandas backend merges
+# them. Each table's positions start at a multiple of this offset.
+TABLE_OFFSET = 2**40
+
+def backend_available():
+    """Return True if the optional polars and pyarrow dependencies are
+    installed."""
+    return pl is not None and pacsv is not None
+
+def _panel_months(filename):
+    """Return the month index of each month column of a panel file."""
+    with open(filename, newline="", encoding="utf-8") as f:
+        col_names = next(csv.reader(f))
+
+    return month_index.to_months(pd.to_datetime(col_names[3:]))
+
+def _scan_wide_panel(filename, value_name, dtype, months, prefix):
+    """
+    Scan one wide panel csv, keeping one row per secid.
+
+    The month columns are named by prefix and month index, and limited
+    to the given months, with months that the file does not have filled
+    with missing values, so that the panels of a country group can be
+    joined side by side and reshaped together. The row of each secid in
+    the file is kept in a column named "row_" + value_name.
+    """
+    file_months = _panel_months(filename)
+    file_columns = [f"{prefix}{month}" for month in file_months]
+    kept_months = set(months)
+
+    return (
+        pl.scan_csv(filename,
+                    new_columns=["name", "fundid", "secid"] + file_columns,
+                    infer_schema=False,
+                    schema_overrides={"fundid": pl.Categorical,
+                                      "secid": pl.Categorical,
+                                      **{col: dtype for col in file_columns}},
+                    null_values=pacsv.ConvertOptions().null_values)
+          .select(["fundid", "secid"]
+                  + [col for month, col in zip(file_months, file_columns)
+                     if month in kept_months])
+          .with_row_index("row_" + value_name)
+          .with_columns([pl.lit(None, dtype).alias(f"{prefix}{month}")
+                         for month in sorted(kept_months - set(file_months))])
+    )
+
+def _scan_fundids(filename, null_values):
+    """Scan the fundid column of any of the source files."""
+    return pl.scan_csv(filename, infer_schema=False,
+                       null_values=null_values).select("fundid")
+
+def _trim_flag(values, by="secid"):
+    """
+    Return an expression that is True for the rows that trim_nans keeps,
+    being those between the first and last observed value of a column
+    within each group. Rows must be in date order within each group.
+    """
+    observed = values.is_not_null()
+    return ((observed.cum_sum().over(by) > 0)
+            & (observed.cum_sum(reverse=True).over(by) > 0))
+
+def _strict_sum(values):
+    """
+    Return an expression for the sum of a column that is missing if any
+    value is missing, as the strict_sum reducer of aggregate_groups.
+    """
+    return values.fill_null(np.nan).sum()
+
+def _polate_assets(lf, how):
+    """
+    Interpolate and/or extrapolate net assets within each secid, as
+    polate_assets does, keeping the original values as
+    "net_assets_original". Rows must be in date order within each secid.
+    """
+    net_assets = pl.col("net_assets")
+    ret_net_m = pl.col("ret_net_m")
+
+    # Number each polation group by the observations of net assets
+    # before it, with -1 for the extrapolation group after the last.
+    observed = net_assets.is_not_null().cast(pl.Int64)
+    num_before = observed.cum_sum().over("secid") - observed
+    lf = lf.with_columns(
+        polation_id=pl.when(num_before == observed.sum().over("secid"))
+                      .then(-1).otherwise(num_before)
+    )
+    polation_id = pl.col("polation_id")
+    is_first_group = polation_id == 0
+    is_last_group = polation_id == -1
+
+    # The asset base of each group is the last observation before it,
+    # or the first observation for group 0.
+    lf = lf.with_columns(
+        asset_base=net_assets.forward_fill().shift(1).over("secid")
+                             .fill_null(net_assets.backward_fill().over("secid")),
+        cumret_net=(ret_net_m/100 + 1).fill_null(1).cum_prod()
+                                      .over(["secid", "polation_id"])
+    )
+    cumret_net = pl.col("cumret_net")
+
+    cumret_divisor = (
+        pl.when(net_assets.is_null()).then(None).otherwise(cumret_net)
+          .backward_fill().over("secid")
+    )
+    lf = lf.with_columns(
+        cumret_net=pl.when(is_first_group).then(cumret_net/cumret_divisor)
+                     .otherwise(cumret_net)
+    )
+
+    # Stop extrapolation across missing returns.
+    stop_back = (
+        pl.when(is_first_group & ret_net_m.is_null()).then(1)
+          .backward_fill().over("secid")
+    )
+    stop_forward = (
+        pl.when(is_last_group & ret_net_m.is_null()).then(1)
+          .forward_fill().over("secid")
+    )
+    lf = lf.with_columns(
+        recalculated_exflows=pl.when((stop_back == 1).fill_null(False)
+                                     | (stop_forward == 1).fill_null(False))
+                               .then(None).otherwise(cumret_net)
+                             * pl.col("asset_base")
+    )
+    recalculated_exflows = pl.col("recalculated_exflows")
+
+    # NaN discrepancies (from 0/0) are missing values to pandas, so they
+    # are back filled over as well.
+    asset_discrepancy = (
+        pl.when(is_first_group | is_last_group).then(1.0)
+          .otherwise(net_assets/recalculated_exflows).fill_nan(None)
+          .backward_fill().over("secid")
+    )
+    # Count rows from the start of each polation group, which is faster
+    # than counting within each group as most groups are a single row.
+    secid_row = pl.int_range(pl.len()).over("secid")
+    group_start = (
+        pl.when(polation_id != polation_id.shift(1)).then(secid_row)
+          .forward_fill().over("secid")
+    )
+    polation_progress = (secid_row - group_start.fill_null(0) + 1)
+    polation_duration = pl.len().over(["secid", "polation_id"])
+    recalculated = (
+        recalculated_exflows
+        * asset_discrepancy**(polation_progress/polation_duration)
+    )
+
+    if how == "interpolate":
+        recalculated = (pl.when(is_first_group | is_last_group).then(None)
+                          .otherwise(recalculated))
+    elif how == "extrapolate":
+        recalculated = (pl.when(is_first_group | is_last_group)
+                          .then(recalculated).otherwise(None))
+
+    return (
+        lf.with_columns(net_assets_original=net_assets,
+                        net_assets=net_assets.fill_null(recalculated.fill_nan(None)))
+          .drop(["polation_id", "asset_base", "cumret_net",
+                 "recalculated_exflows"])
+    )
+
+def _categorical(values, categories):
+    """Convert a pandas Series to a categorical with given categories."""
+    return pd.Categorical(values, categories=pd.Index(categories))
+
+def _sorted_unique(series):
+    """Return the lexically sorted distinct non-missing values of a
+    Polars Series."""
+    return pd.Index(series.drop_nulls().unique().to_list()).sort_values()
+
+def aggregate_fund_data(filenames, mapping_filename, raw_ret_only,
+                        polation_method, strict_eq, exc_finre, inv_targets,
+                        inc_agefilter):
+    """
+    Load, combine, categorise, filter and aggregate the fund data of one
+    country group in lazy queries, as the pandas stages of
+    process_fund_data do.
+
+    Parameters
+    ----------
+    filenames : dict of str
+        The paths of the source files, keyed by "info", "gross", "net",
+        "na", "costs" and "cat".
+    mapping_filename : str
+        The path of morningstar_categories.csv.
+    raw_ret_only, polation_method, strict_eq, exc_finre, inv_targets,
+    inc_agefilter
+        As in process_fund_data.
+
+    Returns
+    -------
+    df_mf_agg : DataFrame
+        The aggregated fund data, as returned by aggregate_fund_panel but
+        without fund flows, and with domiciles still named by country
+        rather than by ISO code.
+    df_conflicts : DataFrame
+        The conflicts between secids that share a fundid and date, as
+        returned by agg_verify with return_conflicts=True.
+    """
+    if not backend_available():
+        raise ValueError("The lazy backend requires polars and pyarrow.")
+
+    ret_gross_m = pl.col("ret_gross_m")
+    ret_net_m = pl.col("ret_net_m")
+    net_assets = pl.col("net_assets")
+
+    # --- COMBINE ---
+    # Join every panel, and the domicile of each secid, while the panels
+    # are still wide, then reshape them together. Each panel holds a
+    # column for every month of the returns panels, and the month columns
+    # of the returns panels are named by month index alone, so that they
+    # become the dates of the tall rows.
+    returns_panels = [("gross", "ret_gross_m"), ("net", "ret_net_m"),
+                      ("costs", "rep_costs")]
+    months = sorted(set().union(*[_panel_months(filenames[name])
+                                  for name, _ in returns_panels]))
+    panels = returns_panels + [("na", "net_assets"),
+                               ("cat", "morningstar_category")]
+    lf_wides = [
+        _scan_wide_panel(filenames[name], value_name,
+                         pl.Categorical if name == "cat" else pl.Float64, months,
+                         "" if name == "gross" else value_name + "_")
+        for name, value_name in panels
+    ]
+    lf_info = (
+        pl.scan_csv(filenames["info"], infer_schema=False,
+                    schema_overrides={"secid": pl.Categorical,
+                                      "domicile": pl.Categorical},
+                    null_values=PANDAS_NA_VALUES)
+          .select(["secid", "domicile"])
+    )
+
+    # Secids without fund information are dropped whole, as
+    # combine_fund_panels drops them after trimming.
+    lf_wide = lf_wides[0]
+    for lf_panel in lf_wides[1:3]:
+        lf_wide = lf_wide.join(lf_panel, on=["fundid", "secid"], how="full",
+                               coalesce=True)
+    for lf_panel in lf_wides[3:]:
+        lf_wide = lf_wide.join(lf_panel, on=["fundid", "secid"], how="left")
+    lf_wide = lf_wide.join(lf_info, on="secid", how="inner")
+
+    row_columns = ["row_" + value_name for _, value_name in panels[:3]]
+    lf_rets = pl.concat(
+        [lf_wide.unpivot(on=[str(month) for month in months],
+                         index=["fundid", "secid", "domicile"] + row_columns,
+                         variable_name="date", value_name="ret_gross_m")
+                .with_columns(pl.col("date").cast(pl.Int16))]
+        + [lf_wide.unpivot(on=[f"{value_name}_{month}" for month in months],
+                           value_name=value_name)
+                  .select(value_name)
+           for _, value_name in panels[1:]],
+        how="horizontal"
+    )
+
+    # A secid-month is only a row of a dense panel if the secid is in the
+    # panel and the month has an observed cell, and rows are ordered as
+    # described under TABLE_OFFSET.
+    positions = []
+    for table, (_, value_name) in enumerate(returns_panels):
+        in_table = (
+            pl.col("row_" + value_name).is_not_null()
+            & pl.col(value_name).is_not_null().any().over("date")
+        )
+        positions.append(
+            pl.when(in_table)
+              .then(pl.col("row_" + value_name).cast(pl.Int64)
+                    + table * TABLE_OFFSET)
+        )
+    lf_rets = (
+        lf_rets.with_columns(position=pl.min_horizontal(positions))
+               .filter(pl.col("position").is_not_null())
+               .drop(row_columns)
+    )
+
+    # Fill gross returns from net returns and costs, as in
+    # combine_fund_panels.
+    if not raw_ret_only:
+        ret_gross_m_recalculated = (
+            ((ret_net_m/100 + 1)/(1 - pl.col("rep_costs")/100) - 1) * 100
+        )
+        lf_rets = lf_rets.with_columns(
+            ret_gross_m=pl.when(ret_net_m == 0).then(0.0)
+                          .otherwise(ret_gross_m.fill_null(
+                              ret_gross_m_recalculated.fill_nan(None)))
+        )
+
+    # Rows are reshaped month by month, so every window over a secid
+    # below runs in date order. The first row each secid keeps after
+    # trimming sets the order of the secids within each fundid-date pair
+    # when they are aggregated.
+    lf_mf = lf_rets.filter(_trim_flag(ret_gross_m)).with_columns(
+        secid_date=pl.col("date").first().over("secid"),
+        secid_position=pl.col("position").first().over("secid")
+    )
+    if inc_agefilter:
+        lf_mf = lf_mf.with_columns(
+            age=(pl.col("date").cum_count().over("secid") - 1).cast(pl.Int64)
+        )
+    lf_mf = lf_mf.with_columns(
+        net_assets=pl.when(net_assets == 0).then(None).otherwise(net_assets)
+    )
+
+    # Polars does not share work between the queries passed to
+    # collect_all, so the combined panel, which the domicile categories
+    # are also taken from, is collected once for the later stages.
+    df_mf = lf_mf.collect()
+    lf_mf = df_mf.lazy()
+
+    # --- CATEGORISE ---
+    if polation_method:
+        lf_mf = _polate_assets(lf_mf, polation_method)
+
+    mapping_fields = EQUITY_FIELDS + (TARGET_FIELDS if inv_targets else [])
+    lf_mapping = (
+        pl.scan_csv(mapping_filename, infer_schema=False,
+                    schema_overrides={"morningstar_category": pl.Categorical},
+                    null_values=PANDAS_NA_VALUES)
+          .select(["morningstar_category"] + mapping_fields)
+          .with_columns(pl.col(EQUITY_FIELDS).cast(pl.Float64))
+    )
+    lf_mf = lf_mf.join(lf_mapping, on="morningstar_category", how="left",
+                       maintain_order="left")
+
+    # --- FILTER ---
+    # Override the classification of every secid with that of its
+    # fundid-date pair, then remove non-equity returns and trim again.
+    equity_flag = pl.col("strict_equity" if strict_eq else "equity")
+    if exc_finre:
+        equity_flag = equity_flag * (1 - pl.col("fin_or_re"))
+    lf_mf = (
+        lf_mf.with_columns(
+                 ret_gross_m=pl.when(equity_flag.min().over(["fundid", "date"])
+                                     == 0)
+                               .then(None).otherwise(ret_gross_m)
+             )
+             .filter(_trim_flag(ret_gross_m))
+             .with_columns(net_assets_m1=net_assets.shift(1).over("secid"))
+    )
+
+    # --- AGGREGATE ---
+    # Sort into fundid-date pairs, ordering the secids of each pair as
+    # the pandas backend does, then weight returns and costs by lagged
+    # net assets.
+    lf_mf = (
+        lf_mf.sort(["fundid", "date", "secid_date", "secid_position"])
+             .with_row_index("row")
+    )
+    pair = ["fundid", "date"]
+    weights = pl.col("net_assets_m1")
+    lf_mf = lf_mf.with_columns(
+        row_weight=pl.when(pl.len().over(pair) == 1).then(1.0)
+                     .otherwise(weights/_strict_sum(weights).over(pair))
+    )
+    weighted_columns = ["ret_gross_m", "ret_net_m", "rep_costs"]
+
+    if polation_method:
+        assets_name = "net_assets_original"
+    else:
+        assets_name = "net_assets"
+
+    aggregations = [
+        _strict_sum(pl.col("ret_gross_m")),
+        _strict_sum(pl.col("ret_net_m")),
+        _strict_sum(pl.col("rep_costs")).alias("mean_costs"),
+        pl.col("domicile").first(ignore_nulls=True),
+    ]
+    if inc_agefilter:
+        aggregations.append(pl.col("age").max().alias("fund_age"))
+    aggregations.append(_strict_sum(pl.col(assets_name)).alias("fund_assets"))
+    if inv_targets:
+        aggregations += [pl.col(col).first(ignore_nulls=True)
+                         for col in TARGET_FIELDS]
+
+    # Count the distinct values of each column that agg_verify checks, to
+    # find the pairs whose secids conflict.
+    verify_columns = (TARGET_FIELDS if inv_targets else []) + ["domicile"]
+    aggregations += [pl.col(col).drop_nulls().n_unique().alias("num_" + col)
+                     for col in verify_columns]
+
+    lf_agg = (
+        lf_mf.with_columns([pl.col(col) * pl.col("row_weight")
+                            for col in weighted_columns])
+             .group_by(pair, maintain_order=True).agg(aggregations)
+    )
+
+    # The modal category of each pair, counting missing categories as a
+    # value, with ties broken by first appearance.
+    lf_modes = (
+        lf_mf.group_by(pair + ["morningstar_category"])
+             .agg(count=pl.len(), first_row=pl.col("row").min())
+             .sort(["count", "first_row"], descending=[True, False])
+             .group_by(pair)
+             .agg(pl.col("morningstar_category").first()
+                    .alias("approx_morningstar_category"))
+    )
+    lf_agg = lf_agg.join(lf_modes, on=pair, how="left", maintain_order="left")
+
+    column_order = ["fundid", "date", "ret_gross_m", "ret_net_m", "mean_costs",
+                    "approx_morningstar_category", "domicile"]
+    if inc_agefilter:
+        column_order.append("fund_age")
+    column_order.append("fund_assets")
+    if inv_targets:
+        column_order += TARGET_FIELDS
+
+    # The categories of the categorical output columns, which are those
+    # the pandas backend gives them.
+    lf_fundids = pl.concat(
+        [_scan_fundids(filenames["info"], PANDAS_NA_VALUES)]
+        + [_scan_fundids(filenames[name], pacsv.ConvertOptions().null_values)
+           for name in ["gross", "net", "na", "costs", "cat"]]
+    ).unique()
+    cat_columns = [f"cat_{month}" for month in
+                   _panel_months(filenames["cat"])]
+    lf_categories = pl.concat([
+        pl.scan_csv(filenames["cat"],
+                    new_columns=["name", "fundid", "secid"] + cat_columns,
+                    infer_schema=False,
+                    null_values=pacsv.ConvertOptions().null_values)
+          .unpivot(on=cat_columns, value_name="morningstar_category")
+          .select("morningstar_category"),
+        lf_mapping.select(pl.col("morningstar_category").cast(pl.String)),
+    ]).unique()
+
+    df_agg, fundids, categories, df_mapping = pl.collect_all(
+        [lf_agg, lf_fundids, lf_categories, lf_mapping]
+    )
+
+    # --- CONVERT TO PANDAS ---
+    df_mf_agg = df_agg.select(column_order).to_pandas()
+    df_mf_agg["fundid"] = _categorical(df_mf_agg.fundid,
+                                       _sorted_unique(fundids["fundid"]))
+    df_mf_agg["approx_morningstar_category"] = _categorical(
+        df_mf_agg.approx_morningstar_category,
+        _sorted_unique(categories["morningstar_category"])
+    )
+    df_mf_agg["domicile"] = _categorical(df_mf_agg.domicile,
+                                         _sorted_unique(df_mf["domicile"]))
+    if inv_targets:
+        for col in TARGET_FIELDS:
+            df_mf_agg[col] = _categorical(df_mf_agg[col],
+                                          _sorted_unique(df_mapping[col]))
+
+    # Report columns without values as agg_verify does, and list the
+    # conflicts in its order. A column has values if any pair has one.
+    if df_agg.height > 0:
+        for col in verify_columns:
+            if df_agg[col].is_null().all():
+                print("Warning: "+col+" contains no usable observations")
+
+    df_conflicts = (
+        df_agg.unpivot(on=["num_" + col for col in verify_columns],
+                       index=pair, variable_name="column",
+                       value_name="num_values")
+              .filter(pl.col("num_values") > 1)
+              .with_columns(pl.col("column").str.strip_prefix("num_"))
+              .to_pandas()
+    )
+    df_conflicts["fundid"] = _categorical(df_conflicts.fundid,
+                                          df_mf_agg.fundid.cat.categories)
+    df_conflicts["column"] = _categorical(df_conflicts.column, verify_columns)
+    df_conflicts = (
+        df_conflicts.sort_values(by=["fundid", "date", "column"])
+                    .loc[:, ["fundid", "date", "column"]]
+                    .reset_index(drop=True)
+    )
+
+    return df_mf_agg, df_conflicts
@@ -0,0 +1,180 @@
+"""
+Columnar sidecar cache for tables loaded by process-mf-data.py.
+
+Parsing the wide domicile-grouped csv files is the slowest part of
+loading fund data, and the same files are parsed again on every run.
+This module stores the already reshaped and typed output of load_data
+as an uncompressed Arrow IPC file, which later runs read instead of
+re-reading the csv. The gain comes from skipping the csv parse and
+reshape. A sidecar is read through a memory map but is still copied
+into pandas, as the later stages of process-mf-data.py modify the
+tables they load.
+
+Each sidecar is keyed both by the arguments that were passed to the
+loader and by a fingerprint of the source file (its path, size and
+modification time), so that a sidecar is never used once its source
+file has changed. A stale sidecar is deleted and replaced the next time
+the same table is loaded.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.feather as feather
+except ImportError:
+    pyarrow = None
+    feather = None
+
+CACHE_DIR = "data/mutual-funds/cache/load-data"
+
+# Bump this whenever the layout of cached tables changes so that any
+# sidecars written by older code are ignored.
+CACHE_VERSION = 2
+
+def cache_available():
+    """Return True if the optional pyarrow dependency is installed."""
+    return feather is not None
+
+def _hash(obj):
+    """Return a short, stable hash of a json-serialisable object."""
+    payload = json.dumps(obj, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha1(payload).hexdigest()[:16]
+
+def args_key(**loader_args):
+    """
+    Hash the loader arguments that affect the shape or types of a
+    loaded table.
+
+    Parameters
+    ----------
+    **loader_args
+        The keyword arguments passed to the loader. Datatypes are
+        normalised to their numpy string representation so that, for
+        example, np.float64 and "float64" produce the same key.
+
+    Returns
+    -------
+    key : str
+    """
+    normalised = {"version": CACHE_VERSION}
+    for name, value in loader_args.items():
+        if name.endswith("dtype") and value is not None:
+            value = np.dtype(value).str
+        normalised[name] = value
+
+    return _hash(normalised)
+
+def source_key(filename):
+    """
+    Fingerprint a source file by its absolute path, size and
+    modification time.
+    """
+    stat = os.stat(filename)
+    return _hash([os.path.abspath(filename), stat.st_size, stat.st_mtime_ns])
+
+def sidecar_path(filename, arg_key, src_key, cache_dir=CACHE_DIR):
+    """Return the path of the sidecar for a source file and key pair."""
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(cache_dir, f"{stem}.{arg_key}.{src_key}.arrow")
+
+def read_sidecar(filename, loader_args, cache_dir=CACHE_DIR):
+    """
+    Load the cached version of a table if an up-to-date sidecar exists.
+    The sidecar is read through a memory map and copied into a
+    DataFrame, which is the same as an uncached load.
+
+    Parameters
+    ----------
+    filename : str
+        The path of the source csv file.
+    loader_args : dict
+        The loader arguments the table was (or will be) loaded with.
+    cache_dir : str, default CACHE_DIR
+        The directory that holds the sidecar files.
+
+    Returns
+    -------
+    df_return : DataFrame or None
+        The cached table, or None if there is no valid sidecar.
+    """
+    if not cache_available():
+        return None
+
+    path = sidecar_path(filename, args_key(**loader_args),
+                        source_key(filename), cache_dir)
+    try:
+        df_return = feather.read_table(path, memory_map=True).to_pandas()
+    except FileNotFoundError:
+        return None
+
+    # Arrow represents missing strings as None, but the csv reader
+    # represents them as NaN. Restore NaN so that cached and uncached
+    # loads behave identically downstream.
+    for col in df_return.columns[df_return.dtypes == object]:
+        df_return[col] = df_return[col].fillna(np.nan)
+
+    return df_return
+
+def write_sidecar(df, filename, loader_args, cache_dir=CACHE_DIR):
+    """
+    Save a loaded table as a sidecar of its source file, and remove any
+    stale sidecars left behind by earlier versions of that file.
+
+    Tables containing columns that Arrow cannot represent (such as
+    object columns holding a mix of strings and numbers) are silently
+    left uncached.
+
+    Parameters
+    ----------
+    df : DataFrame
+        The loaded table to be cached.
+    filename : str
+        The path of the source csv file.
+    loader_args : dict
+        The loader arguments the table was loaded with.
+    cache_dir : str, default CACHE_DIR
+        The directory that holds the sidecar files.
+
+    Returns
+    -------
+    written : bool
+        True if a sidecar was written.
+    """
+    if not cache_available():
+        return False
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    arg_key = args_key(**loader_args)
+    path = sidecar_path(filename, arg_key, source_key(filename), cache_dir)
+
+    # Write to a temporary file first so that a crash part way through a
+    # write can never leave a truncated sidecar at the final path.
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        feather.write_feather(df.reset_index(drop=True), tmp_path,
+                              compression="uncompressed")
+    except (pyarrow.ArrowException, ValueError, TypeError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+    os.replace(tmp_path, path)
+
+    # Any other sidecar for the same file and arguments was built from
+    # an earlier version of the source file. Another worker loading the
+    # same file may remove it first.
+    prefix = os.path.basename(path).rsplit(".", 2)[0] + "."
+    for entry in os.listdir(cache_dir):
+        if (entry.startswith(prefix) and entry.endswith(".arrow")
+                and entry != os.path.basename(path)):
+            try:
+                os.remove(os.path.join(cache_dir, entry))
+            except FileNotFoundError:
+                pass
+
+    return True
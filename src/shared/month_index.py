@@ -0,0 +1,68 @@
+"""
+A compact integer time axis for the monthly fund data.
+
+Every date in the fund data falls at the end of a month, so within
+process-mf-data.py dates are held as the number of months since January
+1900 (which is month 0) in an int16 column, rather than as datetimes.
+Lags and consecutive-month checks are then integer arithmetic rather
+than month-end offset arithmetic, and sorting, grouping and joining on
+dates works on two-byte keys. Month-end dates are only restored when the
+output is saved.
+"""
+import numpy as np
+import pandas as pd
+
+MONTH_DTYPE = np.int16
+
+# The year of month 0.
+BASE_YEAR = 1900
+
+# Months that stand before and after every real month, for use as
+# sentinels in comparisons.
+FIRST_MONTH = np.iinfo(MONTH_DTYPE).min
+LAST_MONTH = np.iinfo(MONTH_DTYPE).max
+
+# The month index of January 1970, which is month 0 of numpy's
+# datetime64[M] type.
+_EPOCH_OFFSET = (1970 - BASE_YEAR) * 12
+
+def to_months(dates):
+    """
+    Convert dates to month indices. Any date within a month is given the
+    index of that month.
+
+    Parameters
+    ----------
+    dates : array-like of datetime
+        The dates to convert. They must not be missing.
+
+    Returns
+    -------
+    months : ndarray of MONTH_DTYPE
+    """
+    dates = np.asarray(pd.DatetimeIndex(dates), dtype="datetime64[M]")
+    if np.isnat(dates).any():
+        raise ValueError("Missing dates cannot be converted to months.")
+
+    months = dates.astype(np.int64) + _EPOCH_OFFSET
+    if len(months) and (months.min() <= FIRST_MONTH or months.max() >= LAST_MONTH):
+        raise ValueError("Dates are out of range of the month index.")
+
+    return months.astype(MONTH_DTYPE)
+
+def to_month_ends(months):
+    """
+    Convert month indices to the dates at the end of each month.
+
+    Parameters
+    ----------
+    months : array-like of int
+
+    Returns
+    -------
+    dates : DatetimeIndex
+    """
+    months = np.asarray(months, dtype=np.int64) - _EPOCH_OFFSET
+    month_starts = months.astype("datetime64[M]")
+
+    return pd.DatetimeIndex((month_starts + 1).astype("datetime64[D]") - 1)
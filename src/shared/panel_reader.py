@@ -0,0 +1,378 @@
+"""
+A multithreaded, bounded-memory reader for the wide panel csv files.
+
+Each panel file holds one row per secid and one column per month, so
+reading it with pandas and then melting it holds the whole wide table
+and the whole tall table in memory at once, and parses every cell on a
+single thread. This module instead splits the file into blocks of whole
+rows, parses each block with pyarrow's threaded csv reader using the
+expected datatype for every month column, and reshapes each block to
+tall format before the next block is read. Peak memory for a panel load
+is therefore about one block plus the tall output, rather than two full
+copies of the data.
+
+The result is the same as reading the file with read_wide_panel and
+reshaping it in process-mf-data.py, including the order of the rows.
+"""
+import csv
+import os
+
+import numpy as np
+import pandas as pd
+
+from shared import month_index
+
+try:
+    import pyarrow
+    import pyarrow.csv as pacsv
+except ImportError:
+    pyarrow = None
+    pacsv = None
+
+# The number of bytes of csv text that are parsed at a time. Each block
+# is extended to the end of its last row.
+BLOCK_SIZE = 64 * 2**20
+
+def reader_available():
+    """Return True if the optional pyarrow dependency is installed."""
+    return pacsv is not None
+
+def _arrow_type(exp_dtype):
+    """Return the Arrow type that a month column is parsed as."""
+    if np.dtype(exp_dtype) == object:
+        return pyarrow.string()
+
+    return pyarrow.from_numpy_dtype(np.dtype(exp_dtype))
+
+def read_blocks(filename, exp_dtype, block_size=BLOCK_SIZE):
+    """
+    Parse a wide panel file in blocks of whole rows.
+
+    Yields
+    ------
+    fundids, secids : ndarray
+        The identifiers of each row in the block.
+    values : ndarray
+        A (month x row) array of the panel values in the block, with
+        missing cells as nan.
+    """
+    with open(filename, "rb") as f:
+        header = f.readline()
+        num_columns = len(next(csv.reader([header.decode("utf-8")])))
+
+        # Columns are named by position, since the first column header
+        # (the fund name) is not used and may be empty.
+        column_names = [f"c{i}" for i in range(num_columns)]
+        date_columns = column_names[3:]
+
+        read_options = pacsv.ReadOptions(column_names=column_names,
+                                         use_threads=True)
+        convert_options = pacsv.ConvertOptions(
+            column_types={
+                "c1": pyarrow.string(), "c2": pyarrow.string(),
+                **{col: _arrow_type(exp_dtype) for col in date_columns}
+            },
+            # Skip the fund name column without converting it.
+            include_columns=column_names[1:],
+            strings_can_be_null=True
+        )
+
+        file_size = os.fstat(f.fileno()).st_size
+        while True:
+            # Extend the block to the end of its last row. Panel values
+            # never contain line breaks. Reads are capped at the size of
+            # the rest of the file, since a read allocates its full size
+            # up front.
+            block = f.read(min(block_size, file_size - f.tell()))
+            if not block:
+                break
+            block += f.readline()
+
+            table = pacsv.read_csv(pyarrow.py_buffer(block),
+                                   read_options=read_options,
+                                   convert_options=convert_options)
+
+            values = np.empty((len(date_columns), table.num_rows),
+                              dtype=exp_dtype)
+            for i, col in enumerate(date_columns):
+                values[i] = table.column(col).to_numpy()
+
+            # Missing strings are read as None, but the pandas reader
+            # leaves them as nan.
+            if values.dtype == object:
+                values[pd.isna(values)] = np.nan
+
+            yield (table.column("c1").to_numpy(), table.column("c2").to_numpy(),
+                   values)
+
+def _count_rows(filename):
+    """Return the number of rows below the header of a csv file."""
+    num_lines = 0
+    last = b"\n"
+    chunk_size = max(min(2**24, os.path.getsize(filename)), 1)
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            num_lines += chunk.count(b"\n")
+            last = chunk[-1:]
+
+    # A final row need not end in a line break.
+    if last != b"\n":
+        num_lines += 1
+
+    return num_lines - 1
+
+def read_panel(filename, value_name, exp_dtype, sparse=False,
+               block_size=BLOCK_SIZE):
+    """
+    Read one wide panel csv directly into tall format.
+
+    Parameters
+    ----------
+    filename : str
+        The path of the file to be read.
+    value_name : str
+        A name for the time-series data component of the panel.
+    exp_dtype : type
+        The datatype of all columns except for the three left-most
+        columns.
+    sparse : bool, default False
+        If True, only observed (nonmissing) cells are returned.
+        Otherwise every secid-month pair is returned, for every month
+        that has at least one observed cell.
+    block_size : int, default BLOCK_SIZE
+        The approximate number of bytes of csv text parsed at a time.
+
+    Returns
+    -------
+    df_return : DataFrame
+        A tall DataFrame with columns "fundid", "secid", "date" and
+        value_name, ordered by date and then by the row order of the
+        file. The identifiers are categoricals with lexically sorted
+        categories, and dates are month indices (see
+        shared/month_index.py).
+    """
+    if not reader_available():
+        raise ValueError("The panel reader requires pyarrow.")
+
+    blocks = read_blocks(filename, exp_dtype, block_size)
+    dates = panel_dates(filename)
+    if sparse:
+        return _reshape_sparse(blocks, value_name, exp_dtype, dates)
+
+    return _reshape_dense(blocks, _count_rows(filename), value_name,
+                          exp_dtype, dates, None, filename)
+
+def read_panel_rows(filename, value_name, exp_dtype, select_rows, sparse=False,
+                    block_size=BLOCK_SIZE):
+    """
+    Read some of the rows of one wide panel csv directly into tall
+    format, dropping the other rows of each block as it is read, so that
+    the rest of the file is never held in memory.
+
+    The result is the same as reading the whole file with read_panel and
+    then selecting the rows, apart from the categories of the
+    identifiers, which are those of the selected rows alone. In
+    particular, a dense panel keeps every month with an observed cell
+    anywhere in the file.
+
+    Parameters
+    ----------
+    filename, value_name, exp_dtype, sparse, block_size
+        As in read_panel.
+    select_rows : callable
+        A function from an array of the fundids of some rows to a boolean
+        array of the rows to keep.
+
+    Returns
+    -------
+    df_return : DataFrame
+        As in read_panel.
+    """
+    if not reader_available():
+        raise ValueError("The panel reader requires pyarrow.")
+
+    dates = panel_dates(filename)
+    date_observed = np.zeros(len(dates), dtype=bool)
+
+    def selected_blocks():
+        for fundids, secids, values in read_blocks(filename, exp_dtype,
+                                                   block_size):
+            np.logical_or(date_observed, pd.notna(values).any(axis=1),
+                          out=date_observed)
+            rows = np.flatnonzero(select_rows(fundids))
+            yield fundids[rows], secids[rows], values[:, rows]
+            del values
+
+    if sparse:
+        return _reshape_sparse(selected_blocks(), value_name, exp_dtype, dates)
+
+    # A dense output is allocated up front, so the selected rows are
+    # gathered before they are reshaped. Every block has been read by
+    # then, so date_observed covers the whole file.
+    blocks = list(selected_blocks())
+    return _reshape_dense(blocks, sum(values.shape[1] for _, _, values in blocks),
+                          value_name, exp_dtype, dates, date_observed, filename)
+
+def panel_dates(filename):
+    """Return the month index of each month column of a panel file."""
+    with open(filename, newline="", encoding="utf-8") as f:
+        col_names = pd.Index(next(csv.reader(f)))
+
+    return month_index.to_months(pd.to_datetime(col_names[3:]))
+
+def reshape_blocks(blocks, value_name, exp_dtype, dates, sparse=False,
+                   num_rows=None, date_observed=None, source="the panel"):
+    """
+    Reshape blocks of a wide panel, such as those yielded by read_blocks
+    for some or all of the rows of a file, into tall format, as
+    read_panel does for a whole file.
+
+    Parameters
+    ----------
+    blocks : iterable of (ndarray, ndarray, ndarray)
+        The fundids, secids and (month x row) values of each block.
+    value_name, exp_dtype, sparse
+        As in read_panel.
+    dates : ndarray
+        The month index of each month of the blocks.
+    num_rows : int, default None
+        The total number of rows in the blocks, which must be given for
+        dense panels.
+    date_observed : ndarray of bool, default None
+        For dense panels, the months to keep. If None, the months with
+        an observed cell in the blocks are kept.
+    source : str, default "the panel"
+        A name for the blocks used in error messages.
+
+    Returns
+    -------
+    df_return : DataFrame
+        As in read_panel.
+    """
+    if sparse:
+        return _reshape_sparse(blocks, value_name, exp_dtype, dates)
+
+    return _reshape_dense(blocks, num_rows, value_name, exp_dtype, dates,
+                          date_observed, source)
+
+def _encode_ids(fundid_parts, secid_parts):
+    """
+    Encode the identifiers of every row of a panel as categoricals.
+    Identifiers are encoded once per row of the file rather than once
+    per output cell. A panel may have no rows at all.
+    """
+    return [pd.Categorical(np.concatenate(parts) if parts
+                           else np.array([], dtype=object))
+            for parts in [fundid_parts, secid_parts]]
+
+def _reshape_dense(blocks, num_rows, value_name, exp_dtype, dates,
+                   date_observed, source):
+    """Reshape every secid-month pair of a panel, as in a melt."""
+    # Every cell is returned, so the output can be allocated up front
+    # and each block copied straight into place. The output is held as
+    # a (month x secid) array, which is the row order of a melt.
+    values_out = np.empty((len(dates), num_rows), dtype=exp_dtype)
+    find_observed = date_observed is None
+    if find_observed:
+        date_observed = np.zeros(len(dates), dtype=bool)
+
+    fundid_parts, secid_parts = [], []
+    row = 0
+    for fundids, secids, values in blocks:
+        block_rows = values.shape[1]
+        if row + block_rows > num_rows:
+            raise ValueError(f"Unexpected line breaks found in {source}.")
+
+        values_out[:, row:row + block_rows] = values
+        if find_observed:
+            date_observed |= pd.notna(values).any(axis=1)
+        fundid_parts.append(fundids)
+        secid_parts.append(secids)
+        row += block_rows
+        del values
+
+    if row != num_rows:
+        raise ValueError(f"Unexpected line breaks found in {source}.")
+
+    # Drop months with no observed cells, as in read_wide_panel, by
+    # moving the kept months to the front of the output in place.
+    kept = np.flatnonzero(date_observed)
+    for i, date_ix in enumerate(kept):
+        if i != date_ix:
+            values_out[i] = values_out[date_ix]
+    values_out = values_out[:len(kept)].reshape(-1)
+
+    fundids, secids = _encode_ids(fundid_parts, secid_parts)
+    del fundid_parts, secid_parts
+
+    df_return = pd.DataFrame({
+        "fundid": pd.Categorical.from_codes(np.tile(fundids.codes, len(kept)),
+                                            fundids.categories),
+        "secid": pd.Categorical.from_codes(np.tile(secids.codes, len(kept)),
+                                           secids.categories),
+        "date": dates[kept].repeat(num_rows)
+    }, copy=False)
+    df_return[value_name] = values_out
+
+    return df_return
+
+def _reshape_sparse(blocks, value_name, exp_dtype, dates):
+    """Reshape only the observed cells of a panel."""
+    # Each block is reduced to the month, row and value of each of its
+    # observed cells, and to its number of observed cells in each month.
+    fundid_parts, secid_parts = [], []
+    date_parts, row_parts, value_parts, block_counts = [], [], [], []
+    num_rows = 0
+    for fundids, secids, values in blocks:
+        observed = pd.notna(values)
+        date_ix, row_ix = np.nonzero(observed)
+
+        fundid_parts.append(fundids)
+        secid_parts.append(secids)
+        date_parts.append(date_ix.astype(np.int32))
+        row_parts.append((row_ix + num_rows).astype(np.int32))
+        value_parts.append(values[date_ix, row_ix])
+        block_counts.append(observed.sum(axis=1))
+        num_rows += values.shape[1]
+        del values, observed, date_ix, row_ix
+
+    # The output is ordered by month and then by row. Within a month,
+    # the cells of each block follow those of the blocks before it, so
+    # the position of every cell follows from the counts alone and no
+    # sort is needed.
+    block_counts = (np.array(block_counts, dtype=np.int64)
+                      .reshape(-1, len(dates)))
+    date_starts = np.cumsum(block_counts.sum(axis=0)) - block_counts.sum(axis=0)
+    block_starts = date_starts + np.cumsum(block_counts, axis=0) - block_counts
+    num_cells = block_counts.sum()
+
+    date_out = np.empty(num_cells, dtype=np.int32)
+    row_out = np.empty(num_cells, dtype=np.int32)
+    values_out = np.empty(num_cells, dtype=exp_dtype)
+    for b in range(len(block_counts)):
+        # Cells within a block are already ordered by month and row.
+        date_ix = date_parts[b]
+        in_block_starts = np.cumsum(block_counts[b]) - block_counts[b]
+        positions = ((block_starts[b] - in_block_starts)[date_ix]
+                     + np.arange(len(date_ix)))
+
+        date_out[positions] = date_ix
+        row_out[positions] = row_parts[b]
+        values_out[positions] = value_parts[b]
+        date_parts[b] = row_parts[b] = value_parts[b] = None
+
+    fundids, secids = _encode_ids(fundid_parts, secid_parts)
+    del fundid_parts, secid_parts
+
+    df_return = pd.DataFrame({
+        "fundid": pd.Categorical.from_codes(fundids.codes[row_out],
+                                            fundids.categories),
+        "secid": pd.Categorical.from_codes(secids.codes[row_out],
+                                           secids.categories),
+    }, copy=False)
+    del row_out
+    df_return["date"] = dates[date_out]
+    del date_out
+    df_return[value_name] = values_out
+
+    return df_return
@@ -0,0 +1,252 @@
+"""
+Fundid-hash partitions of fund data, spilled to local disk for the
+out-of-core runs of process-mf-data.py.
+
+Every stage of process_fund_data holds a whole country group in memory,
+so the largest groups need the most memory, however few funds are
+processed at a time. An out-of-core run instead reads each panel file
+block by block (see panel_reader), splits every block between
+partitions by a hash of its fundids, and appends each part to a file
+for its partition, so that the partitions can later be loaded and
+processed one at a time. Peak memory then depends on the size of a
+partition rather than the size of the group.
+
+Panels are spilled wide, as Arrow IPC streams with one row per secid,
+and reshaped when a partition is loaded. A dense panel keeps every
+month with an observed cell anywhere in its file, so each partition is
+loaded exactly as its funds are by a sharded run.
+
+Processed partitions are spilled as uncompressed Arrow IPC files, which
+are memory mapped when they are read back, so that rows can be merged
+across partitions without loading any partition in full.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from shared import month_index
+from shared import panel_reader
+
+try:
+    import pyarrow
+    import pyarrow.feather as feather
+except ImportError:
+    pyarrow = None
+    feather = None
+
+def spill_available():
+    """Return True if the optional pyarrow dependency is installed."""
+    return pyarrow is not None
+
+def _panel_path(spill_dir, name, partition):
+    """Return the path of one partition of a spilled panel."""
+    return os.path.join(spill_dir, f"{name}_{partition}.arrow")
+
+def _meta_path(spill_dir, name):
+    """Return the path of the description of a spilled panel."""
+    return os.path.join(spill_dir, f"{name}.json")
+
+def spill_panel(filename, spill_dir, name, exp_dtype, assign_partitions,
+                num_partitions, block_size=panel_reader.BLOCK_SIZE):
+    """
+    Split one wide panel csv into partitions of its rows, saving each
+    partition to spill_dir.
+
+    Parameters
+    ----------
+    filename : str
+        The path of the panel file.
+    spill_dir : str
+        The directory to save the partitions into. It must already
+        exist.
+    name : str
+        A name for the panel, which the partitions are saved under.
+    exp_dtype : type
+        The datatype of the month columns, as in panel_reader.read_panel.
+    assign_partitions : callable
+        A function from an array of the fundids of some rows to an
+        array of the partition of each row.
+    num_partitions : int
+        The number of partitions.
+    block_size : int, default panel_reader.BLOCK_SIZE
+        The approximate number of bytes of csv text read at a time.
+    """
+    if not spill_available():
+        raise ValueError("Spilling partitions requires pyarrow.")
+
+    dates = panel_reader.panel_dates(filename)
+    value_type = pyarrow.list_(panel_reader._arrow_type(exp_dtype), len(dates))
+    schema = pyarrow.schema([("fundid", pyarrow.string()),
+                             ("secid", pyarrow.string()),
+                             ("values", value_type)])
+
+    date_observed = np.zeros(len(dates), dtype=bool)
+    num_rows = [0] * num_partitions
+    writers = []
+    try:
+        # Every partition gets a file, even if it has no rows.
+        for partition in range(num_partitions):
+            writers.append(pyarrow.ipc.new_stream(
+                _panel_path(spill_dir, name, partition), schema
+            ))
+
+        for fundids, secids, values in panel_reader.read_blocks(
+                filename, exp_dtype, block_size):
+            date_observed |= pd.notna(values).any(axis=1)
+            partitions = assign_partitions(fundids)
+
+            for partition in np.unique(partitions):
+                rows = np.flatnonzero(partitions == partition)
+
+                # The values of each row are stored as a list of one
+                # value per month.
+                row_values = pyarrow.array(values[:, rows].T.reshape(-1),
+                                           type=value_type.value_type,
+                                           from_pandas=True)
+                writers[partition].write_batch(pyarrow.record_batch(
+                    [pyarrow.array(fundids[rows], type=pyarrow.string()),
+                     pyarrow.array(secids[rows], type=pyarrow.string()),
+                     pyarrow.FixedSizeListArray.from_arrays(row_values,
+                                                            len(dates))],
+                    schema=schema
+                ))
+                num_rows[partition] += len(rows)
+            del values
+    finally:
+        for writer in writers:
+            writer.close()
+
+    with open(_meta_path(spill_dir, name), "w") as f:
+        json.dump({"dates": dates.tolist(),
+                   "date_observed": date_observed.tolist(),
+                   "num_rows": num_rows}, f)
+
+def _read_panel_blocks(path, exp_dtype, num_months):
+    """
+    Read the blocks of one partition of a spilled panel, in the form
+    that panel_reader.read_blocks yields them.
+    """
+    with pyarrow.OSFile(path) as source:
+        for batch in pyarrow.ipc.open_stream(source):
+            values = (
+                batch.column("values").flatten()
+                     .to_numpy(zero_copy_only=False)
+                     .reshape(batch.num_rows, num_months).T
+            )
+
+            # Missing strings are read as None, but the pandas reader
+            # leaves them as nan.
+            if values.dtype == object:
+                values[pd.isna(values)] = np.nan
+
+            yield (batch.column("fundid").to_numpy(zero_copy_only=False),
+                   batch.column("secid").to_numpy(zero_copy_only=False),
+                   values)
+
+def read_panel(spill_dir, name, partition, value_name, exp_dtype,
+               sparse=False):
+    """
+    Read one partition of a spilled panel into tall format.
+
+    The result is the same as reading the whole panel file with
+    panel_reader.read_panel and then selecting the rows of the
+    partition, apart from the categories of the identifiers, which are
+    those of the partition alone.
+
+    Parameters
+    ----------
+    spill_dir, name
+        As passed to spill_panel.
+    partition : int
+        The partition to read.
+    value_name, exp_dtype, sparse
+        As in panel_reader.read_panel.
+
+    Returns
+    -------
+    df_return : DataFrame
+        As in panel_reader.read_panel.
+    """
+    with open(_meta_path(spill_dir, name)) as f:
+        meta = json.load(f)
+    dates = np.asarray(meta["dates"], dtype=month_index.MONTH_DTYPE)
+    path = _panel_path(spill_dir, name, partition)
+
+    return panel_reader.reshape_blocks(
+        _read_panel_blocks(path, exp_dtype, len(dates)), value_name, exp_dtype,
+        dates, sparse, num_rows=meta["num_rows"][partition],
+        date_observed=np.asarray(meta["date_observed"], dtype=bool),
+        source=path
+    )
+
+def spill_frame(df, path):
+    """
+    Save a processed partition, for reading back with
+    read_frame_rows.
+    """
+    feather.write_feather(df, path, compression="uncompressed")
+
+def read_frame_rows(path, start, stop):
+    """
+    Read rows start to stop of a processed partition saved with
+    spill_frame, without reading the rest of the file.
+    """
+    table = feather.read_table(path, memory_map=True)
+
+    return table.slice(start, stop - start).to_pandas()
+
+def merge_partition_rows(paths, key_counts, max_rows):
+    """
+    Merge the rows of processed partitions in order of a key, in chunks.
+
+    Each partition must be sorted by the key, and each value of the key
+    must lie in a single partition, as every fundid does.
+
+    Parameters
+    ----------
+    paths : sequence of str
+        The path of each partition, as saved with spill_frame.
+    key_counts : sequence of Series
+        For each partition, the number of rows with each value of the
+        key, in the order of the partition's rows.
+    max_rows : int
+        The approximate number of rows in each chunk. Chunks only break
+        between values of the key, so a chunk can be larger.
+
+    Yields
+    ------
+    chunks : list of DataFrame
+        The rows of each partition in the next range of key values. Each
+        DataFrame comes from a single partition, so their categories
+        need not match. If there are no rows at all, a single empty
+        chunk is yielded, which still has the columns of the partitions.
+    """
+    # The first row of each key value within its partition.
+    keys = []
+    for partition, counts in enumerate(key_counts):
+        starts = np.cumsum(counts.to_numpy()) - counts.to_numpy()
+        keys.append(pd.DataFrame({"key": counts.index.astype(str),
+                                  "partition": partition,
+                                  "start": starts,
+                                  "stop": starts + counts.to_numpy()}))
+    df_keys = (
+        pd.concat(keys, ignore_index=True).sort_values(by="key", kind="stable")
+          .reset_index(drop=True)
+    )
+    df_keys["chunk"] = (
+        np.cumsum(df_keys.stop - df_keys.start) - (df_keys.stop - df_keys.start)
+    ) // max_rows
+
+    if df_keys.empty:
+        yield [read_frame_rows(paths[0], 0, 0)]
+        return
+
+    # Within a chunk, the rows of each partition are contiguous.
+    for _, df_chunk_keys in df_keys.groupby("chunk", sort=True):
+        rows = df_chunk_keys.groupby("partition", sort=True).agg(
+            start=("start", "min"), stop=("stop", "max")
+        )
+        yield [read_frame_rows(paths[partition], row.start, row.stop)
+               for partition, row in rows.iterrows()]
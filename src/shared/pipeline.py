@@ -0,0 +1,268 @@
+"""
+Fingerprints and a dependency-aware runner for the stages of the
+research pipeline (see run-pipeline.py).
+
+Each stage is a script with a set of input and output files, and runs
+once every stage it depends on has finished. A stage is skipped if
+neither its inputs nor its outputs have changed since it last ran
+successfully, which is recorded in a json state file. Stages whose
+dependencies have all finished run at once, up to a number of workers,
+so independent branches of the pipeline run concurrently.
+
+A stage can also be split into units, such as the country groups of
+process-mf-data.py, each with inputs and outputs of its own. Only the
+units that are out of date are then rebuilt, by passing their names to
+the stage's command as arguments.
+
+Files are fingerprinted by the hash of their contents, so a file that is
+rewritten with the same contents does not make later stages out of
+date. The content hash of each file is kept alongside its size and
+modification time, and a file is only read again once either changes.
+"""
+import glob
+import hashlib
+import json
+import os
+import queue
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+from shared import load_cache
+
+STATE_PATH = "data/cache/pipeline/state.json"
+
+# Bump this whenever the way stages are fingerprinted changes so that
+# every stage is run again.
+STATE_VERSION = 1
+
+# The number of bytes of a file hashed at a time.
+HASH_BLOCK_SIZE = 2**24
+
+def expand_paths(patterns):
+    """
+    Return the sorted paths of every file matched by some glob patterns,
+    including every file within a matched directory. Patterns that match
+    nothing are ignored, as are partly written files ending in ".tmp".
+    """
+    paths = set()
+    for pattern in patterns:
+        for match in glob.glob(pattern):
+            if os.path.isdir(match):
+                for root, _, filenames in os.walk(match):
+                    paths.update(os.path.join(root, filename)
+                                 for filename in filenames)
+            else:
+                paths.add(match)
+
+    return sorted(os.path.normpath(path) for path in paths
+                  if not path.endswith(".tmp"))
+
+def _content_hash(filename):
+    """Hash the contents of a file, reading it a block at a time."""
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+
+    return digest.hexdigest()[:16]
+
+def fingerprint(patterns, file_hashes):
+    """
+    Fingerprint the files matched by some glob patterns (see
+    expand_paths) by their paths and contents.
+
+    Parameters
+    ----------
+    patterns : sequence of str
+        The glob patterns.
+    file_hashes : dict
+        The content hash of each previously hashed file, keyed by path,
+        alongside its size and modification time. Updated in place with
+        every file that is hashed.
+
+    Returns
+    -------
+    key : str
+        The fingerprint, which is the same for the same set of paths
+        with the same contents.
+    """
+    entries = []
+    for path in expand_paths(patterns):
+        stat = os.stat(path)
+        cached = file_hashes.get(path)
+        if cached is None or cached[:2] != [stat.st_size, stat.st_mtime_ns]:
+            cached = [stat.st_size, stat.st_mtime_ns, _content_hash(path)]
+            file_hashes[path] = cached
+        entries.append([path.replace(os.sep, "/"), cached[2]])
+
+    return load_cache._hash(entries)
+
+def read_state(path=STATE_PATH):
+    """
+    Load the state of the pipeline, holding the fingerprints of each
+    stage or unit when it last ran successfully and the content hash of
+    every fingerprinted file. A missing state, or one written by an
+    older STATE_VERSION, is empty.
+    """
+    if os.path.exists(path):
+        with open(path) as f:
+            state = json.load(f)
+        if state.get("version") == STATE_VERSION:
+            return state
+
+    return {"version": STATE_VERSION, "stages": {}, "files": {}}
+
+def write_state(state, path=STATE_PATH):
+    """Save the state of the pipeline, replacing it in one step."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def _targets(name, stage):
+    """
+    Return the (state name, input patterns, output patterns) of each
+    unit of a stage, keyed by unit name. A stage without units has a
+    single unit named None.
+    """
+    if not stage.get("units"):
+        return {None: (name, stage["inputs"], stage["outputs"])}
+
+    return {unit: (f"{name}:{unit}", list(stage["inputs"]) + list(inputs),
+                   outputs)
+            for unit, (inputs, outputs) in stage["units"].items()}
+
+def stale_units(name, stage, state, force=False):
+    """
+    Return the units of a stage that are out of date, as a dict of the
+    fingerprint of each unit's inputs keyed by unit name (None for a
+    stage without units).
+
+    A unit is out of date if its inputs have changed since it last ran
+    successfully, or if its outputs have changed or been deleted since.
+    If force is True, every unit is out of date.
+    """
+    stale = {}
+    for unit, (target, inputs, outputs) in _targets(name, stage).items():
+        inputs_key = fingerprint(inputs, state["files"])
+        record = state["stages"].get(target)
+        if (force or record is None or record["inputs"] != inputs_key
+                or not expand_paths(outputs)
+                or record["outputs"] != fingerprint(outputs, state["files"])):
+            stale[unit] = inputs_key
+
+    return stale
+
+def _run_command(command):
+    """Run a stage's command, returning its exit code."""
+    return subprocess.run(command).returncode
+
+def run_stages(stages, workers=2, state_path=STATE_PATH, force=()):
+    """
+    Run every out-of-date stage of a pipeline, each once the stages it
+    depends on have finished.
+
+    Parameters
+    ----------
+    stages : dict
+        The stages of the pipeline, keyed by name. Each is a dict of:
+        "command", the command to run as a list of arguments; "deps", the
+        names of the stages it depends on; "inputs" and "outputs", lists
+        of glob patterns of the files it reads and writes, relative to
+        the current directory; and optionally "units", a dict mapping the
+        name of each unit to a pair of its own input and output patterns.
+        The inputs of a stage with units are shared by every unit. Every
+        stage should have outputs, or it is run every time.
+    workers : int, default 2
+        The maximum number of stages that may run at once.
+    state_path : str, default STATE_PATH
+        The path of the state file.
+    force : sequence of str, default ()
+        The names of stages to run even if they are up to date.
+
+    Returns
+    -------
+    outcomes : dict
+        The outcome of each stage, being "current" if it was skipped,
+        "ran" or "failed", or "blocked" if a stage it depends on failed.
+    """
+    if workers < 1:
+        raise ValueError("workers must be at least 1.")
+    for name, stage in stages.items():
+        unknown = set(stage["deps"]) - set(stages)
+        if unknown:
+            raise ValueError(f"Stage {name} depends on unknown stages "
+                             f"{sorted(unknown)}.")
+
+    state = read_state(state_path)
+    outcomes = {}
+    running = {}
+    finished = queue.Queue()
+
+    with ThreadPool(processes=workers) as pool:
+        while len(outcomes) < len(stages):
+            # Start, or skip, every stage whose dependencies have all
+            # finished. Fingerprints are only taken at this point, so
+            # that they include the outputs of those dependencies.
+            num_started = len(outcomes) + len(running)
+            for name, stage in stages.items():
+                if name in outcomes or name in running:
+                    continue
+                dep_outcomes = [outcomes.get(dep) for dep in stage["deps"]]
+                if None in dep_outcomes:
+                    continue
+                if any(outcome in ["failed", "blocked"]
+                       for outcome in dep_outcomes):
+                    outcomes[name] = "blocked"
+                    print(f"Skipping {name}, as a stage it depends on failed")
+                    continue
+
+                stale = stale_units(name, stage, state, force=name in force)
+                if not stale:
+                    outcomes[name] = "current"
+                    print(f"{name} is up to date")
+                    continue
+
+                command = list(stage["command"])
+                if stage.get("units"):
+                    command += list(stale)
+                    print(f"Running {name} for {', '.join(stale)}")
+                else:
+                    print(f"Running {name}")
+
+                running[name] = stale
+                pool.apply_async(
+                    _run_command, (command,),
+                    callback=lambda code, name=name: finished.put((name, code)),
+                    error_callback=lambda error, name=name: finished.put(
+                        (name, error))
+                )
+
+            if not running:
+                if len(outcomes) + len(running) == num_started:
+                    raise ValueError("The dependencies of stages "
+                                     f"{sorted(set(stages) - set(outcomes))} "
+                                     "form a cycle.")
+                continue
+
+            name, code = finished.get()
+            stale = running.pop(name)
+            if code != 0:
+                outcomes[name] = "failed"
+                print(f"{name} failed: {code!r}")
+                continue
+
+            # Record the fingerprints of every unit that was run, as they
+            # were when it started and as it left its outputs.
+            targets = _targets(name, stages[name])
+            for unit, inputs_key in stale.items():
+                target, _, outputs = targets[unit]
+                state["stages"][target] = {
+                    "inputs": inputs_key,
+                    "outputs": fingerprint(outputs, state["files"])
+                }
+            write_state(state, state_path)
+            outcomes[name] = "ran"
+
+    return outcomes
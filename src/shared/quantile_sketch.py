@@ -0,0 +1,169 @@
+"""
+Compact, mergeable summaries of the distribution of a set of values,
+for finding quantiles across country groups that are processed in
+separate workers.
+
+Fund flows are winsorised at their 1st and 99th percentiles. Pooling
+those percentiles across every country group would otherwise need the
+flows of every group in one process. Instead, each worker summarises
+its flows in a sketch, and the sketches of every group are merged into
+one from which the pooled percentiles are read.
+
+A sketch counts the values that fall into logarithmically spaced
+buckets (a DDSketch), separately for positive and negative values, with
+values of magnitude below MIN_VALUE counted as zero. Any value in a
+bucket lies within RELATIVE_ACCURACY of the bucket's representative
+value, so each quantile read from a sketch is within RELATIVE_ACCURACY
+of an order statistic of the values at the same rank. Merging adds the
+bucket counts, so a merged sketch is exactly the sketch of the values
+of every merged sketch together, in whatever order they are merged.
+The size of a sketch depends on the range of the values rather than
+their number.
+"""
+import numpy as np
+
+# The relative error of the quantiles read from a sketch.
+RELATIVE_ACCURACY = 1e-4
+
+# Values of smaller magnitude than this are counted as zero.
+MIN_VALUE = 1e-12
+
+# The ratio between the bounds of consecutive buckets.
+_GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+
+def _bucket_counts(magnitudes):
+    """
+    Return the sorted bucket indices of some magnitudes and the number of
+    magnitudes in each. Bucket i holds magnitudes in (GAMMA**(i-1),
+    GAMMA**i].
+    """
+    indices = np.ceil(np.log(magnitudes) / np.log(_GAMMA)).astype(np.int32)
+    return np.unique(indices, return_counts=True)
+
+def summarise(values):
+    """
+    Summarise values in a sketch.
+
+    Parameters
+    ----------
+    values : array-like of float
+        The values to summarise. Missing values are ignored, and every
+        other value must be finite.
+
+    Returns
+    -------
+    sketch : dict
+        The number of values (count), the smallest and largest values
+        (min and max, which are nan if there are none), the number of
+        values counted as zero (zeros), and the bucket indices and counts
+        of the positive and negative values (positive and negative, each
+        an (indices, counts) pair of arrays). A sketch can be pickled to
+        pass it between processes.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    if not np.isfinite(values).all():
+        raise ValueError("Infinite values cannot be summarised.")
+
+    magnitudes = np.abs(values)
+    nonzero = magnitudes >= MIN_VALUE
+
+    return {
+        "count": len(values),
+        "min": values.min() if len(values) else np.nan,
+        "max": values.max() if len(values) else np.nan,
+        "zeros": int((~nonzero).sum()),
+        "positive": _bucket_counts(magnitudes[nonzero & (values > 0)]),
+        "negative": _bucket_counts(magnitudes[nonzero & (values < 0)]),
+    }
+
+def _merge_buckets(buckets):
+    """Add up the counts of a sequence of (indices, counts) pairs."""
+    indices = np.concatenate([bucket_indices for bucket_indices, _ in buckets])
+    counts = np.concatenate([bucket_counts for _, bucket_counts in buckets])
+
+    merged_indices, inverse = np.unique(indices, return_inverse=True)
+    merged_counts = np.zeros(len(merged_indices), dtype=np.int64)
+    np.add.at(merged_counts, inverse, counts)
+
+    return merged_indices.astype(np.int32), merged_counts
+
+def merge(sketches):
+    """
+    Merge sketches into the sketch of all of their values together.
+
+    Parameters
+    ----------
+    sketches : sequence of dict
+        Sketches made by summarise or merge. There must be at least one.
+
+    Returns
+    -------
+    sketch : dict
+        As in summarise.
+    """
+    if not sketches:
+        raise ValueError("At least one sketch must be merged.")
+
+    return {
+        "count": sum(sketch["count"] for sketch in sketches),
+        "min": np.fmin.reduce([sketch["min"] for sketch in sketches]),
+        "max": np.fmax.reduce([sketch["max"] for sketch in sketches]),
+        "zeros": sum(sketch["zeros"] for sketch in sketches),
+        "positive": _merge_buckets([sketch["positive"] for sketch in sketches]),
+        "negative": _merge_buckets([sketch["negative"] for sketch in sketches]),
+    }
+
+def quantile(sketch, q, interpolation="lower"):
+    """
+    Return a quantile of the values summarised in a sketch.
+
+    Parameters
+    ----------
+    sketch : dict
+        A sketch made by summarise or merge.
+    q : float
+        The quantile to return, between 0 and 1.
+    interpolation : {"lower", "higher"}, default "lower"
+        Whether to return the order statistic below or above the quantile
+        when it falls between two, as in pandas.Series.quantile.
+
+    Returns
+    -------
+    value : float
+        A value within RELATIVE_ACCURACY of the order statistic, which is
+        exact if that is the smallest or largest value. nan if the sketch
+        has no values.
+    """
+    if interpolation not in ["lower", "higher"]:
+        raise ValueError("interpolation must be 'lower' or 'higher'.")
+    if not 0 <= q <= 1:
+        raise ValueError("q must be between 0 and 1.")
+
+    count = sketch["count"]
+    if count == 0:
+        return np.nan
+
+    position = q * (count - 1)
+    rank = int(np.floor(position) if interpolation == "lower"
+               else np.ceil(position))
+    if rank == 0:
+        return sketch["min"]
+    if rank == count - 1:
+        return sketch["max"]
+
+    # Walk the buckets in ascending order of their values: negative
+    # values from the largest magnitude down, then zeros, then positive
+    # values from the smallest magnitude up.
+    negative_indices, negative_counts = sketch["negative"]
+    positive_indices, positive_counts = sketch["positive"]
+    indices = np.concatenate([negative_indices[::-1], [0], positive_indices])
+    counts = np.concatenate([negative_counts[::-1], [sketch["zeros"]],
+                             positive_counts])
+    signs = np.concatenate([np.full(len(negative_indices), -1.0), [0.0],
+                            np.ones(len(positive_indices))])
+
+    bucket = np.searchsorted(np.cumsum(counts), rank, side="right")
+    value = signs[bucket] * 2 * _GAMMA**indices[bucket] / (_GAMMA + 1)
+
+    return float(np.clip(value, sketch["min"], sketch["max"]))
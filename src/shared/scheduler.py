@@ -0,0 +1,77 @@
+"""
+A size-aware process pool for running one job per country group.
+
+Country groups differ in size by more than an order of magnitude, so
+running them in a fixed order with a fixed number of workers can leave
+the largest group starting last, or start several large groups at once
+and exhaust memory. This scheduler starts the most expensive jobs first,
+and only admits a new job while the estimated peak memory of every
+running job stays within a budget. Results are yielded as each job
+finishes, as with Pool.imap_unordered.
+"""
+import multiprocessing
+import queue
+
+def imap_budgeted(func, costs, workers=4, memory_budget=None):
+    """
+    Run func on each job in a process pool, largest jobs first, while
+    keeping the estimated memory of all running jobs within a budget.
+
+    Parameters
+    ----------
+    func : callable
+        A picklable function of a single job argument.
+    costs : dict
+        A mapping from each job argument to its estimated peak memory
+        in bytes. Jobs are started in descending order of cost.
+    workers : int, default 4
+        The maximum number of jobs that may run at once.
+    memory_budget : int, default None
+        The maximum total estimated memory of all running jobs, in
+        bytes. A job larger than the budget is still run, but only
+        once no other job is running. If None, only the number of
+        workers is limited.
+
+    Yields
+    ------
+    job, result, error
+        Each job argument as it finishes, with the return value of
+        func and None, or with None and the exception that func
+        raised. An exception in one job does not stop the others.
+    """
+    if workers < 1:
+        raise ValueError("workers must be at least 1.")
+
+    pending = sorted(costs, key=lambda job: costs[job], reverse=True)
+    running = {}
+    finished = queue.Queue()
+
+    # Each worker runs one job only, so that the memory used by a large
+    # job is returned to the system before the next job starts.
+    with multiprocessing.Pool(processes=workers, maxtasksperchild=1) as pool:
+        while pending or running:
+            # Admit the largest pending jobs that fit in the budget. Any
+            # smaller job that fits may jump ahead of a large job that
+            # does not, so that workers are not left idle.
+            for job in list(pending):
+                if len(running) >= workers:
+                    break
+
+                used = sum(running.values())
+                if (memory_budget is not None and running
+                        and used + costs[job] > memory_budget):
+                    continue
+
+                pending.remove(job)
+                running[job] = costs[job]
+                pool.apply_async(
+                    func, (job,),
+                    callback=lambda result, job=job: finished.put(
+                        (job, result, None)),
+                    error_callback=lambda error, job=job: finished.put(
+                        (job, None, error))
+                )
+
+            job, result, error = finished.get()
+            del running[job]
+            yield job, result, error
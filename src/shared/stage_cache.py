@@ -0,0 +1,278 @@
+"""
+Content-addressed checkpoints for the stages of process-mf-data.py.
+
+Each stage of process_fund_data (loading, merging, interpolation, the
+equity filter and aggregation) can save its output as a checkpoint, so
+that a rerun after a crash or a change to a later stage can resume from
+the deepest stage whose output is still valid, instead of starting over.
+
+A checkpoint is keyed by a hash of the key of the stage before it, the
+fingerprints of any source files the stage reads, and the options that
+affect the stage. Changing an option or a source file therefore changes
+the key of every stage from that point on, and never the keys of the
+stages before it.
+
+Each checkpoint is stored as one uncompressed Arrow IPC file per
+DataFrame, plus a small json manifest that is written last, so that a
+checkpoint is only ever read if every one of its files was written. The
+total size of the checkpoint directory is kept under a limit by deleting
+the least recently used checkpoints.
+"""
+import json
+import os
+
+import numpy as np
+
+from shared import load_cache
+
+try:
+    import pyarrow
+    import pyarrow.feather as feather
+except ImportError:
+    pyarrow = None
+    feather = None
+
+CHECKPOINT_DIR = "data/mutual-funds/cache/stages"
+
+# The default limit on the total size of the checkpoint directory.
+MAX_BYTES = 20 * 2**30
+
+# Bump this whenever the output of any stage changes so that any
+# checkpoints written by older code are ignored.
+CHECKPOINT_VERSION = 3
+
+def stage_key(parent_key, stage, filenames=(), **options):
+    """
+    Hash a stage's parent key, source files and options.
+
+    Parameters
+    ----------
+    parent_key : str or None
+        The key of the stage before this one, or None for the first
+        stage.
+    stage : str
+        The name of the stage.
+    filenames : sequence of str, default ()
+        The source files read by this stage. Each is fingerprinted by
+        its path, size and modification time.
+    **options
+        The options that affect the output of this stage.
+
+    Returns
+    -------
+    key : str
+    """
+    return load_cache._hash({
+        "version": CHECKPOINT_VERSION,
+        "parent": parent_key,
+        "stage": stage,
+        "sources": [load_cache.source_key(f) for f in filenames],
+        "options": options
+    })
+
+def _manifest_path(stage, key, cache_dir):
+    return os.path.join(cache_dir, f"{stage}.{key}.json")
+
+def _part_path(stage, key, part, cache_dir):
+    return os.path.join(cache_dir, f"{stage}.{key}.{part}.arrow")
+
+def read_checkpoint(stage, key, cache_dir=CHECKPOINT_DIR):
+    """
+    Load the output of a stage if a complete checkpoint exists.
+
+    Parameters
+    ----------
+    stage : str
+        The name of the stage.
+    key : str
+        The stage key, as returned by stage_key.
+    cache_dir : str, default CHECKPOINT_DIR
+        The directory that holds the checkpoints.
+
+    Returns
+    -------
+    data : DataFrame, dict of DataFrame, or None
+        The saved output of the stage, in the form it was saved in, or
+        None if there is no complete checkpoint.
+    """
+    if not load_cache.cache_available():
+        return None
+
+    # Another process sharing the directory can evict the checkpoint at
+    # any point while it is read, which is treated as a missing
+    # checkpoint.
+    manifest_path = _manifest_path(stage, key, cache_dir)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    parts = {}
+    for part, saved in manifest["parts"].items():
+        if not saved:
+            parts[part] = None
+            continue
+
+        part_path = _part_path(stage, key, part, cache_dir)
+        try:
+            df_part = feather.read_table(part_path, memory_map=True).to_pandas()
+        except FileNotFoundError:
+            return None
+
+        # Restore NaN for missing strings, as in load_cache.
+        for col in df_part.columns[df_part.dtypes == object]:
+            df_part[col] = df_part[col].fillna(np.nan)
+
+        parts[part] = df_part
+
+    # Mark the checkpoint as recently used so that it is evicted last.
+    try:
+        os.utime(manifest_path)
+    except FileNotFoundError:
+        pass
+
+    if manifest["single"]:
+        return parts["data"]
+
+    return parts
+
+def write_checkpoint(data, stage, key, cache_dir=CHECKPOINT_DIR,
+                     max_bytes=MAX_BYTES):
+    """
+    Save the output of a stage as a checkpoint, then evict the least
+    recently used checkpoints until the directory fits within
+    max_bytes.
+
+    Outputs containing columns that Arrow cannot represent are silently
+    left unsaved.
+
+    Parameters
+    ----------
+    data : DataFrame or dict of DataFrame
+        The output of the stage. Values of a dict may be None.
+    stage : str
+        The name of the stage.
+    key : str
+        The stage key, as returned by stage_key.
+    cache_dir : str, default CHECKPOINT_DIR
+        The directory that holds the checkpoints.
+    max_bytes : int, default MAX_BYTES
+        The limit on the total size of the checkpoint directory.
+
+    Returns
+    -------
+    written : bool
+        True if a checkpoint was written.
+    """
+    if not load_cache.cache_available():
+        return False
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    single = not isinstance(data, dict)
+    parts = {"data": data} if single else data
+
+    # Write every part to a temporary file first, and only move them
+    # into place once all of them have been written.
+    tmp_paths = {}
+    try:
+        for part, df_part in parts.items():
+            if df_part is None:
+                continue
+
+            tmp_path = (
+                f"{_part_path(stage, key, part, cache_dir)}.{os.getpid()}.tmp"
+            )
+            tmp_paths[part] = tmp_path
+            table = pyarrow.Table.from_pandas(df_part, preserve_index=True)
+            feather.write_feather(table, tmp_path, compression="uncompressed")
+    except (pyarrow.ArrowException, ValueError, TypeError):
+        for tmp_path in tmp_paths.values():
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return False
+
+    for part, tmp_path in tmp_paths.items():
+        os.replace(tmp_path, _part_path(stage, key, part, cache_dir))
+
+    manifest_path = _manifest_path(stage, key, cache_dir)
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"single": single,
+                   "parts": {part: df_part is not None
+                             for part, df_part in parts.items()}}, f)
+    os.replace(tmp_path, manifest_path)
+
+    evict(cache_dir, max_bytes, keep=(stage, key))
+
+    return True
+
+def evict(cache_dir=CHECKPOINT_DIR, max_bytes=MAX_BYTES, keep=None):
+    """
+    Delete the least recently used checkpoints until the total size of
+    the checkpoint directory is at most max_bytes.
+
+    Parameters
+    ----------
+    cache_dir : str, default CHECKPOINT_DIR
+        The directory that holds the checkpoints.
+    max_bytes : int, default MAX_BYTES
+        The limit on the total size of the checkpoint directory.
+    keep : (str, str), default None
+        The (stage, key) pair of a checkpoint that should never be
+        evicted, such as the one that has just been written.
+
+    Returns
+    -------
+    evicted : list of (str, str)
+        The (stage, key) pairs of the deleted checkpoints.
+    """
+    if not os.path.exists(cache_dir):
+        return []
+
+    # Group every file under the checkpoint it belongs to, with its size,
+    # and date each checkpoint by the last time its manifest was written
+    # or read. Other processes sharing the directory can delete files at
+    # any point, and files that have gone are skipped.
+    checkpoints = {}
+    for entry in os.listdir(cache_dir):
+        if entry.endswith(".tmp"):
+            continue
+
+        path = os.path.join(cache_dir, entry)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+
+        checkpoint = tuple(entry.split(".")[:2])
+        files, last_used = checkpoints.get(checkpoint, ([], 0))
+        files.append((path, stat.st_size))
+        if entry.endswith(".json"):
+            last_used = stat.st_mtime_ns
+        checkpoints[checkpoint] = (files, last_used)
+
+    total_bytes = sum(size for files, _ in checkpoints.values()
+                      for _, size in files)
+
+    evicted = []
+    for checkpoint, (files, _) in sorted(checkpoints.items(),
+                                         key=lambda item: item[1][1]):
+        if total_bytes <= max_bytes:
+            break
+        if checkpoint == keep:
+            continue
+
+        # Remove the manifest first so that a partly deleted checkpoint
+        # can never be read.
+        for path, size in sorted(files,
+                                 key=lambda file: not file[0].endswith(".json")):
+            total_bytes -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        evicted.append(checkpoint)
+
+    return evicted
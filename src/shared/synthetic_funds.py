@@ -0,0 +1,307 @@
+"""
+Synthetic Morningstar-shaped fund data for benchmarking.
+
+The real fund data cannot be shared, so this module writes synthetic
+data in exactly the layout that process-mf-data.py reads: one wide csv
+per field and country group under data/mutual-funds/domicile-grouped,
+with one row per secid and one column per month, a cross-sectional
+info table, and a matching data/mappings/morningstar_categories.csv.
+
+The data is random, but shaped like the real data in the ways that
+matter for performance. Funds have one or more share classes (secids)
+that start and end at different times, so every panel has leading and
+trailing missing months as well as scattered missing cells. Net assets
+are occasionally exactly zero, net returns are occasionally exactly
+zero, and funds change Morningstar category from time to time, with
+the odd share class disagreeing with the rest of its fund.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# The domiciles in each country group, as in CommonConstants.jl. The
+# "other" group is given a few domiciles outside of every other group.
+GROUP_DOMICILES = {
+    "lux": ["Luxembourg"],
+    "kor": ["South Korea"],
+    "usa": ["United States"],
+    "can-chn-jpn": ["Canada", "China", "Japan"],
+    "irl-bra": ["Ireland", "Brazil"],
+    "gbr-fra-ind": ["United Kingdom", "France", "India"],
+    "esp-tha-aus-zaf-mex-aut-che": ["Spain", "Thailand", "Australia",
+                                    "South Africa", "Mexico", "Austria",
+                                    "Switzerland"],
+    "other": ["Germany", "Netherlands", "Singapore"]
+}
+
+# The default share of the months in which a secid is alive that are
+# missing from each panel.
+MISSING_RATES = {"gross-returns": 0.1, "net-returns": 0.05, "costs": 0.2,
+                 "net-assets": 0.3, "category": 0.05}
+
+# The name of the file that records how the synthetic data was made.
+SPEC_NAME = "synthetic-data.json"
+
+def _category_table(num_categories, rng):
+    """Build a table of Morningstar categories and their definitions."""
+    # Roughly as in the real mapping, most categories are equity, some
+    # of those are not strict equity or are financial and real estate
+    # sectors, and a few are ambiguous (neither clearly equity nor
+    # clearly non-equity).
+    kind = rng.choice(["equity", "broad", "finre", "other", "ambiguous"],
+                      size=num_categories, p=[0.5, 0.1, 0.1, 0.2, 0.1])
+    equity = np.select([kind == "other", kind == "ambiguous"], [0, np.nan], 1)
+    strict_equity = np.select([kind == "broad", kind == "other",
+                               kind == "ambiguous"], [0, 0, np.nan], 1)
+    fin_or_re = (kind == "finre").astype(int)
+
+    regions = {"North America": ("DM", "Americas", "USA"),
+               "Europe": ("DM", "Europe", "EUR"),
+               "Asia": ("EM", "Asia", "CHN"),
+               "Global": ("DM", "Global", "GLB")}
+    region = rng.choice(list(regions), size=num_categories)
+
+    df_categories = pd.DataFrame({
+        "morningstar_category": [f"Synthetic Category {i + 1:03d}"
+                                 for i in range(num_categories)],
+        "equity": equity,
+        "strict_equity": strict_equity,
+        "fin_or_re": fin_or_re,
+        "inv_msci_class": [regions[r][0] for r in region],
+        "inv_region": [regions[r][1] for r in region],
+        "inv_group": region,
+        "inv_country": [regions[r][2] for r in region]
+    })
+
+    # Ambiguous categories have no investment target.
+    ambiguous = kind == "ambiguous"
+    df_categories.loc[ambiguous, ["inv_msci_class", "inv_region",
+                                  "inv_group", "inv_country"]] = np.nan
+
+    return df_categories
+
+def _wide_panel(df_ids, months, values, observed):
+    """Lay out one panel as it appears in a domicile-grouped file."""
+    if values.dtype == object:
+        values = np.where(observed, values, None)
+    else:
+        values = np.where(observed, values, np.nan)
+
+    df_values = pd.DataFrame(values, columns=months.strftime("%Y-%m"))
+    return pd.concat([df_ids, df_values], axis=1)
+
+def _write_panel(df_panel, root_dir, filename_base, country_group_code):
+    """Save one panel in the domicile-grouped layout."""
+    folder_dir = os.path.join(root_dir, "data", "mutual-funds",
+                              "domicile-grouped", filename_base)
+    if not os.path.exists(folder_dir):
+        os.makedirs(folder_dir)
+
+    df_panel.to_csv(os.path.join(folder_dir,
+                                 f"mf_{filename_base}_{country_group_code}.csv"),
+                    index=False)
+
+def _generate_group(root_dir, country_group_code, categories, months, num_funds,
+                    max_classes_per_fund, missing_rates, zero_asset_rate,
+                    zero_return_rate, category_churn, rng):
+    """Write every table for one country group, returning its secid count."""
+    num_months = len(months)
+
+    # Funds have between one and max_classes_per_fund share classes,
+    # with single-class funds the most common.
+    class_counts = np.minimum(rng.geometric(0.5, size=num_funds),
+                              max_classes_per_fund)
+    fund_ix = np.repeat(np.arange(num_funds), class_counts)
+    class_ix = np.concatenate([np.arange(count) for count in class_counts])
+    num_secids = len(fund_ix)
+
+    domiciles = GROUP_DOMICILES.get(country_group_code, GROUP_DOMICILES["other"])
+    fund_domiciles = rng.choice(domiciles, size=num_funds)
+
+    prefix = "".join(c for c in country_group_code if c.isalnum()).upper()[:3]
+    df_ids = pd.DataFrame({
+        "name": [f"Synthetic Fund {f} Class {c}" for f, c in zip(fund_ix, class_ix)],
+        "fundid": [f"FS{prefix}{f:07d}" for f in fund_ix],
+        "secid": [f"F0{prefix}{f:07d}{c}" for f, c in zip(fund_ix, class_ix)]
+    })
+
+    # Each fund lives for part of the sample, and each of its classes
+    # starts at or after the fund starts. Every class is alive for at
+    # least one month of the sample, as empty rows are dropped from the
+    # real data.
+    fund_start = rng.integers(-num_months // 2, num_months - 1, size=num_funds)
+    fund_end = np.maximum(fund_start + rng.integers(12, 2 * num_months,
+                                                    size=num_funds), 1)
+    secid_start = np.minimum(
+        fund_start[fund_ix] + rng.integers(0, 24, size=num_secids) * (class_ix > 0),
+        num_months - 1
+    )
+    secid_end = np.maximum(fund_end[fund_ix] - rng.integers(0, 12, size=num_secids),
+                           np.maximum(secid_start, 0) + 1)
+    month = np.arange(num_months)
+    alive = (month >= secid_start[:, None]) & (month < secid_end[:, None])
+
+    def observed(panel):
+        return alive & (rng.random(alive.shape) >= missing_rates[panel])
+
+    # Monthly returns and costs, in percent. Classes of the same fund hold
+    # the same assets, so they share returns up to their costs.
+    fund_returns = rng.normal(0.7, 4.5, size=(num_funds, num_months))
+    costs = np.round(rng.uniform(0.3, 2.5, size=(num_secids, 1))
+                     * np.ones((1, num_months)), 4)
+    gross_returns = np.round(fund_returns[fund_ix]
+                             + rng.normal(0, 0.05, size=alive.shape), 5)
+    net_returns = np.round(gross_returns - costs / 12, 5)
+    net_returns[rng.random(alive.shape) < zero_return_rate] = 0
+
+    # Net assets follow the fund's returns from a random starting size.
+    growth = np.cumprod(1 + gross_returns / 100, axis=1)
+    net_assets = np.round(rng.lognormal(17, 2, size=(num_secids, 1)) * growth, 2)
+    net_assets[rng.random(alive.shape) < zero_asset_rate] = 0
+
+    # Each fund starts in a category and changes category with
+    # probability category_churn in any month. A few classes disagree
+    # with the rest of their fund for a month.
+    fund_category = np.empty((num_funds, num_months), dtype=np.int64)
+    fund_category[:, 0] = rng.integers(len(categories), size=num_funds)
+    changes = rng.random((num_funds, num_months)) < category_churn
+    for t in range(1, num_months):
+        fund_category[:, t] = np.where(changes[:, t],
+                                       rng.integers(len(categories), size=num_funds),
+                                       fund_category[:, t - 1])
+    secid_category = fund_category[fund_ix]
+    strays = rng.random(alive.shape) < category_churn / 10
+    secid_category[strays] = rng.integers(len(categories), size=strays.sum())
+    category_names = categories.to_numpy(dtype=object)[secid_category]
+
+    for currency_type in ["usd", "local"]:
+        # Local currency returns differ from usd returns by a currency
+        # return that is common to each domicile.
+        if currency_type == "local":
+            fx_returns = rng.normal(0, 2, size=(len(domiciles), num_months))
+            fx = fx_returns[pd.Index(domiciles).get_indexer(fund_domiciles)][fund_ix]
+        else:
+            fx = 0
+
+        _write_panel(_wide_panel(df_ids, months, np.round(gross_returns - fx, 5),
+                                 observed("gross-returns")),
+                     root_dir, f"{currency_type}-monthly-gross-returns",
+                     country_group_code)
+        _write_panel(_wide_panel(df_ids, months, np.round(net_returns - fx, 5),
+                                 observed("net-returns")),
+                     root_dir, f"{currency_type}-monthly-net-returns",
+                     country_group_code)
+
+    _write_panel(_wide_panel(df_ids, months, costs, observed("costs")),
+                 root_dir, "monthly-costs", country_group_code)
+    _write_panel(_wide_panel(df_ids, months, net_assets, observed("net-assets")),
+                 root_dir, "monthly-net-assets", country_group_code)
+    _write_panel(_wide_panel(df_ids, months, category_names, observed("category")),
+                 root_dir, "monthly-morningstar-category", country_group_code)
+
+    inception_dates = months[0].to_timestamp() + pd.to_timedelta(
+        (secid_start * 30.44).astype(int) + rng.integers(0, 28, size=num_secids),
+        unit="D"
+    )
+    df_info = df_ids.assign(domicile=fund_domiciles[fund_ix],
+                            **{"inception-date": inception_dates.strftime("%d/%m/%Y")})
+    _write_panel(df_info, root_dir, "info", country_group_code)
+
+    return num_secids
+
+def generate_fund_data(root_dir, country_group_codes=("lux",), num_funds=1000,
+                       max_classes_per_fund=4, start_month="2000-01",
+                       num_months=240, missing_rates=None, zero_asset_rate=0.02,
+                       zero_return_rate=0.01, category_churn=0.005,
+                       num_categories=40, seed=0):
+    """
+    Write a synthetic copy of the fund data that process-mf-data.py
+    reads.
+
+    Parameters
+    ----------
+    root_dir : str
+        The directory to write the data into. The data is written to
+        the same paths below root_dir as the real data is below the
+        repository root, so process-mf-data.py can be run on it from
+        root_dir.
+    country_group_codes : sequence of str, default ("lux",)
+        The country groups to write data for.
+    num_funds : int, default 1000
+        The number of funds in each country group.
+    max_classes_per_fund : int, default 4
+        The largest number of share classes a fund can have.
+    start_month : str, default "2000-01"
+        The first month of the panels.
+    num_months : int, default 240
+        The number of months in the panels.
+    missing_rates : dict, default None
+        The share of the months in which a secid is alive that are
+        missing from each panel, keyed as in MISSING_RATES. Panels that
+        are not given use the rates in MISSING_RATES.
+    zero_asset_rate : float, default 0.02
+        The share of net assets observations that are exactly zero.
+    zero_return_rate : float, default 0.01
+        The share of net return observations that are exactly zero.
+    category_churn : float, default 0.005
+        The probability that a fund changes Morningstar category in any
+        month.
+    num_categories : int, default 40
+        The number of Morningstar categories.
+    seed : int, default 0
+        The seed of the random number generator.
+
+    Returns
+    -------
+    spec : dict
+        The arguments the data was made with and the number of secids
+        in each country group, which is also saved to SPEC_NAME in
+        root_dir.
+    """
+    missing_rates = {**MISSING_RATES, **(missing_rates or {})}
+    spec = {"country_group_codes": list(country_group_codes),
+            "num_funds": num_funds,
+            "max_classes_per_fund": max_classes_per_fund,
+            "start_month": start_month, "num_months": num_months,
+            "missing_rates": missing_rates, "zero_asset_rate": zero_asset_rate,
+            "zero_return_rate": zero_return_rate,
+            "category_churn": category_churn,
+            "num_categories": num_categories, "seed": seed}
+
+    rng = np.random.default_rng(seed)
+    months = pd.period_range(start_month, periods=num_months, freq="M")
+
+    mappings_dir = os.path.join(root_dir, "data", "mappings")
+    if not os.path.exists(mappings_dir):
+        os.makedirs(mappings_dir)
+    df_categories = _category_table(num_categories, rng)
+    df_categories.to_csv(os.path.join(mappings_dir, "morningstar_categories.csv"),
+                         index=False)
+
+    spec["num_secids"] = {
+        country_group_code: _generate_group(
+            root_dir, country_group_code, df_categories.morningstar_category,
+            months, num_funds, max_classes_per_fund, missing_rates,
+            zero_asset_rate, zero_return_rate, category_churn, rng
+        )
+        for country_group_code in country_group_codes
+    }
+
+    with open(os.path.join(root_dir, SPEC_NAME), "w") as f:
+        json.dump(spec, f, indent=4)
+
+    return spec
+
+def read_spec(root_dir):
+    """
+    Return the spec of the synthetic data in root_dir, or None if there
+    is none.
+    """
+    spec_path = os.path.join(root_dir, SPEC_NAME)
+    if not os.path.exists(spec_path):
+        return None
+
+    with open(spec_path) as f:
+        return json.load(f)
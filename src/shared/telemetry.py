@@ -0,0 +1,323 @@
+"""
+Structured timing and memory telemetry for process-mf-data.py.
+
+Once telemetry is started in a process, every pipeline stage measured
+with measure and every function wrapped with timed adds a record of its
+wall time, CPU time, row counts in and out and peak memory. Pool workers
+run their jobs through run_collected, which returns the records of the
+job alongside its result, so that the parent process can gather the
+records of every worker and write them as a single report per run.
+
+Peak memory is reported in two ways. The peak resident set size is the
+high-water mark of the whole process up to the end of the call, as
+reported by the operating system, so it includes memory allocated by
+pyarrow. If memory tracing is enabled, the peak traced memory is the
+largest amount of memory allocated through Python (including numpy
+arrays) at any point during the call, above what was allocated when it
+started. Tracing slows down the run considerably, so it is off by
+default.
+
+When telemetry has not been started, measuring a call only costs a
+check of whether telemetry is active.
+"""
+import contextlib
+import csv
+import functools
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+TELEMETRY_DIR = "data/mutual-funds/telemetry"
+
+# The fields of every record, in the order they are written to csv.
+# Labels (such as the country group) are written after these.
+FIELDS = ["name", "kind", "pid", "start", "wall_seconds", "cpu_seconds",
+          "rows_in", "rows_out", "peak_rss_bytes", "traced_peak_bytes"]
+
+# The telemetry state of this process, or None if telemetry is off.
+_state = None
+
+def active():
+    """Return True if telemetry has been started in this process."""
+    return _state is not None
+
+def tracing():
+    """Return True if telemetry is recording traced memory peaks."""
+    return _state is not None and _state["trace_memory"]
+
+def start(trace_memory=False):
+    """
+    Start recording telemetry in this process.
+
+    Parameters
+    ----------
+    trace_memory : bool, default False
+        If True, the peak memory allocated through Python during each
+        measured call is recorded with tracemalloc.
+    """
+    global _state
+
+    if _state is not None:
+        raise ValueError("Telemetry has already been started.")
+
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+
+    _state = {"records": [], "labels": {}, "trace_memory": trace_memory,
+              "started_tracing": started_tracing, "peaks": []}
+
+def stop():
+    """
+    Stop recording telemetry in this process.
+
+    Returns
+    -------
+    records : list of dict
+        Every record made since telemetry was started.
+    """
+    global _state
+
+    if _state is None:
+        return []
+
+    if _state["started_tracing"]:
+        tracemalloc.stop()
+
+    records = _state["records"]
+    _state = None
+
+    return records
+
+def extend(records):
+    """Add records made in another process, such as a pool worker."""
+    if _state is not None:
+        _state["records"].extend(records)
+
+@contextlib.contextmanager
+def labels(**new_labels):
+    """
+    Add labels, such as the country group, to every record made inside
+    the context.
+    """
+    if _state is None:
+        yield
+        return
+
+    old_labels = _state["labels"]
+    _state["labels"] = {**old_labels, **new_labels}
+    try:
+        yield
+    finally:
+        _state["labels"] = old_labels
+
+def count_rows(data):
+    """
+    Return the total number of rows in a DataFrame, or in every
+    DataFrame in a dict, list or tuple, or None if there are none.
+    """
+    if isinstance(data, (pd.DataFrame, pd.Series)):
+        return len(data)
+
+    if isinstance(data, dict):
+        data = list(data.values())
+
+    if isinstance(data, (list, tuple)):
+        counts = [count_rows(item) for item in data]
+        counts = [count for count in counts if count is not None]
+        if counts:
+            return sum(counts)
+
+    return None
+
+def _peak_rss():
+    """
+    Return the peak resident set size of this process in bytes, or None
+    if it cannot be measured on this platform.
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    if psutil is not None:
+        memory_info = psutil.Process().memory_info()
+        return getattr(memory_info, "peak_wset", memory_info.rss)
+
+    return None
+
+@contextlib.contextmanager
+def measure(name, rows_in=None, kind="stage"):
+    """
+    Measure the code run inside the context.
+
+    Parameters
+    ----------
+    name : str
+        The name of the record.
+    rows_in : int, default None
+        The number of rows passed into the code.
+    kind : {"stage", "call"}, default "stage"
+        Whether the record is of a pipeline stage or a function call.
+
+    Yields
+    ------
+    record : dict
+        The record being made. Set record["rows_out"] inside the context
+        to record the number of rows produced. If telemetry is off, the
+        record is discarded.
+    """
+    record = {"name": name, "kind": kind, "rows_in": rows_in,
+              "rows_out": None}
+    if _state is None:
+        yield record
+        return
+
+    state = _state
+    trace_memory = state["trace_memory"] and tracemalloc.is_tracing()
+    if trace_memory:
+        # Calls may be nested, so pass the peak so far to the enclosing
+        # call before resetting it.
+        current, peak = tracemalloc.get_traced_memory()
+        if state["peaks"]:
+            state["peaks"][-1]["peak"] = max(state["peaks"][-1]["peak"], peak)
+        tracemalloc.reset_peak()
+        state["peaks"].append({"base": current, "peak": 0})
+
+    record.update(pid=os.getpid(), start=datetime.now().isoformat(),
+                  **state["labels"])
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield record
+    finally:
+        record["wall_seconds"] = time.perf_counter() - wall_start
+        record["cpu_seconds"] = time.process_time() - cpu_start
+        record["peak_rss_bytes"] = _peak_rss()
+        record["traced_peak_bytes"] = None
+
+        if trace_memory:
+            frame = state["peaks"].pop()
+            peak = max(tracemalloc.get_traced_memory()[1], frame["peak"])
+            record["traced_peak_bytes"] = peak - frame["base"]
+            if state["peaks"]:
+                state["peaks"][-1]["peak"] = max(state["peaks"][-1]["peak"],
+                                                 peak)
+
+        state["records"].append(record)
+
+def timed(func):
+    """
+    Wrap a function so that each call is measured while telemetry is
+    on. The rows in are counted from the first argument and the rows
+    out from the return value.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _state is None:
+            return func(*args, **kwargs)
+
+        rows_in = count_rows(args[0]) if args else None
+        with measure(func.__name__, rows_in, kind="call") as record:
+            result = func(*args, **kwargs)
+            record["rows_out"] = count_rows(result)
+
+        return result
+
+    return wrapper
+
+def run_collected(func, *args, trace_memory=False, job_labels=None, **kwargs):
+    """
+    Run a function with telemetry on, for use in pool workers.
+
+    Parameters
+    ----------
+    func : callable
+        The function to run.
+    *args, **kwargs
+        The arguments to pass to func.
+    trace_memory : bool, default False
+        As in start.
+    job_labels : dict, default None
+        Labels to add to every record made by func.
+
+    Returns
+    -------
+    result, records
+        The return value of func and the records it made. If func
+        raises an exception, the records are attached to it as its
+        telemetry_records attribute, which survives pickling.
+    """
+    global _state
+
+    # A forked worker inherits the telemetry state of its parent, whose
+    # records belong to the parent, so set it aside while func runs.
+    inherited_state, _state = _state, None
+
+    start(trace_memory)
+    try:
+        with labels(**(job_labels or {})):
+            result = func(*args, **kwargs)
+    except BaseException as error:
+        error.telemetry_records = stop()
+        raise
+    else:
+        records = stop()
+    finally:
+        _state = inherited_state
+
+    return result, records
+
+def write_report(records, report_dir=TELEMETRY_DIR, run_name=None):
+    """
+    Write the records of a run as a json report and a csv report.
+
+    Parameters
+    ----------
+    records : sequence of dict
+        The records of every process in the run.
+    report_dir : str, default TELEMETRY_DIR
+        The directory to save the reports in.
+    run_name : str, default None
+        The file name of the reports, without an extension. Defaults to
+        the current time.
+
+    Returns
+    -------
+    json_path, csv_path : str
+        The paths of the saved reports.
+    """
+    if run_name is None:
+        run_name = "run_" + datetime.now().strftime("%Y%m%d-%H%M%S")
+
+    os.makedirs(report_dir, exist_ok=True)
+
+    json_path = os.path.join(report_dir, run_name + ".json")
+    with open(json_path, "w") as f:
+        json.dump({"run": run_name, "records": list(records)}, f, indent=4,
+                  default=str)
+
+    label_names = sorted({key for record in records for key in record}
+                         - set(FIELDS))
+    csv_path = os.path.join(report_dir, run_name + ".csv")
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS + label_names)
+        writer.writeheader()
+        writer.writerows(records)
+
+    return json_path, csv_path